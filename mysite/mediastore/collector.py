@@ -0,0 +1,276 @@
+"""
+Сборщик мусора в MEDIA_ROOT: файлы, на которые не ссылается ни одно
+поле FileField/ImageField.
+
+Память не зависит от числа файлов и строк:
+
+* имена из всех файловых полей читаются потоком (``iterator``) во временную
+  SQLite-базу на диске с индексом - каждый столбец читается один раз;
+* дерево файлов обходится потоком через ``os.scandir``, а проверка идёт
+  пачками по индексу временной базы;
+* удаление (или перенос в карантин) тоже идёт пачками.
+
+Производные файлы (варианты картинок ``variants/<исходник без расширения>/…``)
+живы, пока жив их исходник. Файлы моложе ``min_age`` не трогаются: их
+строка может быть ещё не закоммичена. Найденные сироты перед удалением
+перепроверяются по базе: одинаковый файл могли загрузить заново, пока
+шёл обход, и тогда старый файл снова нужен. Поэтому файл из ``blobs/``
+удаляется, только если у него нет записи ``Blob`` со ссылками: повторная
+загрузка сначала добавляет ссылку и обновляет mtime файла, а строка с ним
+может быть ещё не закоммичена.
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from functools import reduce
+from itertools import islice
+from operator import or_
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import FileField, Q
+
+from .models import Blob
+from .storage import is_blob
+
+# производные файлы: shopapp.images.variant_name
+DERIVED_PREFIXES = ("variants/",)
+
+MAX_REPORTED_FILES = 100
+
+
+def media_root() -> str:
+    return os.path.abspath(settings.MEDIA_ROOT)
+
+
+def media_fields() -> list:
+    """
+    Файловые поля всех моделей, которые хранят файлы в MEDIA_ROOT.
+    """
+    root = media_root()
+    return [
+        field
+        for model in apps.get_models()
+        for field in model._meta.concrete_fields
+        if isinstance(field, FileField)
+        and isinstance(field.storage, FileSystemStorage)
+        and os.path.abspath(field.storage.location) == root
+    ]
+
+
+def source_stem(name: str):
+    for prefix in DERIVED_PREFIXES:
+        if name.startswith(prefix):
+            return os.path.dirname(name[len(prefix):])
+    return None
+
+
+class ReferenceIndex:
+    """
+    Множество имён, на которые ссылается база, во временном файле SQLite.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.directory = tempfile.mkdtemp(prefix="media-gc-")
+        self.connection = sqlite3.connect(os.path.join(self.directory, "references.sqlite3"))
+        self.connection.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE name (value TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE stem (value TEXT PRIMARY KEY) WITHOUT ROWID;
+        """)
+
+    def close(self):
+        self.connection.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, names):
+        names = iter(names)
+        while batch := list(islice(names, self.batch_size)):
+            self.connection.executemany("INSERT OR IGNORE INTO name VALUES (?)", ((name,) for name in batch))
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO stem VALUES (?)",
+                ((os.path.splitext(name)[0],) for name in batch),
+            )
+        self.connection.commit()
+
+    def load(self, fields):
+        for field in fields:
+            names = (
+                field.model._default_manager
+                .exclude(**{field.attname: ""}).exclude(**{f"{field.attname}__isnull": True})
+                .values_list(field.attname, flat=True)
+                .iterator(chunk_size=self.batch_size)
+            )
+            self.add(names)
+
+    def referenced(self, names: list) -> set:
+        """
+        Те имена из пачки, которые ещё нужны.
+        """
+        found = set()
+        stems = {}
+        for name in names:
+            stem = source_stem(name)
+            if stem is not None:
+                stems.setdefault(stem, []).append(name)
+        # SQLite держит не больше 32766 параметров, пачки заведомо меньше
+        for table, values in (("name", names), ("stem", list(stems))):
+            if not values:
+                continue
+            rows = self.connection.execute(
+                f"SELECT value FROM {table} WHERE value IN ({', '.join('?' * len(values))})", values,
+            )
+            for (value,) in rows:
+                found.update(stems[value] if table == "stem" else [value])
+        return found
+
+
+def still_referenced(fields, names: list) -> set:
+    """
+    Перепроверка кандидатов на удаление по текущему состоянию базы.
+    """
+    found = set()
+    stems = {}
+    for name in names:
+        stem = source_stem(name)
+        if stem is not None:
+            stems.setdefault(stem, []).append(name)
+    for field in fields:
+        manager = field.model._default_manager
+        found.update(manager.filter(**{f"{field.attname}__in": names}).values_list(field.attname, flat=True))
+        if stems:
+            condition = reduce(or_, (Q(**{f"{field.attname}__startswith": f"{stem}."}) for stem in stems))
+            for name in manager.filter(condition).values_list(field.attname, flat=True):
+                found.update(stems.get(os.path.splitext(name)[0], []))
+    return found
+
+
+def iter_media_files(root: str, skip=()):
+    """
+    (имя относительно root, размер, mtime) для всех файлов дерева; порядок - как в каталоге.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in skip:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    name = os.path.relpath(entry.path, root).replace(os.sep, "/")
+                    yield name, stat.st_size, stat.st_mtime
+
+
+def prune_empty_directories(path: str, root: str):
+    directory = os.path.dirname(path)
+    while directory != root and directory.startswith(root):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+class GarbageReport:
+    def __init__(self):
+        self.scanned = 0
+        self.orphans = 0
+        self.orphan_bytes = 0
+        self.removed = 0
+        self.files = []
+
+    def add_orphan(self, name: str, size: int):
+        self.orphans += 1
+        self.orphan_bytes += size
+        if len(self.files) < MAX_REPORTED_FILES:
+            self.files.append(name)
+
+    def as_dict(self) -> dict:
+        return {
+            "scanned": self.scanned,
+            "orphans": self.orphans,
+            "orphan_bytes": self.orphan_bytes,
+            "removed": self.removed,
+            "files": self.files,
+        }
+
+    def __str__(self):
+        return (
+            f"scanned: {self.scanned}, orphans: {self.orphans} ({self.orphan_bytes} bytes), "
+            f"removed: {self.removed}"
+        )
+
+
+def remove_orphans(names: list, root: str, quarantine: str = None) -> int:
+    removed = 0
+    blobs = [name for name in names if is_blob(name)]
+    with transaction.atomic():
+        # запись первой: параллельный Blob.objects.acquire ждёт конца транзакции, а потом заново пишет файл
+        Blob.objects.filter(name__in=blobs, refcount=0).delete()
+        # у файла есть ссылка по счётчику - его загружают заново, строка ещё не закоммичена
+        live = set(Blob.objects.filter(name__in=blobs).values_list("name", flat=True))
+        for name in names:
+            if name in live:
+                continue
+            path = os.path.join(root, name)
+            try:
+                if quarantine:
+                    target = os.path.join(quarantine, name)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                # файл уже удалён (например, последней ссылкой) - это не ошибка
+                continue
+            removed += 1
+            prune_empty_directories(path, root)
+    return removed
+
+
+def collect_garbage(dry_run: bool = False, quarantine: str = None, min_age: int = 24 * 60 * 60,
+                    batch_size: int = 500) -> GarbageReport:
+    """
+    Находит и удаляет (переносит в ``quarantine``) файлы MEDIA_ROOT без ссылок из базы.
+    """
+    root = media_root()
+    report = GarbageReport()
+    if not os.path.isdir(root):
+        return report
+    skip = set()
+    if quarantine:
+        quarantine = os.path.abspath(quarantine)
+        skip.add(quarantine)
+    # сначала список живых имён: файл, загруженный после него, защищает min_age
+    started = time.time()
+    fields = media_fields()
+    with ReferenceIndex(batch_size) as index:
+        index.load(fields)
+        files = iter_media_files(root, skip)
+        while batch := list(islice(files, batch_size)):
+            report.scanned += len(batch)
+            candidates = [(name, size) for name, size, mtime in batch if started - mtime >= min_age]
+            referenced = index.referenced([name for name, size in candidates])
+            orphans = [(name, size) for name, size in candidates if name not in referenced]
+            if orphans:
+                referenced = still_referenced(fields, [name for name, size in orphans])
+                orphans = [(name, size) for name, size in orphans if name not in referenced]
+            for name, size in orphans:
+                report.add_orphan(name, size)
+            if orphans and not dry_run:
+                report.removed += remove_orphans([name for name, size in orphans], root, quarantine)
+    return report
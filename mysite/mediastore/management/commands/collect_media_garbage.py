@@ -0,0 +1,49 @@
+import time
+
+from django.core.management import BaseCommand
+from django.db import close_old_connections
+
+from mediastore.collector import collect_garbage
+
+
+class Command(BaseCommand):
+    """
+    Deletes (or moves to quarantine) files under MEDIA_ROOT that no FileField/ImageField references
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report orphaned files")
+        parser.add_argument(
+            "--quarantine",
+            metavar="DIR",
+            help="Move orphaned files to this directory instead of deleting them (keep it outside MEDIA_ROOT)",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=24 * 60 * 60,
+            help="Skip files modified less than this many seconds ago (default: one day)",
+        )
+        parser.add_argument("--batch-size", type=int, default=500, help="Files checked and removed per batch")
+        parser.add_argument("--loop", action="store_true", help="Keep running, collecting every --interval seconds")
+        parser.add_argument("--interval", type=int, default=6 * 60 * 60, help="Seconds between runs with --loop")
+
+    def handle(self, *args, **options):
+        while True:
+            report = collect_garbage(
+                dry_run=options["dry_run"],
+                quarantine=options["quarantine"],
+                min_age=options["min_age"],
+                batch_size=options["batch_size"],
+            )
+            if options["verbosity"] > 1 or options["dry_run"]:
+                for name in report.files:
+                    self.stdout.write(f"orphan: {name}")
+                if report.orphans > len(report.files):
+                    self.stdout.write(f"... and {report.orphans - len(report.files)} more")
+            self.stdout.write(self.style.SUCCESS(f"Media garbage collected: {report}"))
+            if not options["loop"]:
+                return
+            # соединение с базой между запусками может оборваться
+            close_old_connections()
+            time.sleep(options["interval"])
@@ -0,0 +1,42 @@
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+
+
+class BlobManager(models.Manager):
+
+    def acquire(self, name: str, size: int):
+        """
+        Ещё одна ссылка на файл; первая создаёт запись.
+        """
+        if self.filter(name=name).update(refcount=F("refcount") + 1):
+            return
+        try:
+            with transaction.atomic():
+                self.create(name=name, size=size, refcount=1)
+        except IntegrityError:
+            # запись успел создать параллельный запрос
+            self.filter(name=name).update(refcount=F("refcount") + 1)
+
+    def release(self, name: str) -> bool:
+        """
+        Снимает одну ссылку; True, если ссылок не осталось и файл можно удалять.
+        """
+        if self.filter(name=name, refcount__gt=1).update(refcount=F("refcount") - 1):
+            return False
+        deleted, _ = self.filter(name=name).delete()
+        return bool(deleted)
+
+
+class Blob(models.Model):
+    """
+    Файл в хранилище по содержимому и число ссылающихся на него полей моделей.
+    """
+    name = models.CharField(max_length=255, primary_key=True)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobManager()
+
+    def __str__(self) -> str:
+        return f"{self.name} ({self.refcount})"
@@ -0,0 +1,76 @@
+"""
+Снятие ссылок на файлы хранилища по содержимому.
+
+Ссылку добавляет сама загрузка (``ContentAddressedStorage.save``), а снимают
+её эти сигналы: при удалении строки и при замене файла в поле. Прежние
+имена запоминаются в post_init, чтобы не читать строку заново перед
+сохранением. Сигналы подключаются в ready() только к моделям, у которых
+есть поля с таким хранилищем. Массовые операции (queryset.delete/update)
+сигналов не шлют; оставшиеся после них файлы убирает сборщик мусора.
+"""
+from functools import partial
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import FileField
+from django.db.models.signals import post_delete, post_init, post_save
+
+from .storage import ContentAddressedStorage, is_blob
+
+NAMES_ATTR = "_blob_names"
+
+
+def blob_fields(model) -> list:
+    return [
+        field
+        for field in model._meta.concrete_fields
+        if isinstance(field, FileField) and isinstance(field.storage, ContentAddressedStorage)
+    ]
+
+
+def stored_names(instance, fields) -> dict:
+    names = {}
+    for field in fields:
+        # отложенные (.only/.defer) поля не трогаем: прежнее значение неизвестно
+        if field.attname not in instance.__dict__:
+            continue
+        value = instance.__dict__[field.attname]
+        names[field.attname] = getattr(value, "name", value) or None
+    return names
+
+
+def release(field, name: str):
+    transaction.on_commit(partial(field.storage.delete, name))
+
+
+def remember_names(sender, instance, fields, **kwargs):
+    setattr(instance, NAMES_ATTR, stored_names(instance, fields))
+
+
+def release_replaced(sender, instance, fields, raw: bool, **kwargs):
+    previous = getattr(instance, NAMES_ATTR, {})
+    current = stored_names(instance, fields)
+    if not raw:
+        for field in fields:
+            name = previous.get(field.attname)
+            if is_blob(name) and field.attname in current and current[field.attname] != name:
+                release(field, name)
+    setattr(instance, NAMES_ATTR, current)
+
+
+def release_deleted(sender, instance, fields, **kwargs):
+    for field in fields:
+        name = stored_names(instance, [field]).get(field.attname)
+        if is_blob(name):
+            release(field, name)
+
+
+def connect_blob_fields():
+    for model in apps.get_models():
+        fields = blob_fields(model)
+        if not fields:
+            continue
+        uid = f"mediastore:{model._meta.label_lower}"
+        post_init.connect(partial(remember_names, fields=fields), sender=model, weak=False, dispatch_uid=uid)
+        post_save.connect(partial(release_replaced, fields=fields), sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(partial(release_deleted, fields=fields), sender=model, weak=False, dispatch_uid=uid)
@@ -0,0 +1,166 @@
+"""
+Хранилище медиафайлов с адресацией по содержимому.
+
+Имя файла - хэш его содержимого с исходным расширением, разложенный по
+вложенным каталогам: ``blobs/ab/cd/abcd…ef.png``. Поэтому:
+
+* одинаковые загрузки (одна и та же картинка поставщика у разных товаров,
+  заказов и профилей) лежат на диске один раз;
+* в каталоге не больше 256 подкаталогов, а файлы расходятся по 65536
+  конечным каталогам, так что поиск по каталогу не замедляется с ростом
+  медиатеки;
+* upload_to полей больше не влияет на путь (и ``product_None`` не появляется).
+
+Число ссылок на файл ведёт ``mediastore.models.Blob``: ``save`` добавляет
+ссылку, ``delete`` её снимает, а сам файл удаляется вместе с последней.
+Ссылки от удалённых и заменённых значений полей снимают сигналы
+(``mediastore.signals``). Файл нужно сохранять через поле или ``save``, а не
+присваивать чужое имя: такая копия ссылку не добавит.
+
+Имена вне ``blobs/`` (файлы, загруженные до перехода, и производные файлы с
+префиксами из ``passthrough``, например варианты картинок, названные по
+исходнику) обслуживаются как в обычном FileSystemStorage.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+BLOB_PREFIX = "blobs"
+INCOMING_DIR = ".incoming"
+CHUNK_SIZE = 64 * 1024
+
+EXTENSION_ALIASES = {
+    ".jpeg": ".jpg",
+    ".jpe": ".jpg",
+    ".tif": ".tiff",
+}
+
+
+def is_blob(name: str) -> bool:
+    return bool(name) and name.replace("\\", "/").startswith(f"{BLOB_PREFIX}/")
+
+
+@deconstructible(path="mediastore.storage.ContentAddressedStorage")
+class ContentAddressedStorage(FileSystemStorage):
+
+    def __init__(self, *args, shard_depth: int = 2, shard_width: int = 2, algorithm: str = "sha256",
+                 passthrough=("variants/",), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        self.algorithm = algorithm
+        self.passthrough = tuple(passthrough)
+
+    def is_passthrough(self, name: str) -> bool:
+        return name.replace("\\", "/").startswith(self.passthrough)
+
+    def blob_name(self, digest: str, original_name: str) -> str:
+        extension = os.path.splitext(original_name)[1].lower()
+        extension = EXTENSION_ALIASES.get(extension, extension)
+        width = self.shard_width
+        shards = [digest[level * width:(level + 1) * width] for level in range(self.shard_depth)]
+        return "/".join([BLOB_PREFIX, *shards, digest + extension])
+
+    def get_available_name(self, name, max_length=None):
+        # имя зависит от содержимого и станет известно в _save; совпадение имён - тот же файл
+        if self.is_passthrough(name):
+            return super().get_available_name(name, max_length)
+        return name
+
+    # --- запись ----------------------------------------------------------------------------------------------------
+
+    def makedirs(self, directory: str):
+        if self.directory_permissions_mode is None:
+            os.makedirs(directory, exist_ok=True)
+            return
+        old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+        try:
+            os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+        finally:
+            os.umask(old_umask)
+
+    def incoming_directory(self) -> str:
+        """
+        Каталог для недописанных файлов: на том же разделе, что и blobs/, чтобы перенос был переименованием.
+        """
+        incoming = os.path.join(self.location, BLOB_PREFIX, INCOMING_DIR)
+        self.makedirs(incoming)
+        return incoming
+
+    def spool(self, content):
+        """
+        Считает хэш за один проход; возвращает (хэш, размер, путь к содержимому, наш ли это временный файл).
+
+        Временный файл загрузки хэшируется на месте и потом просто переносится,
+        остальное содержимое пишется во временный файл рядом с blobs/.
+        """
+        if hasattr(content, "temporary_file_path") and getattr(content, "hash_algorithm", None) == self.algorithm:
+            # хэш уже посчитан при приёме загрузки (mediastore.uploadhandlers): файл больше не читаем
+            return content.content_hash, content.size, content.temporary_file_path(), False
+        digest = hashlib.new(self.algorithm)
+        size = 0
+        if hasattr(content, "temporary_file_path"):
+            for chunk in content.chunks(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+            return digest.hexdigest(), size, content.temporary_file_path(), False
+
+        fd, path = tempfile.mkstemp(dir=self.incoming_directory())
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return digest.hexdigest(), size, path, True
+
+    def _save(self, name, content):
+        if self.is_passthrough(name):
+            return super()._save(name, content)
+
+        from .models import Blob
+
+        digest, size, source, owned = self.spool(content)
+        try:
+            name = self.blob_name(digest, name)
+            full_path = self.path(name)
+            # сначала ссылка, потом файл: параллельный delete не удалит файл, который мы уже посчитали
+            Blob.objects.acquire(name, size)
+            try:
+                # файл уже есть: для сборщика мусора (min_age) он снова свежий, пока строка не закоммичена
+                os.utime(full_path)
+            except FileNotFoundError:
+                self.makedirs(os.path.dirname(full_path))
+                if owned:
+                    # атомарно: параллельная загрузка того же содержимого перезапишет файл тем же
+                    os.replace(source, full_path)
+                    owned = False
+                else:
+                    file_move_safe(source, full_path, allow_overwrite=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(full_path, self.file_permissions_mode)
+                self._ensure_location_group_id(full_path)
+        finally:
+            if owned:
+                os.unlink(source)
+        return name
+
+    # --- удаление --------------------------------------------------------------------------------------------------
+
+    def delete(self, name):
+        if not is_blob(name):
+            return super().delete(name)
+
+        from .models import Blob
+
+        if Blob.objects.release(name):
+            super().delete(name)
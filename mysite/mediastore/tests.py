@@ -0,0 +1,274 @@
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import Permission, User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from shopapp.models import Order, Product
+
+from .collector import collect_garbage
+from .models import Blob
+from .storage import ContentAddressedStorage, is_blob
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), SHOPAPP_IMAGE_WORKERS=0)
+class ContentAddressedStorageTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='media_tester', password='pedro999')
+
+    def setUp(self):
+        # варианты превью здесь не нужны, а поток построения упёрся бы в транзакцию теста
+        patcher = mock.patch('shopapp.signals.enqueue_variants')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_identical_uploads_are_stored_once(self):
+        first = Product.objects.create(name='Lamp', created_by=self.user,
+                                       preview=SimpleUploadedFile('lamp.JPEG', b'supplier photo'))
+        second = Product.objects.create(name='Lamp 2', created_by=self.user,
+                                        preview=SimpleUploadedFile('other.jpg', b'supplier photo'))
+        order = Order.objects.create(user=self.user, receipt=SimpleUploadedFile('receipt.jpg', b'supplier photo'))
+
+        name = first.preview.name
+        self.assertTrue(is_blob(name))
+        self.assertNotIn('product_None', name)
+        self.assertEqual(second.preview.name, name)
+        self.assertEqual(order.receipt.name, name)
+        # blobs/ab/cd/<sha256>.jpg
+        shards = name.split('/')
+        self.assertEqual(shards[1] + shards[2], shards[3][:4])
+        self.assertTrue(name.endswith('.jpg'))
+        self.assertEqual(Blob.objects.get(name=name).refcount, 3)
+        self.assertEqual(default_storage.open(name).read(), b'supplier photo')
+
+    def test_file_is_deleted_with_last_reference(self):
+        first = Product.objects.create(name='Desk', created_by=self.user,
+                                       preview=SimpleUploadedFile('desk.png', b'desk'))
+        second = Product.objects.create(name='Desk 2', created_by=self.user,
+                                        preview=SimpleUploadedFile('desk.png', b'desk'))
+        name = first.preview.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(Blob.objects.get(name=name).refcount, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+
+    def test_replaced_file_is_released(self):
+        product = Product.objects.create(name='Shelf', created_by=self.user,
+                                         preview=SimpleUploadedFile('shelf.png', b'old shelf'))
+        old_name = product.preview.name
+
+        product = Product.objects.get(pk=product.pk)
+        product.preview = SimpleUploadedFile('shelf.png', b'new shelf')
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertNotEqual(product.preview.name, old_name)
+        self.assertFalse(default_storage.exists(old_name))
+        self.assertTrue(default_storage.exists(product.preview.name))
+
+    def test_passthrough_and_legacy_names(self):
+        storage = ContentAddressedStorage()
+        name = storage.save('variants/blobs/ab/cd/abcd/thumb.webp', ContentFile(b'webp'))
+        self.assertEqual(name, 'variants/blobs/ab/cd/abcd/thumb.webp')
+        legacy = 'products/product_1/preview/old.png'
+        os.makedirs(os.path.dirname(storage.path(legacy)))
+        with open(storage.path(legacy), 'wb') as file:
+            file.write(b'legacy')
+        self.assertEqual(storage.open(legacy).read(), b'legacy')
+        storage.delete(legacy)
+        self.assertFalse(storage.exists(legacy))
+        self.assertFalse(Blob.objects.exists())
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), SHOPAPP_IMAGE_WORKERS=0)
+class CollectMediaGarbageTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='gc_tester', password='pedro999')
+
+    def setUp(self):
+        patcher = mock.patch('shopapp.signals.enqueue_variants')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.kept = Product.objects.create(name='Kept', created_by=self.user,
+                                           preview=SimpleUploadedFile('kept.png', b'kept'))
+        self.gone = Product.objects.create(name='Gone', created_by=self.user,
+                                           preview=SimpleUploadedFile('gone.png', b'gone'))
+        storage = default_storage
+        self.kept_variant = storage.save(f'variants/{os.path.splitext(self.kept.preview.name)[0]}/thumb.webp',
+                                         ContentFile(b'kept thumb'))
+        self.gone_variant = storage.save(f'variants/{os.path.splitext(self.gone.preview.name)[0]}/thumb.webp',
+                                         ContentFile(b'gone thumb'))
+        self.gone_name = self.gone.preview.name
+        # queryset.delete() сигналов не шлёт: файл остаётся; счётчик сбрасываем, как будто ссылок нет
+        Product.objects.filter(pk=self.gone.pk).delete()
+        Blob.objects.filter(name=self.gone_name).update(refcount=0)
+
+    def test_dry_run_reports_orphans(self):
+        out = StringIO()
+        call_command('collect_media_garbage', '--dry-run', '--min-age=0', stdout=out)
+        output = out.getvalue()
+        self.assertIn(f'orphan: {self.gone_name}', output)
+        self.assertIn(f'orphan: {self.gone_variant}', output)
+        self.assertNotIn(self.kept.preview.name, output)
+        self.assertTrue(default_storage.exists(self.gone_name))
+
+    def test_collect_and_quarantine(self):
+        quarantine = tempfile.mkdtemp()
+        report = collect_garbage(quarantine=quarantine, min_age=0, batch_size=2)
+        self.assertEqual(report.orphans, 2)
+        self.assertEqual(report.removed, 2)
+        self.assertFalse(default_storage.exists(self.gone_name))
+        self.assertFalse(default_storage.exists(self.gone_variant))
+        self.assertTrue(os.path.exists(os.path.join(quarantine, self.gone_name)))
+        self.assertFalse(Blob.objects.filter(name=self.gone_name).exists())
+        self.assertTrue(default_storage.exists(self.kept.preview.name))
+        self.assertTrue(default_storage.exists(self.kept_variant))
+
+    def test_recent_files_are_kept(self):
+        report = collect_garbage()
+        self.assertEqual(report.orphans, 0)
+        self.assertTrue(default_storage.exists(self.gone_name))
+
+    def test_reuploaded_blob_is_kept(self):
+        path = default_storage.path(self.gone_name)
+        os.utime(path, (0, 0))
+        # та же картинка загружается снова, строка с ней ещё не закоммичена
+        self.assertEqual(default_storage.save('again.png', ContentFile(b'gone')), self.gone_name)
+        self.assertGreater(os.path.getmtime(path), 0)
+        self.assertEqual(collect_garbage(min_age=60).orphans, 0)
+
+        report = collect_garbage(min_age=0)
+        self.assertIn(self.gone_name, report.files)
+        self.assertEqual(report.removed, report.orphans - 1)
+        self.assertTrue(default_storage.exists(self.gone_name))
+        self.assertFalse(default_storage.exists(self.gone_variant))
+        self.assertEqual(Blob.objects.get(name=self.gone_name).refcount, 1)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), SHOPAPP_IMAGE_WORKERS=0)
+class ServeMediaTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='receipt_owner', password='pedro999')
+        cls.stranger = User.objects.create_user(username='stranger', password='pedro999')
+        cls.order = Order.objects.create(user=cls.owner, receipt=SimpleUploadedFile('receipt.pdf', b'%PDF receipt'))
+
+    def setUp(self):
+        patcher = mock.patch('shopapp.signals.enqueue_variants')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.product = Product.objects.create(name='Vase', created_by=self.owner,
+                                              preview=SimpleUploadedFile('vase.png', b'0123456789'))
+
+    def url(self, name):
+        return reverse('mediastore:serve', kwargs={'name': name})
+
+    def test_public_file_with_validators_and_ranges(self):
+        url = self.url(self.product.preview.name)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+        etag = response['ETag']
+        self.assertIn(os.path.basename(self.product.preview.name).split('.')[0], etag)
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=4-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'456789')
+        self.assertEqual(response['Content-Length'], '6')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=1-3', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'123')
+        self.assertEqual(response['Content-Range'], 'bytes 1-3/10')
+
+        # устаревший If-Range - весь файл
+        response = self.client.get(url, HTTP_RANGE='bytes=1-3', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_receipt_permissions(self):
+        url = self.url(self.order.receipt.name)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.client.force_login(self.stranger)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.stranger.user_permissions.add(Permission.objects.get(codename='view_order'))
+        self.stranger = User.objects.get(pk=self.stranger.pk)
+        self.client.force_login(self.stranger)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.client.force_login(self.owner)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+
+    @override_settings(SENDFILE_BACKEND='x-accel', SENDFILE_URL='/protected-media/')
+    def test_x_accel_redirect(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url(self.order.receipt.name))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.order.receipt.name}')
+        self.assertEqual(response.content, b'')
+        self.assertTrue(response['ETag'])
+
+    def write_file(self, name, content=b'data'):
+        # мимо хранилища: оно переименовало бы файл в blobs/
+        path = default_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+        return name
+
+    def test_unreferenced_files_are_denied(self):
+        names = [
+            self.write_file('exports/orders-export-7.csv.gz.part'),
+            self.write_file('exports/orders-export-7.csv.gz'),
+            self.write_file('orders/receipts/orphan.pdf'),
+            self.write_file('uploads/stray.png'),
+        ]
+        for name in names:
+            self.assertEqual(self.client.get(self.url(name)).status_code, 404, name)
+
+        admin = User.objects.create_superuser(username='media_admin', password='pedro999')
+        self.client.force_login(admin)
+        # каталог закрытого поля без строки - только для привилегированных, .part - никому
+        response = self.client.get(self.url('exports/orders-export-7.csv.gz'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertEqual(self.client.get(self.url('exports/orders-export-7.csv.gz.part')).status_code, 404)
+        self.assertEqual(self.client.get(self.url('uploads/stray.png')).status_code, 404)
+
+    def test_variants_follow_their_source(self):
+        stem = os.path.splitext(self.product.preview.name)[0]
+        name = self.write_file(f'variants/{stem}/thumb.webp')
+        response = self.client.get(self.url(name))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        orphan = self.write_file('variants/blobs/00/00/gone/thumb.webp')
+        self.assertEqual(self.client.get(self.url(orphan)).status_code, 404)
+
+    def test_hidden_and_outside_paths(self):
+        self.assertEqual(self.client.get(self.url('blobs/.incoming/tmp123')).status_code, 404)
+        self.assertEqual(self.client.get(self.url('../db.sqlite3')).status_code, 404)
+        self.assertEqual(self.client.get(self.url('missing.png')).status_code, 404)
@@ -0,0 +1,155 @@
+"""
+Обработчики загрузки файлов с лимитом размера на представление.
+
+``HashingUploadHandler`` пишет загрузку сразу в каталог хранилища
+(``blobs/.incoming``) и по пути считает хэш содержимого. Поэтому
+``ContentAddressedStorage.save`` только переименовывает готовый файл в
+``blobs/…`` и не читает его второй раз. Лимит проверяется на каждом куске:
+слишком большой файл обрывается сразу, а не после приёма целиком.
+
+На действия viewset обработчики ставит ``UploadHandlersMixin``.
+"""
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, TemporaryFileUploadHandler
+from rest_framework.response import Response
+
+from .storage import ContentAddressedStorage
+
+
+class UploadTooLarge(RequestDataTooBig):
+    """
+    Загружаемый файл больше лимита представления; viewset отвечает 413.
+    """
+
+
+class LimitedUploadHandler(FileUploadHandler):
+    """
+    Базовый обработчик, который обрывает загрузку файла больше ``max_size`` байт.
+    """
+
+    def __init__(self, request=None, max_size: int = None):
+        super().__init__(request)
+        self.max_size = max_size
+
+    def check_size(self, received: int):
+        if self.max_size is not None and received > self.max_size:
+            raise UploadTooLarge(f"{self.file_name}: upload is larger than {self.max_size} bytes")
+
+
+class LimitedTemporaryFileUploadHandler(LimitedUploadHandler, TemporaryFileUploadHandler):
+    """
+    Загрузка во временный файл с лимитом размера.
+    """
+
+    def receive_data_chunk(self, raw_data, start):
+        self.check_size(start + len(raw_data))
+        return super().receive_data_chunk(raw_data, start)
+
+
+class HashedUploadedFile(UploadedFile):
+    """
+    Загрузка во временном файле хранилища с уже посчитанным хэшем содержимого.
+    """
+
+    def __init__(self, file, name, content_type, size, charset, content_type_extra, hash_algorithm, content_hash):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.hash_algorithm = hash_algorithm
+        self.content_hash = content_hash
+
+    def temporary_file_path(self) -> str:
+        return self.file.name
+
+    def close(self):
+        try:
+            return self.file.close()
+        except FileNotFoundError:
+            # файл уже перенесён в хранилище
+            pass
+
+
+class HashingUploadHandler(LimitedUploadHandler):
+
+    def __init__(self, request=None, max_size: int = None, storage=None):
+        super().__init__(request, max_size)
+        self.storage = storage or default_storage
+        self.file = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        directory = settings.FILE_UPLOAD_TEMP_DIR
+        if isinstance(self.storage, ContentAddressedStorage):
+            directory = self.storage.incoming_directory()
+        self.file = tempfile.NamedTemporaryFile(suffix=".upload", dir=directory)
+        self.digest = hashlib.new(getattr(self.storage, "algorithm", "sha256"))
+
+    def receive_data_chunk(self, raw_data, start):
+        self.check_size(start + len(raw_data))
+        self.digest.update(raw_data)
+        self.file.write(raw_data)
+        # кусок обработан, следующим обработчикам его не передаём
+
+    def file_complete(self, file_size):
+        self.file.flush()
+        self.file.seek(0)
+        return HashedUploadedFile(
+            self.file, self.file_name, self.content_type, file_size, self.charset, self.content_type_extra,
+            hash_algorithm=self.digest.name, content_hash=self.digest.hexdigest(),
+        )
+
+    def upload_interrupted(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except FileNotFoundError:
+                pass
+
+
+class UploadHandlersMixin:
+    """
+    Для viewset: свои обработчики загрузки на действие.
+
+    ``get_upload_handlers`` возвращает список обработчиков или None (обработчики
+    из настроек). Ставятся они до того, как тело запроса начнёт читаться, а
+    читать его может уже проверка CSRF при входе по сессии - до проверки прав.
+    Поэтому у них не должно быть последствий, кроме временных файлов.
+
+    ``get_deferred_upload_handlers`` - обработчики, которые что-то делают с
+    данными (например, импортируют строки). Они ставятся в ``initial`` после
+    аутентификации, прав и лимитов запросов и только если тело ещё не прочитано;
+    иначе загрузка остаётся такой, какой её приняли обработчики первого вида.
+    """
+
+    def get_upload_handlers(self, request):
+        return None
+
+    def get_deferred_upload_handlers(self, request):
+        return None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        handlers = self.get_deferred_upload_handlers(request)
+        if handlers is not None:
+            try:
+                request._request.upload_handlers = handlers
+            except AttributeError:
+                # тело уже разобрано при проверке CSRF
+                pass
+
+    def initialize_request(self, request, *args, **kwargs):
+        drf_request = super().initialize_request(request, *args, **kwargs)
+        # self.action уже известен: его выставляет ViewSetMixin.initialize_request
+        handlers = self.get_upload_handlers(request)
+        if handlers is not None:
+            request.upload_handlers = handlers
+        return drf_request
+
+    def handle_exception(self, exc):
+        if isinstance(exc, UploadTooLarge):
+            return Response({"detail": str(exc)}, status=413)
+        return super().handle_exception(exc)
@@ -0,0 +1,9 @@
+from django.urls import path
+
+from .views import serve_media
+
+app_name = "mediastore"
+
+urlpatterns = [
+    path("<path:name>", serve_media, name="serve"),
+]
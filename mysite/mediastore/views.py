@@ -0,0 +1,132 @@
+"""
+Отдача файлов MEDIA_ROOT в продакшене (вместо ``static()``, который
+работает только при DEBUG).
+
+Закрытые поля перечислены в ``settings.MEDIASTORE_PROTECTED_FIELDS``:
+``{"app.Model.field": {"owner": <поле-владелец>, "permission": <право>}}``.
+Файл, на который ссылается строка закрытого поля, получает владелец
+строки или пользователь с правом; остальным он не виден (404), если только
+тот же файл (хранилище дедуплицирует по содержимому) не используется и в
+открытом поле. Сам файл уходит через ``shopapp.downloads`` - с Range,
+ETag и передачей фронтовому серверу.
+
+По умолчанию доступ закрыт: отдаётся только файл, на который ссылается
+строка (открытого или доступного закрытого поля), и производный файл
+(вариант картинки) такого файла. Каталог ``upload_to`` закрытого поля
+(``exports/``, ``orders/receipts/``) закрыт и без строки - файл, который
+ещё пишется или уже осиротел, получает только суперпользователь или
+обладатель права. Недописанные ``.part`` не отдаются никому.
+"""
+import mimetypes
+import os
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpRequest, HttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import quote_etag
+
+from shopapp.downloads import ranged_file_response
+
+from .collector import media_fields, source_stem
+from .storage import is_blob
+
+# имя в blobs/ - хэш содержимого: файл по этому адресу никогда не меняется
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+MUTABLE_MAX_AGE = 60 * 60
+
+# файлы, которые ещё пишутся (shopapp.jobs)
+PARTIAL_SUFFIX = ".part"
+
+
+def protected_fields() -> list:
+    """
+    (поле, имя поля владельца, право) для закрытых полей из настроек.
+    """
+    result = []
+    for label, rule in getattr(settings, "MEDIASTORE_PROTECTED_FIELDS", {}).items():
+        model_label, field_name = label.rsplit(".", 1)
+        field = apps.get_model(model_label)._meta.get_field(field_name)
+        result.append((field, rule.get("owner"), rule.get("permission")))
+    return result
+
+
+def protected_prefix(field) -> str:
+    # upload_to-функция каталога не задаёт, закрыт только строковый
+    return field.upload_to if isinstance(field.upload_to, str) and field.upload_to else ""
+
+
+def referencing_rows(field, name: str):
+    """
+    Строки поля, ссылающиеся на файл, а для производного файла - на его исходник.
+    """
+    stem = source_stem(name)
+    if stem is not None:
+        return field.model._default_manager.filter(**{f"{field.attname}__startswith": f"{stem}."})
+    return field.model._default_manager.filter(**{field.attname: name})
+
+
+def is_public(name: str, protected: list) -> bool:
+    protected = {field for field, owner, permission in protected}
+    return any(
+        referencing_rows(field, name).exists()
+        for field in media_fields()
+        if field not in protected
+    )
+
+
+def check_access(user, name: str) -> bool:
+    """
+    True - файл открытый, False - закрытый и доступен пользователю; Http404 - недоступен или ничей.
+    """
+    protected = protected_fields()
+    for field, owner, permission in protected:
+        privileged = user.is_superuser or bool(permission and user.has_perm(permission))
+        # по индексу столбца: одна выборка на закрытое поле
+        rows = referencing_rows(field, name)
+        if rows.exists():
+            if privileged:
+                return False
+            if owner and user.is_authenticated and rows.filter(**{owner: user}).exists():
+                return False
+            # чужой закрытый файл виден, только если тот же файл лежит и в открытом поле
+        elif protected_prefix(field) and name.startswith(protected_prefix(field)):
+            # в закрытом каталоге без строки: выгрузка ещё пишется или её задача удалена
+            if privileged:
+                return False
+            raise Http404("No such file")
+    if not is_public(name, protected):
+        # ничей файл (сирота до сборки мусора, чужая копия) не отдаём никому
+        raise Http404("No such file")
+    return True
+
+
+def serve_media(request: HttpRequest, name: str) -> HttpResponse:
+    # служебные каталоги (.incoming) и недописанные файлы не отдаём
+    if any(part.startswith(".") for part in name.split("/")) or name.endswith(PARTIAL_SUFFIX):
+        raise Http404("No such file")
+    try:
+        path = default_storage.path(name)
+    except SuspiciousFileOperation:
+        raise Http404("No such file")
+    if not os.path.isfile(path):
+        raise Http404("No such file")
+
+    public = check_access(request.user, name)
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    etag = None
+    if is_blob(name):
+        # имя и есть хэш содержимого - самый строгий ETag
+        etag = quote_etag(os.path.splitext(os.path.basename(name))[0])
+    response = ranged_file_response(
+        request, path, content_type, filename=os.path.basename(name), as_attachment=False, etag=etag,
+    )
+    if not public:
+        patch_cache_control(response, private=True, no_cache=True)
+    elif etag is not None:
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=MUTABLE_MAX_AGE)
+    return response
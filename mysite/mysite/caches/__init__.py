@@ -0,0 +1,5 @@
+"""
+Собственные бэкенды кэша проекта.
+
+Подключаются через CACHES в settings.py.
+"""
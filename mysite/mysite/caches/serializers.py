@@ -0,0 +1,76 @@
+"""
+Сериализаторы значений для бэкендов кэша из ``mysite.caches``.
+
+Выбираются для каждого алиаса через ``OPTIONS["SERIALIZER"]`` (путь до
+класса), параметры берутся из тех же OPTIONS.
+
+``CompactSerializer`` рассчитан на самые крупные наши записи - выгрузки
+(готовые строки JSON) и закэшированные страницы (HttpResponse):
+
+* результат pickle сжимается zlib, если он больше ``COMPRESS_MIN_SIZE``;
+* в начале записи заголовок с версией формата. Запись другой версии или
+  другого сериализатора читается как промах, а не как мусор, так что
+  формат можно менять без очистки кэша.
+"""
+import pickle
+import zlib
+
+MAGIC = b"\xcaC"
+# 2: без раскладки списков словарей по столбцам, записи версии 1 - промахи
+FORMAT_VERSION = 2
+
+FLAG_COMPRESSED = 0x01
+
+
+class SerializationError(ValueError):
+    """
+    Запись не читается этим сериализатором; бэкенд считает её промахом.
+    """
+
+
+class PickleSerializer:
+    protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, options: dict = None):
+        self.options = options or {}
+
+    def dumps(self, value) -> bytes:
+        return pickle.dumps(value, self.protocol)
+
+    def loads(self, data: bytes):
+        try:
+            return pickle.loads(data)
+        except Exception as exc:
+            raise SerializationError(str(exc)) from exc
+
+
+class CompactSerializer(PickleSerializer):
+
+    def __init__(self, options: dict = None):
+        super().__init__(options)
+        self.compress_min_size = self.options.get("COMPRESS_MIN_SIZE", 1024)
+        self.compress_level = self.options.get("COMPRESS_LEVEL", 6)
+
+    def dumps(self, value) -> bytes:
+        payload = pickle.dumps(value, self.protocol)
+        flags = 0
+        if len(payload) >= self.compress_min_size:
+            compressed = zlib.compress(payload, self.compress_level)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= FLAG_COMPRESSED
+        return MAGIC + bytes([FORMAT_VERSION, flags]) + payload
+
+    def loads(self, data: bytes):
+        if data[:len(MAGIC)] != MAGIC or len(data) < len(MAGIC) + 2:
+            raise SerializationError("Not a compact cache entry")
+        version, flags = data[len(MAGIC)], data[len(MAGIC) + 1]
+        if version != FORMAT_VERSION:
+            raise SerializationError(f"Cache entry format {version}, expected {FORMAT_VERSION}")
+        payload = data[len(MAGIC) + 2:]
+        try:
+            if flags & FLAG_COMPRESSED:
+                payload = zlib.decompress(payload)
+            return pickle.loads(payload)
+        except Exception as exc:
+            raise SerializationError(str(exc)) from exc
@@ -0,0 +1,372 @@
+"""
+Дисковый кэш на SQLite вместо FileBasedCache.
+
+Все записи лежат в одной таблице с индексами по сроку жизни и по времени
+(или частоте) обращений, а число записей и их суммарный размер ведут
+триггеры в отдельной строке. Поэтому проверка лимитов стоит O(1), а
+вытеснение удаляет ровно самые старые по LRU/LFU записи через индекс,
+без обхода каталога, как в FileBasedCache.
+
+``get_many``/``set_many``/``delete_many`` выполняются одной транзакцией,
+``add`` и ``incr`` атомарны и между процессами. Журнал - WAL, так что
+чтения не блокируются записью.
+
+Чтение - обычный SELECT, блокировку записи оно не берёт. Время и число
+обращений копятся в памяти и пишутся отложенно: в транзакции ближайшей
+записи (до вытеснения, так что LRU/LFU видит свежие данные) или отдельным
+UPDATE раз в ``ACCESS_FLUSH_INTERVAL`` секунд, который при занятой базе
+просто отбрасывается. Ошибка SQLite при чтении (база занята, повреждена) -
+промах, а не 500.
+
+Параметры (OPTIONS):
+
+* ``MAX_ENTRIES`` - лимит числа записей (как у встроенных бэкендов);
+* ``MAX_SIZE`` - лимит суммарного размера значений в байтах, None - без лимита;
+* ``EVICTION`` - ``"lru"`` (по умолчанию) или ``"lfu"``;
+* ``SWEEP_INTERVAL`` - как часто, в секундах, удалять просроченные записи при записи;
+* ``ACCESS_FLUSH_INTERVAL`` - как часто, в секундах, записывать накопленные обращения без чужой записи;
+* ``SERIALIZER`` - класс из ``mysite.caches.serializers`` (по умолчанию обычный pickle).
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.module_loading import import_string
+
+from .serializers import SerializationError
+
+EVICTION_ORDER = {
+    "lru": "accessed",
+    "lfu": "hits, accessed",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entry (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_entry_expires ON cache_entry (expires) WHERE expires IS NOT NULL;
+CREATE TABLE IF NOT EXISTS cache_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    entries INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO cache_stats (id, entries, bytes) VALUES (1, 0, 0);
+CREATE TRIGGER IF NOT EXISTS cache_entry_inserted AFTER INSERT ON cache_entry BEGIN
+    UPDATE cache_stats SET entries = entries + 1, bytes = bytes + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entry_deleted AFTER DELETE ON cache_entry BEGIN
+    UPDATE cache_stats SET entries = entries - 1, bytes = bytes - old.size;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entry_resized AFTER UPDATE OF size ON cache_entry BEGIN
+    UPDATE cache_stats SET bytes = bytes - old.size + new.size;
+END;
+"""
+
+UPSERT = """
+INSERT INTO cache_entry (key, value, expires, size, accessed) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET
+    value = excluded.value, expires = excluded.expires, size = excluded.size,
+    accessed = excluded.accessed, hits = 0
+"""
+
+# вставка, которая перезаписывает только просроченную запись
+ADD = UPSERT + " WHERE cache_entry.expires IS NOT NULL AND cache_entry.expires <= ?"
+
+NOT_EXPIRED = "(expires IS NULL OR expires > ?)"
+
+# SQLite держит не больше 32766 параметров в запросе, берём с запасом
+MAX_QUERY_KEYS = 900
+
+RECORD_ACCESS = "UPDATE cache_entry SET accessed = max(accessed, ?), hits = hits + ? WHERE key = ?"
+
+# сколько ждать блокировку ради записи обращений, мс: статистика не стоит ожидания
+ACCESS_BUSY_TIMEOUT = 50
+BUSY_TIMEOUT = 5
+
+# больше ключей в буфере обращений не копим, пишем сразу
+MAX_PENDING_ACCESSES = 1000
+
+log = logging.getLogger(__name__)
+
+_initialized = set()
+_initialized_lock = threading.Lock()
+
+
+class SQLiteCache(BaseCache):
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.path = os.path.abspath(location)
+        self.max_size = options.get("MAX_SIZE")
+        eviction = options.get("EVICTION", "lru")
+        if eviction not in EVICTION_ORDER:
+            raise ValueError(f"EVICTION must be one of {', '.join(EVICTION_ORDER)}")
+        self.eviction_order = EVICTION_ORDER[eviction]
+        self.sweep_interval = options.get("SWEEP_INTERVAL", 60)
+        self.serializer = import_string(options.get("SERIALIZER", "mysite.caches.serializers.PickleSerializer"))(options)
+        self.access_flush_interval = options.get("ACCESS_FLUSH_INTERVAL", 1)
+        self.last_sweep = 0
+        # ключ -> [время последнего обращения, число обращений], ещё не записанные в базу
+        self.pending_accesses = {}
+        self.last_access_flush = time.time()
+        self._connection = None
+
+    # --- соединение ------------------------------------------------------------------------------------------------
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # экземпляр бэкенда у каждого потока свой, значит и соединение
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            with _initialized_lock:
+                if self.path not in _initialized:
+                    connection.executescript(SCHEMA)
+                    connection.execute(
+                        f"CREATE INDEX IF NOT EXISTS cache_entry_{self.eviction_order.replace(', ', '_')} "
+                        f"ON cache_entry ({self.eviction_order})"
+                    )
+                    _initialized.add(self.path)
+            self._connection = connection
+        return self._connection
+
+    def write(self):
+        """
+        Транзакция на запись: BEGIN IMMEDIATE сразу берёт блокировку, чтобы чтение-изменение были атомарны.
+        """
+        return WriteTransaction(self.connection)
+
+    # --- сериализация ----------------------------------------------------------------------------------------------
+
+    def dumps(self, value) -> bytes:
+        return self.serializer.dumps(value)
+
+    def loads(self, data: bytes, default=None):
+        # запись чужого формата или версии - промах, а не ошибка
+        try:
+            return self.serializer.loads(data)
+        except SerializationError:
+            return default
+
+    # --- чтение ----------------------------------------------------------------------------------------------------
+
+    def select(self, keys: list, now: float) -> list:
+        """
+        (key, value) живых записей из keys: только SELECT, ошибка SQLite - пустой результат (промах).
+        """
+        rows = []
+        try:
+            for batch in batched(keys, MAX_QUERY_KEYS):
+                rows.extend(self.connection.execute(
+                    f"SELECT key, value FROM cache_entry WHERE key IN ({', '.join('?' * len(batch))}) AND {NOT_EXPIRED}",
+                    (*batch, now),
+                ).fetchall())
+        except sqlite3.OperationalError:
+            log.warning("Cache read from %s failed, treating as a miss", self.path, exc_info=True)
+            return []
+        self.record_access([key for key, value in rows], now)
+        return rows
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        rows = self.select([key], time.time())
+        if not rows:
+            return default
+        return self.loads(rows[0][1], default)
+
+    def get_many(self, keys, version=None):
+        keys = {self.make_and_validate_key(key, version=version): key for key in keys}
+        _missing = object()
+        values = {keys[cache_key]: self.loads(value, _missing) for cache_key, value in self.select(list(keys), time.time())}
+        return {key: value for key, value in values.items() if value is not _missing}
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        try:
+            row = self.connection.execute(
+                f"SELECT 1 FROM cache_entry WHERE key = ? AND {NOT_EXPIRED}",
+                (key, time.time()),
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return False
+        return row is not None
+
+    # --- учёт обращений --------------------------------------------------------------------------------------------
+
+    def record_access(self, keys: list, now: float):
+        for key in keys:
+            access = self.pending_accesses.setdefault(key, [now, 0])
+            access[0] = now
+            access[1] += 1
+        if self.pending_accesses and (
+            len(self.pending_accesses) >= MAX_PENDING_ACCESSES
+            or now - self.last_access_flush >= self.access_flush_interval
+        ):
+            self.flush_accesses()
+
+    def write_accesses(self, connection: sqlite3.Connection):
+        """
+        Записывает накопленные обращения в уже открытой транзакции на запись.
+        """
+        accesses, self.pending_accesses = self.pending_accesses, {}
+        self.last_access_flush = time.time()
+        if accesses:
+            connection.executemany(
+                RECORD_ACCESS, [(accessed, hits, key) for key, (accessed, hits) in accesses.items()],
+            )
+
+    def flush_accesses(self):
+        """
+        Отдельная запись обращений: если база занята дольше ACCESS_BUSY_TIMEOUT, обращения теряются.
+        """
+        connection = self.connection
+        try:
+            connection.execute(f"PRAGMA busy_timeout = {ACCESS_BUSY_TIMEOUT}")
+            try:
+                with self.write() as connection:
+                    self.write_accesses(connection)
+            finally:
+                connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+        except sqlite3.OperationalError:
+            # LRU/LFU немного огрубеет, чтение от этого не страдает
+            self.pending_accesses = {}
+            self.last_access_flush = time.time()
+
+    # --- запись ----------------------------------------------------------------------------------------------------
+
+    def row(self, key, value, timeout, now):
+        data = self.dumps(value)
+        return key, data, self.get_backend_timeout(timeout), len(data), now
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        now = time.time()
+        rows = [self.row(self.make_and_validate_key(key, version=version), value, timeout, now) for key, value in data.items()]
+        with self.write() as connection:
+            connection.executemany(UPSERT, rows)
+            self.write_accesses(connection)
+            self.cull(connection, now)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        now = time.time()
+        row = self.row(self.make_and_validate_key(key, version=version), value, timeout, now)
+        with self.write() as connection:
+            added = connection.execute(ADD, (*row, now)).rowcount == 1
+            if added:
+                self.write_accesses(connection)
+                self.cull(connection, now)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        cursor = self.connection.execute(
+            f"UPDATE cache_entry SET expires = ? WHERE key = ? AND {NOT_EXPIRED}",
+            (self.get_backend_timeout(timeout), key, now),
+        )
+        return cursor.rowcount == 1
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        with self.write() as connection:
+            row = connection.execute(
+                f"SELECT value FROM cache_entry WHERE key = ? AND {NOT_EXPIRED}",
+                (key, now),
+            ).fetchone()
+            value = None if row is None else self.loads(row[0])
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            value += delta
+            data = self.dumps(value)
+            connection.execute(
+                "UPDATE cache_entry SET value = ?, size = ?, accessed = ? WHERE key = ?",
+                (data, len(data), now, key),
+            )
+        return value
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self.connection.execute("DELETE FROM cache_entry WHERE key = ?", (key,)).rowcount == 1
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        with self.write() as connection:
+            for batch in batched(keys, MAX_QUERY_KEYS):
+                connection.execute(f"DELETE FROM cache_entry WHERE key IN ({', '.join('?' * len(batch))})", batch)
+
+    def clear(self):
+        self.connection.execute("DELETE FROM cache_entry")
+
+    # --- вытеснение ------------------------------------------------------------------------------------------------
+
+    def sweep(self, connection=None, now=None) -> int:
+        """
+        Удаляет просроченные записи; идёт по индексу, поэтому стоит столько, сколько их удалено.
+        """
+        connection = connection or self.connection
+        self.last_sweep = now or time.time()
+        return connection.execute("DELETE FROM cache_entry WHERE expires <= ?", (self.last_sweep,)).rowcount
+
+    def cull(self, connection, now):
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep(connection, now)
+        entries, size = connection.execute("SELECT entries, bytes FROM cache_stats").fetchone()
+        if entries <= self._max_entries and (self.max_size is None or size <= self.max_size):
+            return
+        # сначала то, что и так просрочено, потом самое давнее (или редкое) по индексу
+        self.sweep(connection, now)
+        evict_order = f"SELECT key FROM cache_entry ORDER BY {self.eviction_order} LIMIT ?"
+        entries, size = connection.execute("SELECT entries, bytes FROM cache_stats").fetchone()
+        if entries > self._max_entries:
+            connection.execute(f"DELETE FROM cache_entry WHERE key IN ({evict_order})", (entries - self._max_entries,))
+        if self.max_size is None:
+            return
+        overflow = connection.execute("SELECT bytes FROM cache_stats").fetchone()[0] - self.max_size
+        if overflow <= 0:
+            return
+        # курсор идёт по индексу, читаем ровно столько записей, сколько нужно освободить
+        victims = []
+        cursor = connection.execute(f"SELECT key, size FROM cache_entry ORDER BY {self.eviction_order}")
+        for key, entry_size in cursor:
+            victims.append(key)
+            overflow -= entry_size
+            if overflow <= 0:
+                break
+        cursor.close()
+        for batch in batched(victims, MAX_QUERY_KEYS):
+            connection.execute(f"DELETE FROM cache_entry WHERE key IN ({', '.join('?' * len(batch))})", batch)
+
+
+class WriteTransaction:
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def batched(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
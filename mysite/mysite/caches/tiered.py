@@ -0,0 +1,268 @@
+"""
+Двухуровневый кэш: LRU в памяти процесса (L1) перед общим хранилищем (L2).
+
+L2 - любой другой алиас из CACHES (по умолчанию ``shared``), в нём лежат
+значения вместе с "мягким" сроком жизни. L1 хранит копию недолго
+(``L1_TIMEOUT``), поэтому запись из другого процесса становится видна не
+позже чем через столько секунд; свои записи и удаления видны сразу.
+
+Защита от лавины пересчётов:
+
+* stale-while-revalidate: после мягкого срока запись ещё ``STALE_TIMEOUT``
+  секунд живёт в L2. Первый читатель получает промах и пересчитывает
+  значение, остальные в это время получают старое;
+* single-flight: ``get_or_set`` и ``single_flight`` дают пересчитать пустой
+  ключ одному процессу, остальные ждут результата.
+
+Блокировки берутся через ``add`` в L2, поэтому атомарны ровно настолько,
+насколько атомарен ``add`` общего хранилища.
+"""
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# L1 общий для всех потоков процесса, как у LocMemCache: экземпляры бэкенда у каждого потока свои
+_stores = {}
+_stores_lock = threading.Lock()
+
+_MISSING = object()
+
+
+class LRUStore:
+    """
+    Потокобезопасный LRU: ключ -> (срок в L1, мягкий срок, pickle значения).
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, expires_at: float, soft_expires_at: Optional[float], pickled: bytes):
+        with self.lock:
+            self.entries[key] = (expires_at, soft_expires_at, pickled)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class TieredCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.l2_alias = location or "shared"
+        self.l1_timeout = options.get("L1_TIMEOUT", 5)
+        self.stale_timeout = options.get("STALE_TIMEOUT", 60)
+        self.lock_timeout = options.get("LOCK_TIMEOUT", 30)
+        self.lock_poll_interval = options.get("LOCK_POLL_INTERVAL", 0.05)
+        with _stores_lock:
+            self.l1 = _stores.setdefault(self.l2_alias, LRUStore(options.get("L1_MAX_ENTRIES", 1000)))
+
+    @property
+    def l2(self) -> BaseCache:
+        return caches[self.l2_alias]
+
+    # --- сроки -----------------------------------------------------------------------------------------------------
+
+    def l2_timeout(self, soft_expires_at: Optional[float]) -> Optional[float]:
+        if soft_expires_at is None:
+            return None
+        return max(0, soft_expires_at - time.time()) + self.stale_timeout
+
+    def remember(self, key: str, soft_expires_at: Optional[float], pickled: bytes):
+        expires_at = time.time() + self.l1_timeout
+        if soft_expires_at is not None:
+            expires_at = min(expires_at, soft_expires_at + self.stale_timeout)
+        self.l1.set(key, expires_at, soft_expires_at, pickled)
+
+    @staticmethod
+    def is_stale(soft_expires_at: Optional[float]) -> bool:
+        return soft_expires_at is not None and soft_expires_at <= time.time()
+
+    # --- чтение ----------------------------------------------------------------------------------------------------
+
+    def lookup(self, key, version):
+        """
+        (мягкий срок, значение) из L1 или L2, либо None.
+        """
+        cache_key = self.make_and_validate_key(key, version=version)
+        entry = self.l1.get(cache_key)
+        if entry is not None:
+            return entry[1], pickle.loads(entry[2])
+        envelope = self.l2.get(key, _MISSING, version=version)
+        if envelope is _MISSING:
+            return None
+        soft_expires_at, value = envelope
+        self.remember(cache_key, soft_expires_at, pickle.dumps(value, self.pickle_protocol))
+        return soft_expires_at, value
+
+    def get(self, key, default=None, version=None):
+        found = self.lookup(key, version)
+        if found is None:
+            return default
+        soft_expires_at, value = found
+        if self.is_stale(soft_expires_at) and self.acquire(f"{key}:refresh", version) is not None:
+            # этот читатель пересчитает значение, остальные пока получат старое
+            return default
+        return value
+
+    def get_many(self, keys, version=None):
+        # без stale-while-revalidate: get_many читает версии тегов и прочие значения без срока
+        result = {}
+        missing = []
+        for key in keys:
+            entry = self.l1.get(self.make_and_validate_key(key, version=version))
+            if entry is None:
+                missing.append(key)
+            elif not self.is_stale(entry[1]):
+                result[key] = pickle.loads(entry[2])
+        for key, (soft_expires_at, value) in self.l2.get_many(missing, version=version).items():
+            self.remember(
+                self.make_and_validate_key(key, version=version),
+                soft_expires_at,
+                pickle.dumps(value, self.pickle_protocol),
+            )
+            if not self.is_stale(soft_expires_at):
+                result[key] = value
+        return result
+
+    def has_key(self, key, version=None):
+        found = self.lookup(key, version)
+        return found is not None and not self.is_stale(found[0])
+
+    # --- запись ----------------------------------------------------------------------------------------------------
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        cache_key = self.make_and_validate_key(key, version=version)
+        soft_expires_at = self.get_backend_timeout(timeout)
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        self.l2.set(key, (soft_expires_at, value), self.l2_timeout(soft_expires_at), version=version)
+        self.remember(cache_key, soft_expires_at, pickled)
+        # значение пересчитано: ждущие могут его забирать
+        self.l2.delete_many([f"{key}:refresh", f"{key}:flight"], version=version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        soft_expires_at = self.get_backend_timeout(timeout)
+        added = self.l2.add(key, (soft_expires_at, value), self.l2_timeout(soft_expires_at), version=version)
+        if added:
+            self.remember(
+                self.make_and_validate_key(key, version=version),
+                soft_expires_at,
+                pickle.dumps(value, self.pickle_protocol),
+            )
+        return added
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        soft_expires_at = self.get_backend_timeout(timeout)
+        failed = self.l2.set_many(
+            {key: (soft_expires_at, value) for key, value in data.items()},
+            self.l2_timeout(soft_expires_at),
+            version=version,
+        )
+        for key, value in data.items():
+            if key not in failed:
+                self.remember(
+                    self.make_and_validate_key(key, version=version),
+                    soft_expires_at,
+                    pickle.dumps(value, self.pickle_protocol),
+                )
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        found = self.lookup(key, version)
+        if found is None:
+            return False
+        self.set(key, found[1], timeout, version=version)
+        return True
+
+    def delete(self, key, version=None):
+        self.l1.delete(self.make_and_validate_key(key, version=version))
+        return self.l2.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self.l1.delete(self.make_and_validate_key(key, version=version))
+        self.l2.delete_many(keys, version=version)
+
+    def clear(self):
+        self.l1.clear()
+        self.l2.clear()
+
+    # --- single-flight ---------------------------------------------------------------------------------------------
+
+    def acquire(self, lock_key: str, version=None) -> Optional[Callable[[], None]]:
+        """
+        Берёт блокировку в L2; возвращает функцию, которая её снимает, или None, если блокировка занята.
+        """
+        token = uuid.uuid4().hex
+        if not self.l2.add(lock_key, token, self.lock_timeout, version=version):
+            return None
+
+        def release():
+            if self.l2.get(lock_key, version=version) == token:
+                self.l2.delete(lock_key, version=version)
+
+        return release
+
+    def single_flight(self, name: str, version=None) -> Optional[Callable[[], None]]:
+        """
+        Даёт выполнить работу ``name`` одному вызывающему за раз.
+
+        Первый получает функцию снятия блокировки и должен её вызвать, закончив
+        (set() того же ключа снимает её сам). Остальные ждут, пока блокировку
+        снимут или истечёт LOCK_TIMEOUT, и получают None: к этому времени
+        результат обычно уже в кэше.
+        """
+        lock_key = f"{name}:flight"
+        release = self.acquire(lock_key, version)
+        if release is not None:
+            return release
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline and self.l2.has_key(lock_key, version=version):
+            time.sleep(self.lock_poll_interval)
+        return None
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        value = self.get(key, _MISSING, version=version)
+        if value is not _MISSING:
+            return value
+        release = self.single_flight(key, version=version)
+        try:
+            if release is None:
+                value = self.get(key, _MISSING, version=version)
+                if value is not _MISSING:
+                    return value
+            if callable(default):
+                default = default()
+            self.set(key, default, timeout, version=version)
+            return default
+        finally:
+            if release is not None:
+                release()
@@ -92,6 +92,7 @@ INSTALLED_APPS = [
     'shopapp.apps.ShopappConfig',
     'myauth.apps.MyauthConfig',
     'myapiapp.apps.MyapiappConfig',
+    'mediastore.apps.MediastoreConfig',
 ]
 
 MIDDLEWARE = [
@@ -146,11 +147,32 @@ CACHES = {
         # отладочный вариант кэширования? без реального кэширования:
         # "BACKEND": "django.core.cache.backends.dummy.DummyCache",
 
-        # для реального кэширования эти строки раскоментить:
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
-        "LOCATION": "/var/tmp/django_cache",
-        # "LOCATION": "c:/foo/bar",    - for windows
-    }
+        # LRU в памяти процесса перед общим кэшем "shared", с защитой от лавины пересчётов
+        "BACKEND": "mysite.caches.tiered.TieredCache",
+        "LOCATION": "shared",
+        "OPTIONS": {
+            "L1_MAX_ENTRIES": 1000,
+            # запись из другого процесса видна не позже чем через столько секунд
+            "L1_TIMEOUT": 5,
+            # сколько просроченная запись ещё отдаётся, пока её пересчитывает один запрос
+            "STALE_TIMEOUT": 60,
+            "LOCK_TIMEOUT": 30,
+        },
+    },
+    "shared": {
+        # общий для всех процессов дисковый кэш с индексом и LRU-вытеснением
+        "BACKEND": "mysite.caches.sqlite.SQLiteCache",
+        "LOCATION": "/var/tmp/django_cache/cache.sqlite3",
+        # "LOCATION": "c:/foo/bar/cache.sqlite3",    - for windows
+        "OPTIONS": {
+            "MAX_ENTRIES": 100_000,
+            "MAX_SIZE": 512 * 1024 * 1024,
+            "EVICTION": "lru",
+            # pickle, сжатый zlib, если он больше COMPRESS_MIN_SIZE (1 КБ)
+            "SERIALIZER": "mysite.caches.serializers.CompactSerializer",
+            "COMPRESS_MIN_SIZE": 1024,
+        },
+    },
 }
 
 CACHE_MIDDLEWARE_SECONDS = 200
@@ -197,6 +219,31 @@ MEDIA_ROOT = BASE_DIR / 'uploads/'
 
 # if u would like to use custom interaction with file system
 # DEFAULT_FILE_STORAGE =
+# загрузки хранятся по хэшу содержимого в blobs/ab/cd/..., одинаковые файлы - один раз (см. mediastore.storage)
+STORAGES = {
+    "default": {
+        "BACKEND": "mediastore.storage.ContentAddressedStorage",
+        "OPTIONS": {
+            "shard_depth": 2,
+            "shard_width": 2,
+        },
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+}
+
+# отдача файлов (shopapp.downloads): None - сам Django через FileResponse,
+# "x-accel" - nginx (internal location SENDFILE_URL смотрит на SENDFILE_ROOT, по умолчанию MEDIA_ROOT),
+# "x-sendfile" - Apache/lighttpd
+SENDFILE_BACKEND = getenv("DJANGO_SENDFILE_BACKEND") or None
+SENDFILE_URL = "/protected-media/"
+
+# файлы этих полей получают только владелец строки и пользователи с правом (mediastore.views)
+MEDIASTORE_PROTECTED_FIELDS = {
+    "shopapp.Order.receipt": {"owner": "user", "permission": "shopapp.view_order"},
+    "shopapp.ExportJob.file": {"owner": "created_by", "permission": None},
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
@@ -1,4 +1,10 @@
+from django.db.models import Count, Max
+
+from RSS.models import Article
 from RSS.sitemap import BlogSitemap
+from shopapp.caching import model_tag, versions_fingerprint
+from shopapp.conditional import representation_etag
+from shopapp.models import Product
 from shopapp.sitemap import ShopSitemap
 
 sitemaps = {
@@ -6,3 +12,16 @@ sitemaps = {
     "shopapp-sitemap": ShopSitemap,
 
 }
+
+
+def sitemap_etag(request, *args, **kwargs) -> str:
+    # у статей блога нет версий кэша, поэтому их учитываем по числу и дате последней публикации
+    articles = Article.objects.filter(published_at__isnull=False).aggregate(
+        count=Count("pk"),
+        latest=Max("published_at"),
+    )
+    return representation_etag(
+        request,
+        versions_fingerprint([model_tag(Product)]),
+        f"{articles['count']}:{articles['latest']}",
+    )
@@ -0,0 +1,186 @@
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.test import SimpleTestCase, override_settings
+
+TIERED_CACHES = {
+    "default": {
+        "BACKEND": "mysite.caches.tiered.TieredCache",
+        "LOCATION": "tiered-shared",
+        "OPTIONS": {"STALE_TIMEOUT": 60, "LOCK_TIMEOUT": 5, "LOCK_POLL_INTERVAL": 0.01},
+    },
+    "tiered-shared": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "tiered-shared",
+    },
+}
+
+
+@override_settings(CACHES=TIERED_CACHES)
+class TieredCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = caches["default"]
+        self.cache.clear()
+
+    def test_warm_hits_are_served_from_process_memory(self):
+        self.cache.set("answer", {"value": 42})
+        caches["tiered-shared"].clear()
+        self.assertEqual(self.cache.get("answer"), {"value": 42})
+        self.assertEqual(self.cache.get_many(["answer", "other"]), {"answer": {"value": 42}})
+
+        self.cache.delete("answer")
+        self.assertIsNone(self.cache.get("answer"))
+
+    def test_stale_value_is_served_while_one_caller_refreshes(self):
+        self.cache.set("page", "old", timeout=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get("page"))
+        self.assertEqual(self.cache.get("page"), "old")
+        self.assertEqual(self.cache.get("page"), "old")
+
+        self.cache.set("page", "new")
+        self.assertEqual(self.cache.get("page"), "new")
+
+    def test_get_or_set_computes_once_under_concurrency(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return "value"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(caches["default"].get_or_set("cold", compute)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["value"] * 5)
+
+
+def sqlite_cache(**options):
+    location = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+    return {
+        "default": {
+            "BACKEND": "mysite.caches.sqlite.SQLiteCache",
+            "LOCATION": location,
+            "OPTIONS": options,
+        },
+    }
+
+
+class SQLiteCacheTestCase(SimpleTestCase):
+
+    def test_basic_operations(self):
+        with override_settings(CACHES=sqlite_cache()):
+            cache = caches["default"]
+            cache.set("a", {"x": 1})
+            self.assertEqual(cache.get("a"), {"x": 1})
+            self.assertFalse(cache.add("a", 2))
+            self.assertTrue(cache.add("b", 2))
+            self.assertEqual(cache.incr("b", 3), 5)
+            cache.set_many({"c": 3, "d": 4})
+            self.assertEqual(cache.get_many(["a", "c", "d", "missing"]), {"a": {"x": 1}, "c": 3, "d": 4})
+            cache.delete_many(["c", "d"])
+            self.assertFalse(cache.has_key("c"))
+
+            cache.set("short", 1, timeout=0.01)
+            time.sleep(0.02)
+            self.assertIsNone(cache.get("short"))
+            self.assertTrue(cache.add("short", 2))
+            self.assertEqual(cache.get("short"), 2)
+
+    def test_lru_eviction_keeps_recently_used(self):
+        with override_settings(CACHES=sqlite_cache(MAX_ENTRIES=3)):
+            cache = caches["default"]
+            for key in "abc":
+                cache.set(key, key)
+            cache.get("a")
+            cache.set("d", "d")
+            self.assertEqual(sorted(cache.get_many("abcd")), ["a", "c", "d"])
+
+    def test_reads_do_not_take_the_write_lock(self):
+        with override_settings(CACHES=sqlite_cache()):
+            cache = caches["default"]
+            cache.set("a", 1)
+            writer = sqlite3.connect(cache.path, timeout=0, isolation_level=None)
+            writer.execute("BEGIN IMMEDIATE")
+            try:
+                started = time.monotonic()
+                self.assertEqual(cache.get("a"), 1)
+                self.assertEqual(cache.get_many(["a"]), {"a": 1})
+                self.assertLess(time.monotonic() - started, 1)
+                # обращения не записаны, пока база занята, но чтение от этого не пострадало
+                cache.flush_accesses()
+            finally:
+                writer.execute("ROLLBACK")
+                writer.close()
+
+    def test_read_errors_are_misses(self):
+        with override_settings(CACHES=sqlite_cache()):
+            cache = caches["default"]
+            cache.set("a", 1)
+            broken = mock.Mock(execute=mock.Mock(side_effect=sqlite3.OperationalError("database is locked")))
+            with mock.patch.object(cache, "_connection", broken):
+                self.assertEqual(cache.get("a", "default"), "default")
+                self.assertEqual(cache.get_many(["a"]), {})
+                self.assertFalse(cache.has_key("a"))
+
+    def test_size_limit(self):
+        with override_settings(CACHES=sqlite_cache(MAX_SIZE=10_000)):
+            cache = caches["default"]
+            for i in range(20):
+                cache.set(f"blob{i}", b"x" * 1000)
+            entries, size = cache.connection.execute("SELECT entries, bytes FROM cache_stats").fetchone()
+            self.assertLessEqual(size, 10_000)
+            self.assertTrue(cache.has_key("blob19"))
+            self.assertFalse(cache.has_key("blob0"))
+
+
+class CompactSerializerTestCase(SimpleTestCase):
+
+    def test_round_trip_and_size(self):
+        from mysite.caches.serializers import CompactSerializer
+
+        serializer = CompactSerializer({})
+        # так выглядят реальные записи: выгрузка - готовая строка JSON, страница - HttpResponse
+        export = json.dumps({
+            "products": [
+                {"pk": i, "name": f"Product {i}", "price": "9.99", "archived": False}
+                for i in range(500)
+            ],
+        })
+        data = serializer.dumps(export)
+        self.assertEqual(serializer.loads(data), export)
+        self.assertLess(len(data) * 4, len(pickle.dumps(export)))
+
+        response = HttpResponse(b"<li>product</li>" * 1000)
+        self.assertEqual(serializer.loads(serializer.dumps(response)).content, response.content)
+
+        small = serializer.dumps({"x": 1})
+        self.assertEqual(serializer.loads(small), {"x": 1})
+
+    def test_foreign_entries_are_misses(self):
+        options = {"SERIALIZER": "mysite.caches.serializers.CompactSerializer"}
+        with override_settings(CACHES=sqlite_cache(**options)):
+            cache = caches["default"]
+            cache.set("export", [{"a": 1}, {"a": 2}])
+            self.assertEqual(cache.get("export"), [{"a": 1}, {"a": 2}])
+            key = cache.make_key("export")
+            cache.connection.execute("UPDATE cache_entry SET value = ? WHERE key = ?", (pickle.dumps("old"), key))
+            self.assertIsNone(cache.get("export"))
+            self.assertEqual(cache.get_many(["export"]), {})
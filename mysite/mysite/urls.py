@@ -18,11 +18,12 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.contrib.sitemaps.views import sitemap
 from django.urls import path, include
+from django.views.decorators.http import condition
 
 from shopapp.views import ShopMainView
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 
-from .sitemaps import sitemaps
+from .sitemaps import sitemaps, sitemap_etag
 
 urlpatterns = [
     path('', ShopMainView.as_view(), name='main_view'),
@@ -34,7 +35,7 @@ urlpatterns = [
     path('RSS/', include('RSS.urls')),
     path(
         'sitemap.xml',
-        sitemap,
+        condition(etag_func=sitemap_etag)(sitemap),
         {'sitemaps': sitemaps},
         name='django.contrib.sitemaps.views.sitemap',
     ),
@@ -43,15 +44,14 @@ urlpatterns = [
     path('api/schema/swagger/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger'),
     path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
     path('api/', include('myapiapp.urls')),
+    # медиафайлы отдаём всегда, с проверкой прав на чеки и с X-Accel-Redirect за nginx
+    path(settings.MEDIA_URL.lstrip('/'), include('mediastore.urls')),
 
 
 ]
 
 
 if settings.DEBUG:
-    urlpatterns.extend(
-        static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-    )
     urlpatterns.extend(
         static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
     )
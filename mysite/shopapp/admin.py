@@ -5,10 +5,12 @@ from django.http import HttpRequest, HttpResponse
 from django.shortcuts import render, redirect
 from django.urls import path
 
+from .caching import update_and_bump
 from .common import save_csv_products, save_csv_orders
 from .models import Product, Order, ProductImage
-from .admin_mixins import ExportAsCSVMixin
-from .forms import CSVImportForm
+from .signals import bump_product_customers
+from .admin_mixins import ExportAsCSVMixin, FullTextSearchMixin, ImportReportMixin
+from .forms import CSVImportForm, ProductCSVImportForm
 
 
 class OrderInline(admin.TabularInline):
@@ -21,16 +23,16 @@ class ProductInline(admin.StackedInline):
 
 @admin.action(description="Archive products")
 def mark_archived(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet):
-    queryset.update(archived=True)
+    bump_product_customers(update_and_bump(queryset, archived=True))
 
 
 @admin.action(description="Unarchive products")
 def mark_unarchived(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet):
-    queryset.update(archived=False)
+    bump_product_customers(update_and_bump(queryset, archived=False))
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin, ExportAsCSVMixin):
+class ProductAdmin(FullTextSearchMixin, admin.ModelAdmin, ExportAsCSVMixin, ImportReportMixin):
     change_list_template = "shopapp/products_changelist.html"
     actions = [
         mark_archived,
@@ -48,7 +50,7 @@ class ProductAdmin(admin.ModelAdmin, ExportAsCSVMixin):
     search_fields = "name", "description"
     fieldsets = [
         (None, {
-           "fields": ("name", "description"),
+           "fields": ("name", "sku", "description"),
         }),
         ("Price options", {
             "fields": ("price", "discount"),
@@ -71,24 +73,26 @@ class ProductAdmin(admin.ModelAdmin, ExportAsCSVMixin):
 
     def import_csv(self, request: HttpRequest) -> HttpResponse:
         if request.method == "GET":
-            form = CSVImportForm()
+            form = ProductCSVImportForm()
             context = {
                 'form': form,
             }
             return render(request, 'admin/csv_form.html', context=context)
-        form = CSVImportForm(request.POST, request.FILES)
+        form = ProductCSVImportForm(request.POST, request.FILES)
         if not form.is_valid():
             context = {
                 "form": form,
             }
             return render(request, "admin/csv_form.html", context, status=400)
 
-        save_csv_products(
+        report = save_csv_products(
             file=form.files["csv_file"].file,
             encoding=request.encoding,
+            created_by=request.user,
+            upsert_key=form.cleaned_data["upsert_key"] or None,
         )
 
-        self.message_user(request, "Data from CSV was imported")
+        self.message_import_report(request, report)
         return redirect("..")
 
    # для админки в urls прописывают вот так:
@@ -109,15 +113,18 @@ class ProductInline(admin.StackedInline):
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(FullTextSearchMixin, admin.ModelAdmin, ImportReportMixin):
     change_list_template = "shopapp/orders_changelist.html"
     inlines = [
         ProductInline,
     ]
-    list_display = "delivery_address", "promocode", "created_at", "user_verbose"
+    # товары заказа правятся строками в инлайне, с количеством и ценой
+    exclude = "products",
+    list_display = "delivery_address", "promocode", "created_at", "user_verbose", "total"
+    search_fields = "delivery_address",
 
     def get_queryset(self, request):
-        return Order.objects.select_related("user").prefetch_related("products")
+        return Order.objects.select_related("user").prefetch_related("items")
 
     def user_verbose(self, obj: Order) -> str:
         return obj.user.first_name or obj.user.username
@@ -136,12 +143,13 @@ class OrderAdmin(admin.ModelAdmin):
             }
             return render(request, "admin/csv_form.html", context, status=400)
 
-        save_csv_orders(
+        report = save_csv_orders(
             file=form.files["csv_file"].file,
             encoding=request.encoding,
+            created_by=request.user,
         )
 
-        self.message_user(request, "Data from CSV was imported")
+        self.message_import_report(request, report)
         return redirect("..")
 
     # для админки в urls прописывают вот так:
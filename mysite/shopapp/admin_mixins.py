@@ -1,9 +1,12 @@
 import csv
 
+from django.contrib import messages
 from django.db.models import QuerySet
 from django.db.models.options import Options
 from django.http import HttpRequest, HttpResponse
 
+from .search import full_text_search, supports_full_text
+
 
 class ExportAsCSVMixin:
     def export_as_csv(self, request: HttpRequest, queryset: QuerySet):
@@ -21,3 +24,26 @@ class ExportAsCSVMixin:
         return response
 
     export_as_csv.short_description = "Export as CSV"
+
+
+class ImportReportMixin:
+    def message_import_report(self, request: HttpRequest, report):
+        if not report.failed:
+            self.message_user(request, f"Data from CSV was imported ({report})")
+            return
+        self.message_user(request, f"Data from CSV was imported with errors ({report})", level=messages.WARNING)
+        for error in report.errors:
+            self.message_user(request, f"Line {error['line']}: {error['error']}", level=messages.WARNING)
+
+
+class FullTextSearchMixin:
+    """
+    Поиск в списке объектов через индекс FTS5 вместо LIKE по search_fields.
+
+    Должен стоять в базовых классах раньше admin.ModelAdmin.
+    """
+    def get_search_results(self, request: HttpRequest, queryset: QuerySet, search_term: str):
+        if not supports_full_text(queryset):
+            return super().get_search_results(request, queryset, search_term)
+        # сортировку задаёт сам changelist, ранжировать здесь незачем
+        return full_text_search(queryset, search_term, rank=False), False
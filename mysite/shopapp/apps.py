@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def ensure_search_indexes(sender, using, **kwargs):
+    from .search import ensure_search_indexes
+    ensure_search_indexes(using)
 
 
 class ShopappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shopapp'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        # SQLite при ALTER пересоздаёт таблицы и теряет триггеры полнотекстового индекса
+        post_migrate.connect(ensure_search_indexes, sender=self)
@@ -0,0 +1,159 @@
+"""
+Версионирование кэша по тегам.
+
+Каждая закэшированная страница, фрагмент шаблона или выгрузка объявляет
+теги, от которых зависит: модель целиком (``shopapp.product``) или
+конкретная строка (``shopapp.product:5``). Текущие версии тегов входят
+в ключ кэша, поэтому после изменения данных достаточно сменить версию
+тега (``bump``) - старые записи просто перестают читаться и вытесняются
+сами. Благодаря этому TTL можно держать большими.
+
+Версии меняются сигналами (см. ``shopapp.signals``), а массовые операции
+вроде ``queryset.update()`` должны идти через ``update_and_bump``.
+"""
+import time
+from functools import wraps
+from typing import Callable, Iterable, Union
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.db import transaction
+from django.db.models import Model, QuerySet
+from django.utils import timezone
+from django.utils.cache import get_cache_key
+from django.views.decorators.cache import cache_page
+
+TAG_VERSION_PREFIX = "cache_tag"
+
+Tags = Union[Iterable[str], Callable[..., Iterable[str]]]
+
+
+def model_tag(model) -> str:
+    return model._meta.label_lower
+
+
+def instance_tag(instance: Model) -> str:
+    return row_tag(type(instance), instance.pk)
+
+
+def row_tag(model, pk) -> str:
+    return f"{model_tag(model)}:{pk}"
+
+
+def user_orders_tag(user_id) -> str:
+    return f"shopapp.user_orders:{user_id}"
+
+
+def tag_version_key(tag: str) -> str:
+    return f"{TAG_VERSION_PREFIX}:{tag}"
+
+
+def new_version() -> str:
+    # версия должна лишь отличаться от прежней; время, а не счётчик, чтобы после
+    # вытеснения ключа версии не вернуться к старому значению и не ожить устаревшим записям
+    return format(time.time_ns(), "x")
+
+
+def get_versions(tags: Iterable[str]) -> dict:
+    keys = {tag_version_key(tag): tag for tag in tags}
+    versions = cache.get_many(keys)
+    missing = {key: new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    return {tag: versions[key] for key, tag in keys.items()}
+
+
+def versions_fingerprint(tags: Iterable[str]) -> str:
+    versions = get_versions(tags)
+    return ".".join(versions[tag] for tag in sorted(versions))
+
+
+def tagged_key(base: str, tags: Iterable[str]) -> str:
+    return f"{base}:{versions_fingerprint(tags)}"
+
+
+def set_new_versions(tags: Iterable[str]):
+    version = new_version()
+    cache.set_many({tag_version_key(tag): version for tag in tags}, timeout=None)
+
+
+def bump(*tags: str):
+    """
+    Меняет версии тегов сразу и ещё раз после коммита транзакции.
+
+    Без второй смены параллельный запрос мог бы между первой сменой и коммитом
+    закэшировать старые данные уже под новой версией.
+    """
+    if not tags:
+        return
+    set_new_versions(tags)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: set_new_versions(tags))
+
+
+def bump_user_orders(user_ids: Iterable):
+    bump(*(user_orders_tag(user_id) for user_id in set(user_ids)))
+
+
+def bump_rows(model, pks: Iterable):
+    bump(model_tag(model), *(row_tag(model, pk) for pk in pks))
+
+
+def update_and_bump(queryset: QuerySet, **values) -> list:
+    """
+    queryset.update(), который ещё и сбрасывает кэш модели и всех затронутых строк.
+
+    Возвращает pk обновлённых строк.
+    """
+    pks = list(queryset.values_list("pk", flat=True))
+    if any(field.name == "updated_at" for field in queryset.model._meta.concrete_fields):
+        # auto_now при update() не срабатывает
+        values.setdefault("updated_at", timezone.now())
+    queryset.model.objects.filter(pk__in=pks).update(**values)
+    bump_rows(queryset.model, pks)
+    return pks
+
+
+def resolve_tags(tags: Tags, *args, **kwargs) -> list:
+    if callable(tags):
+        return list(tags(*args, **kwargs))
+    return list(tags)
+
+
+def cache_page_tagged(timeout: int, tags: Tags, cache_alias: str = None):
+    """
+    Как cache_page, но ключ страницы включает версии тегов.
+
+    ``tags`` - список тегов или функция от (request, *args, **kwargs), возвращающая его.
+
+    Если бэкенд умеет single_flight (см. ``mysite.caches.tiered``), страницу, которой
+    нет в кэше, строит один запрос, а одновременные с ним ждут и берут её из кэша.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            key_prefix = "tagged:" + versions_fingerprint(resolve_tags(tags, request, *args, **kwargs))
+            cached_view = cache_page(timeout, cache=cache_alias, key_prefix=key_prefix)(view_func)
+            backend = caches[cache_alias or DEFAULT_CACHE_ALIAS]
+            if not hasattr(backend, "single_flight") or request.method not in ("GET", "HEAD"):
+                return cached_view(request, *args, **kwargs)
+            page_key = get_cache_key(request, key_prefix, "GET", cache=backend)
+            if page_key is not None and backend.has_key(page_key):
+                return cached_view(request, *args, **kwargs)
+
+            release = backend.single_flight(f"{key_prefix}:{request.get_full_path()}")
+            try:
+                response = cached_view(request, *args, **kwargs)
+            except Exception:
+                if release is not None:
+                    release()
+                raise
+            if release is not None:
+                if getattr(response, "is_rendered", True):
+                    release()
+                else:
+                    # ответы DRF рендерятся и попадают в кэш уже после возврата из view
+                    response.add_post_render_callback(lambda rendered: release())
+            return response
+        return wrapper
+    return decorator
@@ -1,34 +1,471 @@
+"""
+Импорт товаров и заказов из CSV.
+
+Файл читается построчно, строки валидируются и приводятся к типам полей
+модели, а в базу пишутся пачками по ``batch_size`` штук, каждая пачка в
+своём savepoint. Пользователи и товары, на которые ссылаются строки,
+подтягиваются одним запросом на пачку. Ошибочные строки не прерывают
+импорт, а попадают в отчёт ``ImportReport``.
+
+Тело загрузки можно разбирать прямо по мере прихода: ``CSVPushReader``
+принимает байты кусками и отдаёт импортёру готовые строки (см.
+``shopapp.uploadhandlers``).
+
+Для каталога есть режим upsert: строки сопоставляются с уже существующими
+товарами по естественному ключу (``sku`` или ``name``), новые вставляются,
+изменившиеся обновляются одним bulk_update, а совпадающие пропускаются.
+"""
+import codecs
+import re
+from abc import ABC, abstractmethod
+from collections import Counter, deque
 from csv import DictReader
 from io import TextIOWrapper
+from typing import Iterable, Optional
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .caching import bump, bump_rows, bump_user_orders, model_tag
 from .models import Product, Order
+from .orders import attach_items, build_items
+from .recommendations import mark_products
+from .rollups import mark_instances
+from .signals import bump_product_customers
 
+IMPORT_BATCH_SIZE = getattr(settings, "SHOPAPP_IMPORT_BATCH_SIZE", 1000)
 
-def save_csv_products(file, encoding):
-    csv_file = TextIOWrapper(
-        file,
-        encoding=encoding,
-    )
-    reader = DictReader(csv_file)
+# сколько ошибок держать в отчёте: на битом файле из миллионов строк список не должен съесть память
+MAX_REPORTED_ERRORS = 100
+
+UPSERT_KEYS = ("sku", "name")
+UPSERT_FIELDS = ("name", "sku", "description", "price", "discount", "archived")
+
+TRUE_VALUES = {"1", "t", "true", "y", "yes", "on"}
+FALSE_VALUES = {"", "0", "f", "false", "n", "no", "off"}
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, line: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def add_counts(self, counts: dict):
+        for name, count in counts.items():
+            setattr(self, name, getattr(self, name) + count)
+
+    def as_dict(self) -> dict:
+        return {
+            "created": self.created,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
+
+    def __str__(self):
+        return (
+            f"created: {self.created}, updated: {self.updated}, "
+            f"unchanged: {self.unchanged}, failed: {self.failed}"
+        )
+
+
+class RowError(Exception):
+    pass
+
+
+def clean_field(model, name: str, value):
+    field = model._meta.get_field(name)
+    try:
+        return field.clean(value, None)
+    except ValidationError as exc:
+        raise RowError(f"{name}: {' '.join(exc.messages)}")
+
+
+def clean_decimal(model, name: str, value: Optional[str]):
+    value = (value or "0").strip().replace(" ", "").replace(",", ".")
+    return clean_field(model, name, value)
+
+
+def clean_bool(name: str, value: Optional[str]) -> bool:
+    value = (value or "").strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise RowError(f"{name}: {value!r} is not a boolean.")
+
+
+def split_refs(value: Optional[str]) -> list:
+    return [ref for ref in re.split(r"[\s,;]+", value or "") if ref]
+
+
+def resolve_users(refs: Iterable[str]) -> dict:
+    """
+    Сопоставляет ссылкам на пользователей (pk или username) их pk одним запросом.
+    """
+    refs = set(refs)
+    if not refs:
+        return {}
+    ids = {int(ref) for ref in refs if ref.isdigit()}
+    resolved = {}
+    users = User.objects.filter(Q(pk__in=ids) | Q(username__in=refs)).values_list("pk", "username")
+    for pk, username in users:
+        resolved[username] = pk
+        resolved[str(pk)] = pk
+    return resolved
+
+
+class CSVImporter(ABC):
+    """
+    Базовый импортёр: копит строки в пачку и сохраняет её по заполнении.
+
+    Строки подаются через ``feed()``, в конце нужно вызвать ``close()``,
+    который сохранит остаток и вернёт отчёт.
+    """
+    model = None
+
+    def __init__(self, batch_size: int = IMPORT_BATCH_SIZE, created_by: Optional[User] = None):
+        self.batch_size = batch_size
+        self.created_by = created_by
+        self.report = ImportReport()
+        self.batch = []
+
+    def feed(self, line: int, row: dict):
+        self.batch.append((line, row))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+        if batch:
+            self.process_batch(batch)
+
+    def close(self) -> ImportReport:
+        self.flush()
+        if self.report.created or self.report.updated:
+            # bulk_create и bulk_update сигналов не шлют
+            bump(model_tag(self.model))
+        return self.report
+
+    def build_batch(self, batch: list) -> list:
+        """
+        Пары (номер строки, объект) для строк пачки, прошедших build(); ошибки - в отчёт.
+        """
+        context = self.resolve(batch)
+        items = []
+        for line, row in batch:
+            try:
+                items.append((line, self.build(row, context)))
+            except RowError as exc:
+                self.report.add_error(line, str(exc))
+        return items
+
+    def process_batch(self, batch: list):
+        items = self.build_batch(batch)
+        if not items:
+            return
+
+        try:
+            with transaction.atomic():
+                counts = self.save([item for line, item in items])
+        except DatabaseError:
+            # пачка откатилась целиком, повторяем построчно, чтобы найти и отсечь виноватые строки
+            for line, item in items:
+                try:
+                    with transaction.atomic():
+                        counts = self.save([item])
+                except DatabaseError as exc:
+                    self.report.add_error(line, str(exc))
+                else:
+                    self.report.add_counts(counts)
+        else:
+            self.report.add_counts(counts)
 
-    products = [
-        Product(**row)
-        for row in reader
-    ]
-    Product.objects.bulk_create(products)
-    return products
+    def resolve(self, batch: list) -> dict:
+        return {}
 
+    @abstractmethod
+    def build(self, row: dict, context: dict):
+        """
+        Объект для сохранения из строки CSV; ошибка в строке - ``RowError``.
+        """
 
-def save_csv_orders(file, encoding):
+    @abstractmethod
+    def save(self, items: list) -> dict:
+        """
+        Сохраняет пачку и возвращает счётчики для отчёта, например ``{"created": 10}``.
+        """
+
+    def resolve_user(self, ref: Optional[str], context: dict, name: str) -> int:
+        ref = (ref or "").strip()
+        if not ref:
+            if self.created_by is None:
+                raise RowError(f"{name}: this field is required.")
+            return self.created_by.pk
+        try:
+            return context["users"][ref]
+        except KeyError:
+            raise RowError(f"{name}: unknown user {ref!r}.")
+
+
+class ProductCSVImporter(CSVImporter):
+    model = Product
+
+    def resolve(self, batch: list) -> dict:
+        return {
+            "users": resolve_users(
+                row["created_by"].strip() for line, row in batch if row.get("created_by")
+            ),
+        }
+
+    def build(self, row: dict, context: dict) -> Product:
+        return Product(
+            name=clean_field(Product, "name", (row.get("name") or "").strip()),
+            sku=(row.get("sku") or "").strip() or None,
+            description=row.get("description") or "",
+            price=clean_decimal(Product, "price", row.get("price")),
+            discount=clean_field(Product, "discount", (row.get("discount") or "0").strip()),
+            archived=clean_bool("archived", row.get("archived")),
+            created_by_id=self.resolve_user(row.get("created_by"), context, "created_by"),
+        )
+
+    def save(self, items: list) -> dict:
+        Product.objects.bulk_create(items)
+        return {"created": len(items)}
+
+
+class ProductCSVUpserter(ProductCSVImporter):
+    """
+    Импорт каталога в режиме insert-or-update по естественному ключу.
+
+    Если ключ не уникален (``name``), обновляются все товары с этим ключом.
+    Обновляются только поля, присутствующие в CSV.
+    """
+
+    def __init__(self, key: str = "sku", **kwargs):
+        if key not in UPSERT_KEYS:
+            raise ValueError(f"Unsupported upsert key {key!r}, expected one of {UPSERT_KEYS}")
+        super().__init__(**kwargs)
+        self.key = key
+        self.fields = []
+
+    def process_batch(self, batch: list):
+        self.fields = [name for name in UPSERT_FIELDS if name in batch[0][1] and name != self.key]
+        super().process_batch(batch)
+
+    def build(self, row: dict, context: dict) -> Product:
+        product = super().build(row, context)
+        if not getattr(product, self.key):
+            raise RowError(f"{self.key}: this field is required for upsert.")
+        return product
+
+    def build_batch(self, batch: list) -> list:
+        items = super().build_batch(batch)
+        # последняя строка с данным ключом побеждает, более ранние - ошибки в отчёте, а не молчаливая потеря
+        last_lines = {getattr(product, self.key): line for line, product in items}
+        kept = []
+        for line, product in items:
+            key = getattr(product, self.key)
+            if last_lines[key] != line:
+                self.report.add_error(line, f"{self.key}: duplicate {key!r}, superseded by line {last_lines[key]}.")
+            else:
+                kept.append((line, product))
+        return kept
+
+    def save(self, items: list) -> dict:
+        # ключи в пачке уникальны: повторы отсеял build_batch
+        incoming = {getattr(product, self.key): product for product in items}
+        existing = (
+            Product.objects
+            .filter(**{f"{self.key}__in": incoming.keys()})
+            .only(self.key, "updated_at", *self.fields)
+        )
+
+        to_update = []
+        matched = set()
+        unchanged = 0
+        now = timezone.now()
+        for product in existing:
+            key = getattr(product, self.key)
+            matched.add(key)
+            source = incoming[key]
+            changed = False
+            for name in self.fields:
+                value = getattr(source, name)
+                if getattr(product, name) != value:
+                    setattr(product, name, value)
+                    changed = True
+            if changed:
+                product.updated_at = now
+                to_update.append(product)
+            else:
+                unchanged += 1
+
+        to_create = [product for key, product in incoming.items() if key not in matched]
+        Product.objects.bulk_create(to_create)
+        if to_update and self.fields:
+            Product.objects.bulk_update(to_update, [*self.fields, "updated_at"], batch_size=self.batch_size)
+            bump_rows(Product, [product.pk for product in to_update])
+            bump_product_customers([product.pk for product in to_update])
+        return {
+            "created": len(to_create),
+            "updated": len(to_update),
+            "unchanged": unchanged,
+        }
+
+
+class OrderCSVImporter(CSVImporter):
+    model = Order
+
+    def resolve(self, batch: list) -> dict:
+        product_refs = {ref for line, row in batch for ref in split_refs(row.get("products"))}
+        product_ids = {int(ref) for ref in product_refs if ref.isdigit()}
+        prices = Product.objects.filter(pk__in=product_ids).values_list("pk", "price", "discount")
+        return {
+            "users": resolve_users(
+                row["user"].strip() for line, row in batch if row.get("user")
+            ),
+            # цены на момент импорта попадают в строки заказа
+            "products": {pk: (price, discount) for pk, price, discount in prices},
+        }
+
+    def build(self, row: dict, context: dict) -> tuple:
+        product_ids = []
+        for ref in split_refs(row.get("products")):
+            if not ref.isdigit() or int(ref) not in context["products"]:
+                raise RowError(f"products: unknown product {ref!r}.")
+            product_ids.append(int(ref))
+        order = Order(
+            delivery_address=row.get("delivery_address") or "",
+            promocode=clean_field(Order, "promocode", (row.get("promocode") or "").strip()),
+            user_id=self.resolve_user(row.get("user"), context, "user"),
+        )
+        # повтор товара в ячейке - количество
+        return order, build_items(order, Counter(product_ids), context["products"])
+
+    def save(self, items: list) -> dict:
+        orders = Order.objects.bulk_create([order for order, order_items in items])
+        attach_items(
+            [item for order, order_items in items for item in order_items],
+            batch_size=self.batch_size,
+        )
+        mark_instances(orders)
+        mark_products(item.product_id for order, order_items in items for item in order_items)
+        # списки и выгрузки заказов этих покупателей устарели, как и после shopapp.orders.create_orders
+        bump_user_orders(order.user_id for order in orders)
+        return {"created": len(orders)}
+
+
+class CSVPushReader:
+    """
+    DictReader, в который байты подаются кусками по мере прихода (push, а не pull).
+
+    Физические строки копятся, пока число кавычек в записи нечётное (перевод
+    строки внутри поля в кавычках), и только полная запись отдаётся
+    DictReader. Поэтому он никогда не упирается в конец данных посреди
+    записи, а номера строк в отчёте те же, что при чтении файла.
+    """
+
+    def __init__(self, importer: CSVImporter, encoding: Optional[str] = None):
+        self.importer = importer
+        self.decoder = codecs.getincrementaldecoder(encoding or "utf-8-sig")()
+        self.lines = deque()
+        self.reader = DictReader(self.pending_lines())
+        self.header_read = False
+        self.tail = ""
+        self.quotes = 0
+        self.closed = False
+
+    def pending_lines(self):
+        # до close() записи читаются только целиком, так что очередь посреди записи не кончается
+        while self.lines or not self.closed:
+            yield self.lines.popleft()
+
+    def feed(self, data: bytes):
+        text = self.tail + self.decoder.decode(data)
+        *lines, self.tail = text.split("\n")
+        for line in lines:
+            self.add_line(line + "\n")
+
+    def add_line(self, line: str):
+        self.lines.append(line)
+        self.quotes += line.count('"')
+        if self.quotes % 2:
+            return
+        self.quotes = 0
+        if line.strip("\r\n"):
+            self.read_record()
+        # пустые строки DictReader пропускает сам, вместе со следующей записью
+
+    def read_record(self):
+        if not self.header_read:
+            self.header_read = True
+            self.reader.fieldnames
+            return
+        row = next(self.reader)
+        self.importer.feed(self.reader.line_num, row)
+
+    def close(self) -> ImportReport:
+        text = self.tail + self.decoder.decode(b"", final=True)
+        self.tail = ""
+        if text:
+            self.add_line(text)
+        self.closed = True
+        if self.quotes % 2 and self.header_read:
+            # незакрытая кавычка в последней записи: как и csv, читаем до конца данных
+            self.quotes = 0
+            self.read_record()
+        return self.importer.close()
+
+
+def import_csv(importer: CSVImporter, file, encoding: Optional[str]) -> ImportReport:
     csv_file = TextIOWrapper(
         file,
-        encoding=encoding,
+        encoding=encoding or "utf-8-sig",
+        newline="",
     )
     reader = DictReader(csv_file)
+    for row in reader:
+        importer.feed(reader.line_num, row)
+    return importer.close()
+
+
+def save_csv_products(
+    file,
+    encoding,
+    created_by: Optional[User] = None,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    upsert_key: Optional[str] = None,
+):
+    """
+    Импортирует товары; если задан ``upsert_key``, существующие товары обновляются, а не дублируются.
+    """
+    return import_csv(product_importer(created_by, batch_size, upsert_key), file, encoding)
+
+
+def product_importer(
+    created_by: Optional[User] = None,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    upsert_key: Optional[str] = None,
+) -> ProductCSVImporter:
+    if upsert_key:
+        return ProductCSVUpserter(key=upsert_key, batch_size=batch_size, created_by=created_by)
+    return ProductCSVImporter(batch_size=batch_size, created_by=created_by)
+
 
-    orders = [
-        Order(**row)
-        for row in reader
-    ]
-    Order.objects.bulk_create(orders)
-    return orders
+def save_csv_orders(file, encoding, created_by: Optional[User] = None, batch_size: int = IMPORT_BATCH_SIZE):
+    importer = OrderCSVImporter(batch_size=batch_size, created_by=created_by)
+    return import_csv(importer, file, encoding)
@@ -0,0 +1,61 @@
+"""
+Условные GET-запросы (ETag / Last-Modified) для товаров, заказов, лент и карт сайта.
+
+Для списков ETag строится из версий тегов кэша (см. ``shopapp.caching``),
+так что проверка не трогает базу и учитывает удаления. Для отдельных
+объектов ETag и Last-Modified берутся из ``updated_at`` одним запросом
+по первичному ключу. В обоих случаях при совпадении отдаётся 304 без
+сериализации и рендеринга.
+"""
+import hashlib
+
+from django.views.decorators.http import condition
+
+from .caching import row_tag, versions_fingerprint
+
+
+def representation_etag(request, *parts: str) -> str:
+    """
+    ETag одного представления: версии данных плюс всё, от чего зависит ответ.
+    """
+    user = getattr(request, "user", None)
+    user_pk = user.pk if user is not None and user.is_authenticated else ""
+    raw = "|".join([
+        *parts,
+        request.get_full_path(),
+        request.headers.get("Accept", ""),
+        str(user_pk),
+    ])
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def tags_etag(*tags: str):
+    def etag_func(request, *args, **kwargs):
+        return representation_etag(request, versions_fingerprint(tags))
+    return etag_func
+
+
+def tags_condition(*tags: str):
+    return condition(etag_func=tags_etag(*tags))
+
+
+def row_updated_at(model, request, pk):
+    # etag_func и last_modified_func вызываются по очереди, а запрос в базу нужен один
+    memo = request.__dict__.setdefault("_updated_at", {})
+    key = row_tag(model, pk)
+    if key not in memo:
+        memo[key] = model.objects.filter(pk=pk).values_list("updated_at", flat=True).first()
+    return memo[key]
+
+
+def row_condition(model, pk_kwarg: str = "pk"):
+    def last_modified_func(request, *args, **kwargs):
+        return row_updated_at(model, request, kwargs[pk_kwarg])
+
+    def etag_func(request, *args, **kwargs):
+        updated_at = row_updated_at(model, request, kwargs[pk_kwarg])
+        if updated_at is None:
+            return None
+        return representation_etag(request, updated_at.isoformat())
+
+    return condition(etag_func=etag_func, last_modified_func=last_modified_func)
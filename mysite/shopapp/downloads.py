@@ -0,0 +1,184 @@
+"""
+Отдача файлов: HTTP Range, чтобы прерванные скачивания можно было докачать,
+строгий ETag и Last-Modified для условных запросов, а в продакшене -
+передача файла фронтовому серверу.
+
+``settings.SENDFILE_BACKEND``:
+
+* None - файл отдаёт Django через FileResponse; WSGI-сервер с
+  ``wsgi.file_wrapper`` (gunicorn, uWSGI) отправляет его через sendfile,
+  без чтения в Python;
+* ``"x-accel"`` - заголовок X-Accel-Redirect для nginx, путь внутри
+  ``settings.SENDFILE_URL`` (internal location, смотрящая на ``SENDFILE_ROOT``);
+* ``"x-sendfile"`` - заголовок X-Sendfile с абсолютным путём (Apache, lighttpd).
+
+С фронтовым сервером Range и отправку выполняет он сам; Django остаются
+проверка прав и ответы 304.
+"""
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpRequest, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+
+SENDFILE_HEADERS = {
+    "x-accel": "X-Accel-Redirect",
+    "x-sendfile": "X-Sendfile",
+}
+
+
+def parse_range(header: str, size: int):
+    """
+    Разбирает заголовок Range с одним диапазоном.
+
+    Возвращает (start, end) включительно, None если заголовок не понят
+    (тогда отдаётся весь файл) или False если диапазон за пределами файла.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        length = int(end)
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def iter_file_range(file, start: int, length: int, chunk_size: int = CHUNK_SIZE):
+    try:
+        file.seek(start)
+        while length > 0:
+            data = file.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+def file_etag(stat: os.stat_result) -> str:
+    # размер и mtime в наносекундах: файл перезаписывается только целиком (os.replace)
+    return quote_etag(f"{stat.st_size:x}-{stat.st_mtime_ns:x}")
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    return any(value.strip() in ("*", etag) for value in header.split(","))
+
+
+def not_modified(request: HttpRequest, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+def range_applies(request: HttpRequest, etag: str, mtime: float) -> bool:
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if if_range.startswith(('"', "W/")):
+        # для If-Range годится только строгое сравнение
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(mtime)
+
+
+def sendfile_response(path: str, content_type: str):
+    """
+    Пустой ответ с заголовком для фронтового сервера или None, если отдавать самим.
+    """
+    backend = getattr(settings, "SENDFILE_BACKEND", None)
+    if backend is None:
+        return None
+    header = SENDFILE_HEADERS[backend]
+    root = os.path.abspath(getattr(settings, "SENDFILE_ROOT", settings.MEDIA_ROOT))
+    path = os.path.abspath(path)
+    if os.path.commonpath([root, path]) != root:
+        return None
+    response = HttpResponse(content_type=content_type)
+    if backend == "x-accel":
+        relative = os.path.relpath(path, root).replace(os.sep, "/")
+        response[header] = settings.SENDFILE_URL.rstrip("/") + "/" + quote(relative)
+    else:
+        response[header] = path
+    return response
+
+
+def content_disposition(filename: str, as_attachment: bool) -> str:
+    disposition = "attachment" if as_attachment else "inline"
+    return f"{disposition}; filename*=utf-8''{quote(filename)}"
+
+
+def ranged_file_response(request: HttpRequest, path: str, content_type: str, filename: str,
+                         as_attachment: bool = True, etag: str = None) -> HttpResponse:
+    """
+    Ответ с файлом: 304 по If-None-Match/If-Modified-Since, 206/416 по Range.
+
+    ``etag`` - уже известный строгий ETag (например, хэш содержимого); по
+    умолчанию он строится из размера и времени изменения файла.
+    """
+    stat = os.stat(path)
+    etag = etag or file_etag(stat)
+    validators = {"ETag": etag, "Last-Modified": http_date(stat.st_mtime)}
+    if not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        for header, value in validators.items():
+            response[header] = value
+        return response
+
+    response = sendfile_response(path, content_type)
+    if response is not None:
+        response["Content-Disposition"] = content_disposition(filename, as_attachment)
+        for header, value in validators.items():
+            response[header] = value
+        return response
+
+    byte_range = None
+    header = request.headers.get("Range")
+    if header and range_applies(request, etag, stat.st_mtime):
+        byte_range = parse_range(header, stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{stat.st_size}"
+    elif byte_range is None:
+        response = FileResponse(open(path, "rb"), content_type=content_type, as_attachment=as_attachment,
+                                filename=filename)
+    elif byte_range[1] == stat.st_size - 1:
+        # диапазон до конца файла (обычная докачка): FileResponse с позиции start,
+        # Content-Length он посчитает сам, и файл по-прежнему уйдёт через sendfile
+        start, end = byte_range
+        file = open(path, "rb")
+        file.seek(start)
+        response = FileResponse(file, status=206, content_type=content_type, as_attachment=as_attachment,
+                                filename=filename)
+        response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            iter_file_range(open(path, "rb"), start, length),
+            status=206,
+            content_type=content_type,
+        )
+        response["Content-Length"] = str(length)
+        response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        response["Content-Disposition"] = content_disposition(filename, as_attachment)
+    response["Accept-Ranges"] = "bytes"
+    for header, value in validators.items():
+        response[header] = value
+    return response
@@ -0,0 +1,259 @@
+"""
+Потоковая выгрузка товаров и заказов.
+
+Строки выбираются из базы порциями фиксированного размера, а связанные
+пользователи и товары подтягиваются одним запросом на порцию, поэтому
+расход памяти не зависит от размера каталога.
+
+JSON-выгрузки кодируются по строке и отдаются потоком: либо как один
+объект ``{"orders": [...]}``, либо как NDJSON по ``?format=ndjson``.
+"""
+from collections import defaultdict
+from csv import DictWriter
+from itertools import islice
+from typing import Iterable, Iterator, Sequence
+
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import QuerySet
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+
+from .models import Order, Product
+
+EXPORT_CHUNK_SIZE = 2000
+# сколько текста копить перед отдачей клиенту, чтобы не писать в сокет по строке
+STREAM_BUFFER_SIZE = 64 * 1024
+# выгрузки не больше этого размера кладутся в кэш целиком
+EXPORT_CACHE_MAX_SIZE = getattr(settings, "SHOPAPP_EXPORT_CACHE_MAX_SIZE", 1024 * 1024)
+
+JSON_EXPORT_CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+PRODUCT_EXPORT_FIELDS = [
+    "name",
+    "description",
+    "price",
+    "discount",
+]
+
+ORDER_EXPORT_FIELDS = [
+    "delivery_address",
+    "promocode",
+    "created_at",
+    "user",
+    "products",
+    "total",
+]
+
+
+class Echo:
+    """
+    Псевдо-буфер для csv.writer: ничего не хранит, а сразу отдаёт записанную строку.
+    """
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def iter_chunks(rows: Iterable, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[list]:
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_product_rows(queryset: QuerySet, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[dict]:
+    rows = queryset.values_list(*PRODUCT_EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+    for row in rows:
+        yield dict(zip(PRODUCT_EXPORT_FIELDS, row))
+
+
+def iter_product_dicts(queryset: QuerySet, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[dict]:
+    fields = ["pk", "name", "price", "archived"]
+    for row in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+        yield dict(zip(fields, row))
+
+
+def iter_order_rows(queryset: QuerySet, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[dict]:
+    """
+    Строки заказов с username владельца, списком pk товаров и суммой заказа.
+
+    На каждую порцию заказов выполняется ровно три запроса: сами заказы,
+    их владельцы и строки through-таблицы Order.products.
+    """
+    rows = queryset.values_list(
+        "pk",
+        "delivery_address",
+        "promocode",
+        "created_at",
+        "user_id",
+        "total",
+    ).iterator(chunk_size=chunk_size)
+
+    for chunk in iter_chunks(rows, chunk_size):
+        usernames = dict(
+            User.objects
+            .filter(pk__in={row[4] for row in chunk})
+            .values_list("pk", "username")
+        )
+        products = {row[0]: [] for row in chunk}
+        through_rows = (
+            Order.products.through.objects
+            .filter(order_id__in=products.keys())
+            .order_by("order_id", "product_id")
+            .values_list("order_id", "product_id")
+        )
+        for order_id, product_id in through_rows:
+            products[order_id].append(product_id)
+
+        for pk, delivery_address, promocode, created_at, user_id, total in chunk:
+            yield {
+                "delivery_address": delivery_address,
+                "promocode": promocode,
+                "created_at": created_at,
+                "user": usernames.get(user_id, user_id),
+                "products": ",".join(str(product_id) for product_id in products[pk]),
+                "total": total,
+            }
+
+
+def iter_order_dicts(queryset: QuerySet, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[dict]:
+    """
+    Заказы в формате JSON-выгрузок: товары - строковое представление их values().
+
+    Запросов на порцию три: заказы, строки through-таблицы и товары,
+    вместо двух дополнительных запросов на каждый заказ.
+    """
+    rows = queryset.values_list(
+        "pk",
+        "delivery_address",
+        "promocode",
+        "user_id",
+        "total",
+    ).iterator(chunk_size=chunk_size)
+
+    for chunk in iter_chunks(rows, chunk_size):
+        products = {row[0]: [] for row in chunk}
+        orders_by_product = defaultdict(list)
+        through_rows = (
+            Order.products.through.objects
+            .filter(order_id__in=products.keys())
+            .values_list("product_id", "order_id")
+        )
+        for product_id, order_id in through_rows:
+            orders_by_product[product_id].append(order_id)
+        # товары идут в порядке Product.Meta.ordering, как и в order.products.filter().values()
+        for values in Product.objects.filter(pk__in=orders_by_product.keys()).values():
+            for order_id in orders_by_product[values["id"]]:
+                products[order_id].append(str(values))
+
+        for pk, delivery_address, promocode, user_id, total in chunk:
+            yield {
+                "pk": pk,
+                "delivery_address": delivery_address,
+                "promocode": promocode,
+                "user": user_id,
+                "products": products[pk],
+                "total": total,
+            }
+
+
+def iter_csv(rows: Iterable[dict], fieldnames: Sequence[str]) -> Iterator[str]:
+    writer = DictWriter(Echo(), fieldnames=fieldnames)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_ndjson(rows: Iterable[dict]) -> Iterator[str]:
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for row in rows:
+        yield encoder.encode(row) + "\n"
+
+
+def iter_json_object(key: str, rows: Iterable[dict]) -> Iterator[str]:
+    """
+    ``{"<key>": [row, ...]}`` по кусочку на строку: весь документ в памяти не собирается.
+    """
+    encoder = DjangoJSONEncoder()
+    yield f"{{{encoder.encode(key)}: ["
+    separator = ""
+    for row in rows:
+        yield separator + encoder.encode(row)
+        separator = ", "
+    yield "]}"
+
+
+def iter_buffered(parts: Iterable[str], buffer_size: int = STREAM_BUFFER_SIZE) -> Iterator[str]:
+    buffer, size = [], 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= buffer_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def iter_caching(parts: Iterable[str], cache_key: str, timeout: int, max_size: int = EXPORT_CACHE_MAX_SIZE) -> Iterator[str]:
+    """
+    Отдаёт куски дальше и, если выгрузка целиком уложилась в ``max_size``, кладёт её в кэш.
+    """
+    cached, size = [], 0
+    for part in parts:
+        if cached is not None:
+            size += len(part)
+            if size > max_size:
+                cached = None
+            else:
+                cached.append(part)
+        yield part
+    if cached is not None:
+        cache.set(cache_key, "".join(cached), timeout)
+
+
+def json_export_response(
+    request: HttpRequest,
+    key: str,
+    rows: Iterable[dict],
+    cache_key: str = None,
+    timeout: int = None,
+) -> HttpResponse:
+    """
+    Потоковый ответ с выгрузкой ``rows`` в формате из ``?format=`` (json по умолчанию или ndjson).
+
+    ``rows`` должен быть ленивым: при попадании в кэш он не читается. С ``cache_key``
+    небольшие выгрузки кэшируются готовым текстом, отдельно для каждого формата.
+    """
+    export_format = request.GET.get("format", "json")
+    if export_format not in JSON_EXPORT_CONTENT_TYPES:
+        return HttpResponseBadRequest(f"Unknown format, expected one of {', '.join(JSON_EXPORT_CONTENT_TYPES)}")
+    content_type = JSON_EXPORT_CONTENT_TYPES[export_format]
+
+    if cache_key is not None:
+        cache_key = f"{cache_key}:{export_format}"
+        body = cache.get(cache_key)
+        if body is not None:
+            return HttpResponse(body, content_type=content_type)
+
+    if export_format == "ndjson":
+        parts = iter_ndjson(rows)
+    else:
+        parts = iter_json_object(key, rows)
+    parts = iter_buffered(parts)
+    if cache_key is not None:
+        parts = iter_caching(parts, cache_key, timeout)
+    return StreamingHttpResponse(parts, content_type=content_type)
+
+
+def streaming_csv_response(rows: Iterable[dict], fieldnames: Sequence[str], filename: str) -> StreamingHttpResponse:
+    response = StreamingHttpResponse(iter_csv(rows, fieldnames), content_type="text/csv")
+    response["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
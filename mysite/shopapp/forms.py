@@ -1,5 +1,7 @@
 from django import forms
 
+from .common import UPSERT_KEYS
+from .images import validate_uploads
 from .models import Product
 
 
@@ -9,11 +11,26 @@ class ProductForm(forms.ModelForm):
         fields = 'name', 'price', 'description', 'discount', 'preview'
 
     # adding a new field:
-    images = forms.ImageField(
+    # FileField, а не ImageField: ImageField проверил бы только последний файл, да ещё и декодируя его целиком.
+    # Все файлы по заголовкам проверяются в clean_images
+    images = forms.FileField(
         # to have an option of adding many images at the time, we have to tag this widget:
         widget=forms.ClearableFileInput(attrs={"multiple": True})
     )
 
+    def clean_images(self) -> list:
+        files = self.files.getlist(self.add_prefix('images'))
+        validate_uploads(files)
+        return files
+
 
 class CSVImportForm(forms.Form):
     csv_file = forms.FileField()
+
+
+class ProductCSVImportForm(CSVImportForm):
+    # пустое значение - обычная вставка, иначе повторный импорт обновит товары с тем же ключом
+    upsert_key = forms.ChoiceField(
+        choices=[("", "Insert only")] + [(key, f"Upsert by {key}") for key in UPSERT_KEYS],
+        required=False,
+    )
@@ -0,0 +1,257 @@
+"""
+Уменьшенные копии (варианты) превью и картинок галереи товаров.
+
+После сохранения картинки её варианты строятся вне запроса: задача уходит
+в пул потоков после коммита, поток читает исходник из хранилища, а сжатие
+выполняется в пуле процессов (``shopapp.imaging``). Файлы вариантов лежат
+рядом с исходником по схеме ``variants/<путь без расширения>/<вариант>.webp``,
+а их имена и размеры - в JSON-поле модели (``Product.preview_variants``,
+``ProductImage.variants``), откуда их берут шаблоны и API для srcset.
+
+Галерея загружается пачкой через ``ingest_images``: заголовки всех файлов
+проверяются до записи, файлы пишутся в хранилище параллельно, а строки
+``ProductImage`` вставляются одним ``bulk_create``.
+"""
+import logging
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.db.models.fields.files import FieldFile
+from PIL import Image
+
+from .caching import bump, model_tag, update_and_bump
+from .imaging import VARIANT_EXTENSION, render_variants
+from .models import Product, ProductImage
+
+log = logging.getLogger(__name__)
+
+# вариант для обычной плотности и для 2x; ширина на странице - по обычному
+SIZES = {
+    "thumb": ("thumb", "thumb_2x"),
+    "detail": ("detail", "detail_2x"),
+}
+
+# форматы, которые принимаем в галерею (Image.format)
+UPLOAD_FORMATS = ("JPEG", "PNG", "WEBP", "GIF")
+
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-variants")
+# запись загруженных файлов в хранилище - ввод-вывод, потоков может быть больше
+upload_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="image-uploads")
+_process_pool = None
+
+
+def image_workers() -> int:
+    # 0 - сжимать в том же процессе (для тестов и разработки)
+    return getattr(settings, "SHOPAPP_IMAGE_WORKERS", 2)
+
+
+def process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # spawn, а не fork: процесс Django многопоточный
+        _process_pool = ProcessPoolExecutor(max_workers=image_workers(), mp_context=get_context("spawn"))
+    return _process_pool
+
+
+def variant_name(name: str, variant: str) -> str:
+    return f"variants/{os.path.splitext(name)[0]}/{variant}.{VARIANT_EXTENSION}"
+
+
+def render(data: bytes) -> dict:
+    if image_workers():
+        return process_pool().submit(render_variants, data).result()
+    return render_variants(data)
+
+
+def generate_variants(field_file: FieldFile) -> dict:
+    """
+    Строит и сохраняет варианты картинки; возвращает значение для JSON-поля модели.
+    """
+    with field_file.open("rb") as file:
+        data = file.read()
+    storage = field_file.storage
+    variants = {"source": field_file.name}
+    for variant, (content, width, height) in render(data).items():
+        name = variant_name(field_file.name, variant)
+        # перестраиваем на месте: иначе хранилище выберет новое имя, а старый файл останется
+        if storage.exists(name):
+            storage.delete(name)
+        variants[variant] = {
+            "name": storage.save(name, ContentFile(content)),
+            "width": width,
+            "height": height,
+        }
+    return variants
+
+
+def needs_variants(field_file: FieldFile, variants: dict) -> bool:
+    return bool(field_file) and variants.get("source") != field_file.name
+
+
+def update_preview_variants(product_id: int):
+    product = Product.objects.filter(pk=product_id).first()
+    if product is None or not product.preview:
+        return
+    variants = generate_variants(product.preview)
+    # превью могли заменить, пока строились варианты: тогда их перестроит следующая задача
+    update_and_bump(Product.objects.filter(pk=product_id, preview=product.preview.name), preview_variants=variants)
+
+
+def update_image_variants(image_id: int):
+    image = ProductImage.objects.filter(pk=image_id).first()
+    if image is None or not image.image:
+        return
+    variants = generate_variants(image.image)
+    ProductImage.objects.filter(pk=image_id, image=image.image.name).update(variants=variants)
+    bump(model_tag(ProductImage))
+    update_and_bump(Product.objects.filter(pk=image.product_id))
+
+
+def run_in_thread(func, pk: int) -> bool:
+    """
+    Строит варианты в потоке пула; ошибка пишется в лог и не мешает остальным задачам. True - успех.
+    """
+    try:
+        func(pk)
+    except Exception:
+        log.exception("Building image variants failed: %s(%s)", func.__name__, pk)
+        return False
+    finally:
+        # у каждого потока своё соединение с базой
+        connection.close()
+    return True
+
+
+def enqueue_variants(func, pk: int):
+    transaction.on_commit(lambda: executor.submit(run_in_thread, func, pk))
+
+
+def variant_url(field_file: FieldFile, variants: dict, variant: str) -> Optional[str]:
+    if variant not in variants:
+        return None
+    return field_file.storage.url(variants[variant]["name"])
+
+
+def srcset(field_file: FieldFile, variants: dict, size: str = "thumb", build_url=None) -> str:
+    """
+    Значение атрибута srcset ("<url> 1x, <url> 2x") или пустая строка, если вариантов ещё нет.
+
+    ``build_url`` позволяет сделать адреса абсолютными (request.build_absolute_uri).
+    """
+    urls = [variant_url(field_file, variants, variant) for variant in SIZES[size]]
+    if build_url is not None:
+        urls = [build_url(url) if url else url for url in urls]
+    return ", ".join(f"{url} {density}x" for density, url in enumerate(urls, start=1) if url)
+
+
+def max_upload_images() -> int:
+    return getattr(settings, "SHOPAPP_MAX_UPLOAD_IMAGES", 50)
+
+
+def inspect_upload(file) -> tuple:
+    """
+    (формат, ширина, высота) загруженной картинки.
+
+    Image.open читает только заголовок, пиксели не декодируются. Слишком
+    большие картинки Pillow отвергает сам (DecompressionBombError).
+    """
+    try:
+        file.seek(0)
+        with Image.open(file) as image:
+            result = image.format, image.width, image.height
+    except Exception:
+        raise ValidationError(f"{file.name}: not a valid image", code="invalid_image")
+    finally:
+        file.seek(0)
+    if result[0] not in UPLOAD_FORMATS:
+        raise ValidationError(f"{file.name}: unsupported format {result[0]}", code="invalid_image")
+    return result
+
+
+def save_upload(storage, name: str, file, max_length: int) -> str:
+    try:
+        return storage.save(name, file, max_length=max_length)
+    finally:
+        # хранилище может писать в базу (mediastore считает ссылки)
+        connection.close()
+
+
+def submit_upload(storage, name: str, file, max_length: int) -> Future:
+    if image_workers():
+        return upload_executor.submit(save_upload, storage, name, file, max_length)
+    # 0 потоков - пишем в текущем потоке (тесты и разработка)
+    future = Future()
+    try:
+        future.set_result(storage.save(name, file, max_length=max_length))
+    except Exception as exc:
+        future.set_exception(exc)
+    return future
+
+
+def validate_uploads(files: list):
+    """
+    Проверяет пачку картинок; ValidationError со списком ошибок по всем битым файлам.
+    """
+    if len(files) > max_upload_images():
+        raise ValidationError(f"At most {max_upload_images()} images per upload", code="too_many_images")
+    errors = []
+    for file in files:
+        try:
+            inspect_upload(file)
+        except ValidationError as exc:
+            errors.extend(exc.messages)
+    if errors:
+        raise ValidationError(errors)
+
+
+def ingest_images(product: Product, files: list, descriptions: list = None, validated: bool = False) -> list:
+    """
+    Добавляет в галерею товара сразу несколько картинок; возвращает созданные ProductImage.
+
+    Все файлы проверяются до записи: одна битая картинка отклоняет всю пачку.
+    ``validated=True`` - файлы уже прошли validate_uploads (например, в форме).
+    Сигналы bulk_create не шлёт, поэтому кэш сбрасывается и варианты ставятся
+    в очередь здесь же.
+    """
+    if not files:
+        return []
+    if not validated:
+        validate_uploads(files)
+
+    descriptions = descriptions or []
+    field = ProductImage._meta.get_field("image")
+    images = [
+        ProductImage(product=product, description=descriptions[index] if index < len(descriptions) else "")
+        for index in range(len(files))
+    ]
+    futures = [
+        submit_upload(field.storage, field.generate_filename(image, file.name), file, field.max_length)
+        for image, file in zip(images, files)
+    ]
+    saved = []
+    try:
+        for image, future in zip(images, futures):
+            image.image = future.result()
+            saved.append(image.image.name)
+        with transaction.atomic():
+            ProductImage.objects.bulk_create(images)
+    except Exception:
+        # дожидаемся остальных записей, чтобы не оставить в хранилище файлы без строк
+        for future in futures[len(saved):]:
+            if future.exception() is None:
+                saved.append(future.result())
+        for name in saved:
+            field.storage.delete(name)
+        raise
+
+    bump(model_tag(ProductImage))
+    update_and_bump(Product.objects.filter(pk=product.pk))
+    for image in images:
+        enqueue_variants(update_image_variants, image.pk)
+    return images
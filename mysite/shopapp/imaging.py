@@ -0,0 +1,44 @@
+"""
+Построение уменьшенных копий картинок.
+
+Модуль нарочно не зависит от Django: функции выполняются в отдельных
+процессах (см. ``shopapp.images``), и дочернему процессу не нужно
+поднимать приложение, чтобы его импортировать.
+"""
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# ширина в пикселях; картинки меньше не увеличиваются
+VARIANTS = {
+    "thumb": 200,
+    "thumb_2x": 400,
+    "detail": 600,
+    "detail_2x": 1200,
+}
+
+VARIANT_FORMAT = "WEBP"
+VARIANT_EXTENSION = "webp"
+VARIANT_QUALITY = 80
+
+
+def render_variants(data: bytes) -> dict:
+    """
+    {вариант: (байты webp, ширина, высота)} для исходной картинки ``data``.
+
+    Исходник декодируется один раз, варианты строятся от большего к меньшему,
+    каждый из предыдущего.
+    """
+    with Image.open(BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    rendered = {}
+    for variant, width in sorted(VARIANTS.items(), key=lambda item: item[1], reverse=True):
+        if width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+        rendered[variant] = (buffer.getvalue(), image.width, image.height)
+    return rendered
@@ -0,0 +1,176 @@
+"""
+Фоновые выгрузки заказов и товаров.
+
+Задача ExportJob ставится в очередь после коммита транзакции, в которой
+она создана, и выполняется локальным пулом потоков. Вся выгрузка читается
+внутри одной транзакции, поэтому файл соответствует одному состоянию базы,
+даже если заказы меняются во время выгрузки. Результат пишется в gzip-файл
+под MEDIA_ROOT/exports/, прогресс - в кэш, чтобы не писать в базу из
+открытой читающей транзакции.
+"""
+import gzip
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.http import HttpRequest, QueryDict
+from django.utils import timezone
+from rest_framework.request import Request
+
+from .exports import (
+    EXPORT_CHUNK_SIZE,
+    ORDER_EXPORT_FIELDS,
+    PRODUCT_EXPORT_FIELDS,
+    iter_csv,
+    iter_ndjson,
+    iter_order_rows,
+    iter_product_rows,
+)
+from .models import ExportJob
+
+log = logging.getLogger(__name__)
+
+EXPORT_WORKERS = getattr(settings, "SHOPAPP_EXPORT_WORKERS", 2)
+# задача в running дольше этого (секунд) считается брошенной умершим воркером
+EXPORT_STALE_AFTER = getattr(settings, "SHOPAPP_EXPORT_STALE_AFTER", 6 * 60 * 60)
+PROGRESS_TIMEOUT = 60 * 60 * 24
+
+executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export-job")
+
+
+def progress_cache_key(job_id: int) -> str:
+    return f"export_job_progress:{job_id}"
+
+
+def get_progress(job: ExportJob) -> dict:
+    if job.status == ExportJob.STATUS_RUNNING:
+        return cache.get(progress_cache_key(job.pk), {"rows_done": job.rows_done, "rows_total": job.rows_total})
+    return {"rows_done": job.rows_done, "rows_total": job.rows_total}
+
+
+def enqueue_export(job: ExportJob):
+    transaction.on_commit(lambda: executor.submit(run_export_job_in_thread, job.pk))
+
+
+def run_export_job_in_thread(job_id: int):
+    try:
+        run_export_job(job_id)
+    finally:
+        # у каждого потока своё соединение с базой, за собой его нужно закрыть
+        connection.close()
+
+
+def filtered_queryset(job: ExportJob):
+    """
+    Применяет к выгрузке те же filter backends, что и соответствующий viewset.
+    """
+    from .views import OrderViewSet, ProductViewSet
+
+    viewset_class = {
+        "orders": OrderViewSet,
+        "products": ProductViewSet,
+    }[job.kind]
+    http_request = HttpRequest()
+    http_request.method = "GET"
+    http_request.GET = QueryDict(job.query)
+    view = viewset_class(request=Request(http_request), format_kwarg=None, action="list", args=(), kwargs={})
+    return view.filter_queryset(view.get_queryset())
+
+
+def track_progress(job: ExportJob, rows: Iterable[dict], rows_total: int) -> Iterator[dict]:
+    key = progress_cache_key(job.pk)
+    rows_done = 0
+    for rows_done, row in enumerate(rows, start=1):
+        if rows_done % EXPORT_CHUNK_SIZE == 0:
+            cache.set(key, {"rows_done": rows_done, "rows_total": rows_total}, PROGRESS_TIMEOUT)
+        yield row
+    job.rows_done = rows_done
+
+
+def iter_job_lines(job: ExportJob, rows_total: int) -> Iterator[str]:
+    queryset = filtered_queryset(job)
+    if job.kind == "orders":
+        rows, fieldnames = iter_order_rows(queryset), ORDER_EXPORT_FIELDS
+    else:
+        rows, fieldnames = iter_product_rows(queryset), PRODUCT_EXPORT_FIELDS
+    rows = track_progress(job, rows, rows_total)
+    if job.format == "ndjson":
+        return iter_ndjson(rows)
+    return iter_csv(rows, fieldnames)
+
+
+def begin_snapshot():
+    """
+    В SQLite снимок и так держится открытой читающей транзакцией, а Postgres
+    по умолчанию берёт новый снимок на каждый запрос, поэтому просим REPEATABLE READ.
+    """
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+
+
+def requeue_stale_jobs(stale_after: int = EXPORT_STALE_AFTER) -> list:
+    """
+    Возвращает в очередь задачи, которые слишком давно в running. Возвращает их pk.
+    """
+    stale = ExportJob.objects.filter(status=ExportJob.STATUS_RUNNING).filter(
+        # задачи, забранные до появления started_at, тоже
+        Q(started_at__lt=timezone.now() - timedelta(seconds=stale_after)) | Q(started_at__isnull=True),
+    )
+    job_ids = list(stale.values_list("pk", flat=True))
+    # только если их не закончили, пока шёл запрос
+    ExportJob.objects.filter(pk__in=job_ids, status=ExportJob.STATUS_RUNNING).update(
+        status=ExportJob.STATUS_PENDING, started_at=None, rows_done=0,
+    )
+    for job_id in job_ids:
+        log.warning("Export job %s was stuck in running, requeued", job_id)
+    return job_ids
+
+
+def run_export_job(job_id: int):
+    # забираем задачу атомарно, чтобы её не выполнили два воркера сразу
+    claimed = ExportJob.objects.filter(pk=job_id, status=ExportJob.STATUS_PENDING).update(
+        status=ExportJob.STATUS_RUNNING,
+        started_at=timezone.now(),
+    )
+    if not claimed:
+        return
+    job = ExportJob.objects.get(pk=job_id)
+
+    relative_path = f"exports/{job.kind}-export-{job.pk}.{job.format}.gz"
+    path = Path(settings.MEDIA_ROOT) / relative_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_name(path.name + ".part")
+
+    try:
+        with transaction.atomic():
+            begin_snapshot()
+            rows_total = filtered_queryset(job).count()
+            with gzip.open(partial_path, "wt", encoding="utf-8", newline="") as file:
+                for line in iter_job_lines(job, rows_total):
+                    file.write(line)
+        os.replace(partial_path, path)
+    except Exception as exc:
+        log.exception("Export job %s failed", job.pk)
+        partial_path.unlink(missing_ok=True)
+        job.status = ExportJob.STATUS_FAILED
+        job.error = str(exc)
+        job.finished_at = timezone.now()
+        job.save(update_fields=["status", "error", "finished_at"])
+        return
+    finally:
+        cache.delete(progress_cache_key(job.pk))
+
+    job.status = ExportJob.STATUS_DONE
+    job.rows_total = rows_total
+    job.file.name = relative_path
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "rows_total", "rows_done", "file", "finished_at"])
+    log.info("Export job %s finished: %s rows", job.pk, job.rows_done)
@@ -24,15 +24,19 @@ class Command(BaseCommand):
         # )
         # print(res)
 
+        # сумма заказа хранится в самом заказе (по ценам на момент заказа), join к товарам не нужен;
+        # количество товаров - по строкам заказа
         orders = Order.objects.annotate(
-            total=Sum('products__price', default=0),
-            products_count=Count('products'),
+            products_count=Sum('items__quantity', default=0),
         )
         for order in orders:
             print(f'Order #{order.id} '
                   f'with {order.products_count} '
                   f'products worth {order.total}')
 
+        revenue = Order.objects.aggregate(revenue=Sum('total', default=0), count=Count('id'))
+        print(f'{revenue["count"]} orders worth {revenue["revenue"]}')
+
 
         self.stdout.write("____\n"
                           "Done\n"
@@ -0,0 +1,25 @@
+from django.core.management import BaseCommand, CommandError
+
+from shopapp.recommendations import RECOMMENDATION_CHUNK_SIZE, rebuild_recommendations, refresh_dirty_products
+
+
+class Command(BaseCommand):
+    """
+    Builds "frequently bought together" recommendations from all orders or refreshes the marked products
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dirty", action="store_true",
+                            help="only refresh the products marked by order changes and exit")
+        parser.add_argument("--chunk-size", type=int, default=RECOMMENDATION_CHUNK_SIZE,
+                            help="order lines read and counted at once")
+
+    def handle(self, *args, **options):
+        if options["dirty"]:
+            refreshed = refresh_dirty_products()
+            self.stdout.write(self.style.SUCCESS(f"Refreshed {refreshed} products"))
+            return
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        changed = rebuild_recommendations(chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt recommendations, {len(changed)} products changed"))
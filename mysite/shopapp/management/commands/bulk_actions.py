@@ -1,7 +1,9 @@
 from django.contrib.auth.models import User
 from django.core.management import BaseCommand
 
+from shopapp.caching import update_and_bump
 from shopapp.models import Product
+from shopapp.signals import bump_product_customers
 
 
 class Command(BaseCommand):
@@ -12,11 +14,14 @@ class Command(BaseCommand):
                           "Start demo bulk actions!!!\n"
                           "--------------------------")
 
-        res = Product.objects.filter(
-            name__contains='Smartphone'
-        ).update(discount=11)
+        # update() не шлёт сигналов, поэтому кэш сбрасываем сами
+        updated_pks = update_and_bump(
+            Product.objects.filter(name__contains='Smartphone'),
+            discount=11,
+        )
+        bump_product_customers(updated_pks)
 
-        print(res)
+        print(len(updated_pks))
 
         # to create:
 
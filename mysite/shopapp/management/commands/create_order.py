@@ -1,29 +1,83 @@
-from typing import Sequence
+import json
 
 from django.contrib.auth.models import User
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 from django.db import transaction
 
-from shopapp.models import Order, Product
+from shopapp.models import Order
+from shopapp.orders import BulkOrderError, add_products, create_orders, default_products
+from shopapp.serializers import BulkOrderSerializer
 
 
 class Command(BaseCommand):
+    """
+    Creates a demo order, or many orders at once (--count, --file) with one through-table insert
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", default="steef", help="username of the order owner")
+        parser.add_argument("--products", type=int, nargs="+", help="product ids, all live products by default")
+        parser.add_argument("--address", default="Kazino777, azino 18")
+        parser.add_argument("--promocode", default="promo5")
+        parser.add_argument("--count", type=int, help="create this many orders in one transaction")
+        parser.add_argument(
+            "--file",
+            help="JSON list of orders in the format of the bulk API: "
+                 '[{"user": 1, "products": [1, 2], "delivery_address": "...", "promocode": "..."}]',
+        )
+
     @transaction.atomic
     def handle(self, *args, **options):
         # with transaction/atomic():
             # и так же как декоратор атомик, этот контекстный менеджер можно использовать.
         self.stdout.write("Create order")
-        user = User.objects.get(username="steef")
-        # products: Sequence[Product] = Product.objects.defer('description', 'price', 'created_at').all()
-        products: Sequence[Product] = Product.objects.only('id', 'name', 'discount', 'created_by_id', 'archived').all()
-        order, created = Order.objects.get_or_create(
-            delivery_address="Kazino777, azino 18",
-            promocode="promo5",
-            user=user,
-        )
-        for product in products:
-            # вот такой записью мы добавляем в заказ продуты:
-            if not product.archived:
-                order.products.add(product)
-        order.save()
-        self.stdout.write(f"Created order {order}")
+        user = User.objects.filter(username=options["user"]).first()
+        if user is None:
+            raise CommandError(f"Unknown user {options['user']!r}")
+        products = options["products"] or default_products()
+
+        try:
+            if options["file"]:
+                orders = self.read_orders(options["file"], user)
+            elif options["count"]:
+                orders = [
+                    {
+                        "user_id": user.pk,
+                        "products": products,
+                        "delivery_address": options["address"],
+                        "promocode": options["promocode"],
+                    }
+                ] * options["count"]
+            else:
+                order, created = Order.objects.get_or_create(
+                    delivery_address=options["address"],
+                    promocode=options["promocode"],
+                    user=user,
+                )
+                # вот такой записью мы добавляем в заказ продукты - одной вставкой в through-таблицу:
+                add_products([order.pk], products)
+                self.stdout.write(f"Created order {order}")
+                return
+            created = create_orders(orders)
+        except BulkOrderError as exc:
+            raise CommandError(self.format_errors(exc.errors))
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} orders"))
+
+    def read_orders(self, path: str, user: User) -> list:
+        with open(path, encoding="utf-8") as file:
+            serializer = BulkOrderSerializer(data=json.load(file), many=True)
+        if not serializer.is_valid():
+            raise CommandError(self.format_errors(serializer.errors))
+        return [
+            {
+                "user_id": data.get("user", user.pk),
+                "products": data["products"],
+                "delivery_address": data["delivery_address"],
+                "promocode": data["promocode"],
+            }
+            for data in serializer.validated_data
+        ]
+
+    @staticmethod
+    def format_errors(errors: list) -> str:
+        return "\n".join(f"order #{index}: {error}" for index, error in enumerate(errors) if error)
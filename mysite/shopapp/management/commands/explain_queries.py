@@ -0,0 +1,134 @@
+import re
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from shopapp.models import ExportJob, Order, Product
+from shopapp.pagination import KeysetPagination
+from shopapp.search import full_text_search
+from shopapp.sitemap import ShopSitemap
+from shopapp.views import (
+    LatestProductsFeed,
+    OrderDetailsView,
+    OrdersListView,
+    OrderViewSet,
+    ProductDetailsView,
+    ProductsListView,
+    ProductViewSet,
+)
+
+# планы, которые означают чтение всей таблицы или сортировку в памяти
+PLAN_ISSUES = {
+    "sqlite": [
+        ("full scan", re.compile(r"\bSCAN (?!.*\b(?:USING|VIRTUAL TABLE)\b)")),
+        ("temp b-tree sort", re.compile(r"USE TEMP B-TREE")),
+    ],
+    "postgresql": [
+        ("full scan", re.compile(r"Seq Scan on")),
+        ("in-memory sort", re.compile(r"\bSort\b")),
+    ],
+}
+
+# значения для запросов по ключу: план от них не зависит
+SAMPLE_PK = 1
+SAMPLE_TERM = "table"
+
+
+class EmptyRequest:
+    query_params = {}
+
+
+def keyset_page(queryset, view_class, after: bool):
+    """
+    Страница API так, как её запрашивает KeysetPagination: первая или следующая за курсором.
+    """
+    pagination = KeysetPagination()
+    pagination.ordering = pagination.get_ordering(
+        request=EmptyRequest(), queryset=queryset, view=view_class(),
+    )
+    page = queryset.order_by(*pagination.ordering_terms(reverse=False))
+    if after:
+        page = page.filter(pagination.keyset_filter([SAMPLE_PK] * len(pagination.ordering), reverse=False))
+    return page[:pagination.page_size + 1]
+
+
+# допустимые находки: представление и так отдаёт всю таблицу
+WHOLE_TABLE = ("full scan",)
+# сортировка по релевантности идёт только по найденным строкам
+RANKED = ("temp b-tree sort",)
+
+
+def audited_querysets():
+    """
+    (название, queryset, допустимые находки) для запросов представлений shopapp.
+    """
+    products = ProductViewSet.queryset.all()
+    orders = OrderViewSet.queryset.all()
+    return [
+        ("ProductViewSet.list", keyset_page(products, ProductViewSet, after=False), ()),
+        ("ProductViewSet.list ?cursor=", keyset_page(products, ProductViewSet, after=True), ()),
+        ("ProductViewSet.list ?search=", keyset_page(full_text_search(products, SAMPLE_TERM), ProductViewSet, after=False), RANKED),
+        ("ProductViewSet.retrieve", products.filter(pk=SAMPLE_PK), ()),
+        # первая страница по pk - это проход по rowid, который останавливается на LIMIT
+        ("OrderViewSet.list", keyset_page(orders, OrderViewSet, after=False), WHOLE_TABLE),
+        ("OrderViewSet.list ?cursor=", keyset_page(orders, OrderViewSet, after=True), ()),
+        ("OrderViewSet.list ?search=", keyset_page(full_text_search(orders, SAMPLE_TERM), OrderViewSet, after=False), RANKED),
+        ("row_condition", Product.objects.filter(pk=SAMPLE_PK).values_list("updated_at", flat=True), ()),
+        ("ProductsListView", ProductsListView.queryset.all(), WHOLE_TABLE),
+        ("ProductDetailsView", ProductDetailsView.queryset.filter(pk=SAMPLE_PK), ()),
+        ("OrdersListView", OrdersListView.queryset.all(), WHOLE_TABLE),
+        ("OrderDetailsView", OrderDetailsView.queryset.filter(pk=SAMPLE_PK), ()),
+        ("UserOrdersListView", Order.objects.filter(user_id=SAMPLE_PK).values_list("pk", flat=True), ()),
+        ("UserOrdersDataExportView", Order.objects.filter(user_id=SAMPLE_PK).order_by("pk"), ()),
+        ("OrdersDataExportView", Order.objects.order_by("pk"), WHOLE_TABLE),
+        ("ProductsDataExportView", Product.objects.order_by("pk"), WHOLE_TABLE),
+        ("LatestProductsFeed.items", LatestProductsFeed().items(), ()),
+        ("ShopSitemap.items", ShopSitemap().items(), ()),
+        ("ExportJobViewSet.list", ExportJob.objects.filter(created_by_id=SAMPLE_PK).order_by("-pk"), ()),
+    ]
+
+
+def plan_issues(plan: str, vendor: str) -> list:
+    return [
+        (name, line.strip())
+        for line in plan.splitlines()
+        for name, pattern in PLAN_ISSUES.get(vendor, [])
+        if pattern.search(line)
+    ]
+
+
+class Command(BaseCommand):
+    """
+    Prints query plans of the shopapp views and flags full scans and temporary sorts
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fail-on-issue",
+            action="store_true",
+            help="Exit with an error if any query plan has an issue (for CI)",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor not in PLAN_ISSUES:
+            raise CommandError(f"Query plan audit is not supported on {connection.vendor}")
+
+        problems = 0
+        for label, queryset, allowed in audited_querysets():
+            plan = queryset.explain()
+            issues = [(name, line) for name, line in plan_issues(plan, connection.vendor) if name not in allowed]
+            if options["verbosity"] > 1:
+                self.stdout.write(f"{label}:\n{plan}\n")
+            if not issues:
+                self.stdout.write(f"OK    {label}")
+                continue
+            problems += len(issues)
+            for name, line in issues:
+                self.stdout.write(self.style.WARNING(f"ISSUE {label}: {name}: {line}"))
+
+        if problems and options["fail_on_issue"]:
+            raise CommandError(f"{problems} query plan issue(s) found")
+        if problems:
+            self.stdout.write(self.style.WARNING(f"{problems} query plan issue(s) found"))
+        else:
+            self.stdout.write(self.style.SUCCESS("All query plans use indexes"))
@@ -0,0 +1,41 @@
+from django.core.management import BaseCommand
+
+from shopapp.images import executor, needs_variants, run_in_thread, update_image_variants, update_preview_variants
+from shopapp.models import Product, ProductImage
+
+
+class Command(BaseCommand):
+    """
+    Builds missing or outdated image variants for product previews and gallery images
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Rebuild variants that are already up to date")
+
+    def handle(self, *args, **options):
+        force = options["force"]
+        products = (
+            Product.objects
+            .exclude(preview="").exclude(preview__isnull=True)
+            .only("pk", "preview", "preview_variants")
+        )
+        product_ids = [
+            product.pk for product in products.iterator()
+            if force or needs_variants(product.preview, product.preview_variants)
+        ]
+        images = ProductImage.objects.only("pk", "image", "variants")
+        image_ids = [
+            image.pk for image in images.iterator()
+            if force or needs_variants(image.image, image.variants)
+        ]
+        self.stdout.write(f"Build variants for {len(product_ids)} previews and {len(image_ids)} gallery images")
+
+        # потоки читают и пишут файлы, сжатие идёт в пуле процессов; упавшая задача не останавливает остальные
+        futures = [executor.submit(run_in_thread, update_preview_variants, pk) for pk in product_ids]
+        futures += [executor.submit(run_in_thread, update_image_variants, pk) for pk in image_ids]
+        failed = sum(1 for future in futures if not future.result())
+
+        if failed:
+            self.stdout.write(self.style.ERROR(f"Failed to build variants for {failed} of {len(futures)} images, see the log"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Image variants are up to date"))
@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from shopapp.rollups import order_date_range, refresh_dirty_days, refresh_range, split_range
+
+
+def refresh_chunk(first: date, last: date) -> tuple:
+    try:
+        refresh_range(first, last)
+    finally:
+        # у каждого потока своё соединение с базой
+        connection.close()
+    return first, last
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the sales rollup tables for a date range, several ranges in parallel
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat,
+                            help="first day, YYYY-MM-DD (default: day of the first order)")
+        parser.add_argument("--to", dest="date_to", type=date.fromisoformat,
+                            help="last day, YYYY-MM-DD (default: day of the last order)")
+        parser.add_argument("--chunk-days", type=int, default=7, help="days rebuilt by one task")
+        parser.add_argument("--workers", type=int, default=4, help="parallel tasks, 0 - in the current thread")
+        parser.add_argument("--dirty", action="store_true",
+                            help="only refresh the days marked by order changes and exit")
+
+    def handle(self, *args, **options):
+        if options["dirty"]:
+            refreshed = refresh_dirty_days()
+            self.stdout.write(self.style.SUCCESS(f"Refreshed {refreshed} days"))
+            return
+
+        bounds = order_date_range()
+        if bounds is None and not (options["date_from"] and options["date_to"]):
+            self.stdout.write("no orders found")
+            return
+        first = options["date_from"] or bounds[0]
+        last = options["date_to"] or bounds[1]
+        if first > last:
+            raise CommandError("--from must not be later than --to")
+        if options["chunk_days"] < 1 or options["workers"] < 0:
+            raise CommandError("--chunk-days must be positive and --workers non-negative")
+
+        chunks = split_range(first, last, options["chunk_days"])
+        if options["workers"]:
+            # диапазоны не пересекаются, так что задачи не пишут одни и те же строки
+            with ThreadPoolExecutor(max_workers=options["workers"], thread_name_prefix="rollup-rebuild") as executor:
+                futures = [executor.submit(refresh_chunk, *chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    self.stdout.write("Rebuilt {} - {}".format(*future.result()))
+        else:
+            for chunk in chunks:
+                refresh_range(*chunk)
+                self.stdout.write("Rebuilt {} - {}".format(*chunk))
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt sales rollups from {first} to {last}"))
@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from shopapp.search import ensure_search_indexes
+
+
+class Command(BaseCommand):
+    """
+    Recreates full-text search triggers and rebuilds the FTS5 indexes from the source tables
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        rebuilt = ensure_search_indexes(options["database"], rebuild=True)
+        if not rebuilt:
+            self.stdout.write("Full-text search is only available on SQLite, nothing to rebuild")
+            return
+        for model in rebuilt:
+            self.stdout.write(f"Rebuilt search index for {model._meta.label}")
+        self.stdout.write(self.style.SUCCESS("Search indexes rebuilt"))
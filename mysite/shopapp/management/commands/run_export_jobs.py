@@ -0,0 +1,30 @@
+from django.core.management import BaseCommand, CommandError
+
+from shopapp.jobs import EXPORT_STALE_AFTER, requeue_stale_jobs, run_export_job
+from shopapp.models import ExportJob
+
+
+class Command(BaseCommand):
+    """
+    Runs pending export jobs, e.g. the ones left in the queue by a restarted worker,
+    and requeues jobs stuck in running because their worker died
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stale-after", type=int, default=EXPORT_STALE_AFTER,
+                            help="seconds after which a running job is considered abandoned")
+
+    def handle(self, *args, **options):
+        if options["stale_after"] < 0:
+            raise CommandError("--stale-after must not be negative")
+        for job_id in requeue_stale_jobs(options["stale_after"]):
+            self.stdout.write(self.style.WARNING(f"Export job #{job_id} was stuck in running, requeued"))
+
+        pending = ExportJob.objects.filter(status=ExportJob.STATUS_PENDING).order_by("pk")
+        for job_id in pending.values_list("pk", flat=True):
+            self.stdout.write(f"Run export job #{job_id}")
+            run_export_job(job_id)
+            job = ExportJob.objects.get(pk=job_id)
+            self.stdout.write(f"Export job #{job_id}: {job.status}")
+
+        self.stdout.write(self.style.SUCCESS("Pending export jobs processed"))
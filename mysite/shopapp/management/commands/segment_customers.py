@@ -0,0 +1,27 @@
+from django.core.management import BaseCommand, CommandError
+
+from shopapp.segments import SEGMENT_BATCH_SIZE, refresh_segments, segment_customers, segment_summary
+
+
+class Command(BaseCommand):
+    """
+    Recomputes RFM segments of all customers or only of those with new orders
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--incremental", action="store_true",
+                            help="only customers whose orders changed since the previous run")
+        parser.add_argument("--batch-size", type=int, default=SEGMENT_BATCH_SIZE, help="segments saved per query")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive")
+        if options["incremental"]:
+            run = refresh_segments(batch_size=options["batch_size"])
+        else:
+            run = segment_customers(batch_size=options["batch_size"])
+
+        for segment, count in segment_summary()["segments"].items():
+            self.stdout.write(f"{segment}: {count}")
+        kind = "full" if run.full else "incremental"
+        self.stdout.write(self.style.SUCCESS(f"Segmented {run.users} customers ({kind} run)"))
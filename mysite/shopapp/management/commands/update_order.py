@@ -1,24 +1,31 @@
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 
-from shopapp.models import Order, Product
+from shopapp.models import Order
+from shopapp.orders import BulkOrderError, add_products, default_products
 
 
 class Command(BaseCommand):
-    def handle(self, *args, **options):
-        order = Order.objects.first()
-        if not order:
-            self.stdout.write("no order found")
-            return
-
-        products = Product.objects.all()
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, nargs="+", help="order ids, the first order by default")
+        parser.add_argument("--products", type=int, nargs="+", help="product ids, all live products by default")
 
-        for product in products:
-            order.products.add(product)
+    def handle(self, *args, **options):
+        order_ids = options["orders"]
+        if not order_ids:
+            order = Order.objects.first()
+            if not order:
+                self.stdout.write("no order found")
+                return
+            order_ids = [order.pk]
 
-        order.save()
+        # все пары заказ-товар одной вставкой в through-таблицу, уже добавленные пропускаются
+        try:
+            updated = add_products(order_ids, options["products"] or default_products())
+        except BulkOrderError as exc:
+            raise CommandError(exc.errors[0]["products"][0])
 
         self.stdout.write(
             self.style.SUCCESS(
-                f"Successfully added products {order.products.all()} to order {order}"
+                f"Successfully added products to {updated} orders"
             )
         )
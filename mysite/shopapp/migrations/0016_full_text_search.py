@@ -0,0 +1,68 @@
+# Generated by Django 4.2 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+# замороженная копия схемы из shopapp.search на момент миграции: правки модуля её не меняют
+SEARCH_INDEX_SQL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS shopapp_product_fts USING fts5("
+    "name, description, content='shopapp_product', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS shopapp_product_fts_ai AFTER INSERT ON shopapp_product BEGIN "
+    "INSERT INTO shopapp_product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS shopapp_product_fts_ad AFTER DELETE ON shopapp_product BEGIN "
+    "INSERT INTO shopapp_product_fts(shopapp_product_fts, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS shopapp_product_fts_au AFTER UPDATE OF name, description ON shopapp_product BEGIN "
+    "INSERT INTO shopapp_product_fts(shopapp_product_fts, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO shopapp_product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "INSERT INTO shopapp_product_fts(shopapp_product_fts) VALUES ('rebuild')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS shopapp_order_fts USING fts5("
+    "delivery_address, content='shopapp_order', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS shopapp_order_fts_ai AFTER INSERT ON shopapp_order BEGIN "
+    "INSERT INTO shopapp_order_fts(rowid, delivery_address) VALUES (new.id, new.delivery_address); END",
+    "CREATE TRIGGER IF NOT EXISTS shopapp_order_fts_ad AFTER DELETE ON shopapp_order BEGIN "
+    "INSERT INTO shopapp_order_fts(shopapp_order_fts, rowid, delivery_address) "
+    "VALUES ('delete', old.id, old.delivery_address); END",
+    "CREATE TRIGGER IF NOT EXISTS shopapp_order_fts_au AFTER UPDATE OF delivery_address ON shopapp_order BEGIN "
+    "INSERT INTO shopapp_order_fts(shopapp_order_fts, rowid, delivery_address) "
+    "VALUES ('delete', old.id, old.delivery_address); "
+    "INSERT INTO shopapp_order_fts(rowid, delivery_address) VALUES (new.id, new.delivery_address); END",
+    "INSERT INTO shopapp_order_fts(shopapp_order_fts) VALUES ('rebuild')",
+]
+
+DROP_SEARCH_INDEX_SQL = [
+    "DROP TRIGGER IF EXISTS shopapp_product_fts_ai",
+    "DROP TRIGGER IF EXISTS shopapp_product_fts_ad",
+    "DROP TRIGGER IF EXISTS shopapp_product_fts_au",
+    "DROP TABLE IF EXISTS shopapp_product_fts",
+    "DROP TRIGGER IF EXISTS shopapp_order_fts_ai",
+    "DROP TRIGGER IF EXISTS shopapp_order_fts_ad",
+    "DROP TRIGGER IF EXISTS shopapp_order_fts_au",
+    "DROP TABLE IF EXISTS shopapp_order_fts",
+]
+
+
+def run_on_sqlite(statements):
+    def run(apps, schema_editor):
+        # таблицы FTS5 и триггеры есть только на SQLite, на других базах операция ничего не делает
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for statement in statements:
+            schema_editor.execute(statement, params=None)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0015_product_updated_at_order_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='description',
+            field=models.TextField(blank=True),
+        ),
+        migrations.RunPython(run_on_sqlite(SEARCH_INDEX_SQL), run_on_sqlite(DROP_SEARCH_INDEX_SQL)),
+    ]
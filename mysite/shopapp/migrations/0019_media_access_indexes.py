@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 06:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0018_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportjob',
+            name='file',
+            field=models.FileField(db_index=True, null=True, upload_to='exports/'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='receipt',
+            field=models.FileField(db_index=True, null=True, upload_to='orders/receipts/'),
+        ),
+    ]
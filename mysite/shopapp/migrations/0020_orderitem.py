@@ -0,0 +1,84 @@
+# Generated by Django 4.2 on 2026-10-18 07:05
+
+from decimal import ROUND_HALF_UP, Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def snapshot_prices(apps, schema_editor):
+    """
+    Строкам существующих заказов - текущие цену и скидку товара, заказам - сумму.
+    """
+    OrderItem = apps.get_model('shopapp', 'OrderItem')
+    Order = apps.get_model('shopapp', 'Order')
+    Product = apps.get_model('shopapp', 'Product')
+    prices = {
+        pk: (price, discount)
+        for pk, price, discount in Product.objects.values_list('pk', 'price', 'discount').iterator()
+    }
+    items = []
+    totals = {}
+    for item in OrderItem.objects.only('pk', 'order_id', 'product_id').iterator():
+        item.unit_price, item.discount = prices[item.product_id]
+        items.append(item)
+        discount = min(max(item.discount, 0), 100)
+        line = (Decimal(item.unit_price) * (100 - discount) / 100).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        totals[item.order_id] = totals.get(item.order_id, Decimal('0')) + line
+    OrderItem.objects.bulk_update(items, ['unit_price', 'discount'], batch_size=1000)
+    Order.objects.bulk_update(
+        [Order(pk=pk, total=total) for pk, total in totals.items()], ['total'], batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopapp', '0019_media_access_indexes'),
+    ]
+
+    operations = [
+        # таблица связи уже есть: модель строки заказа занимает её, ничего не пересоздавая
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='OrderItem',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='shopapp.order')),
+                        ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_items', to='shopapp.product')),
+                    ],
+                    options={
+                        'db_table': 'shopapp_order_products',
+                        'unique_together': {('order', 'product')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='order',
+                    name='products',
+                    field=models.ManyToManyField(related_name='orders', through='shopapp.OrderItem', to='shopapp.product'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='quantity',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=8),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='discount',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.RunPython(snapshot_prices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2 on 2026-10-18 06:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('shopapp', '0021_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerSegment',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='segment', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('last_order_at', models.DateTimeField()),
+                ('frequency', models.PositiveIntegerField()),
+                ('monetary', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('r_score', models.PositiveSmallIntegerField()),
+                ('f_score', models.PositiveSmallIntegerField()),
+                ('m_score', models.PositiveSmallIntegerField()),
+                ('segment', models.CharField(choices=[('champions', 'Champions'), ('loyal', 'Loyal'), ('new', 'New'), ('promising', 'Promising'), ('at_risk', 'At risk'), ('hibernating', 'Hibernating'), ('need_attention', 'Need attention')], db_index=True, max_length=20)),
+                ('computed_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SegmentationRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('full', models.BooleanField(default=True)),
+                ('started_at', models.DateTimeField()),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('users', models.PositiveIntegerField(default=0)),
+                ('edges', models.JSONField(default=dict)),
+            ],
+        ),
+    ]
@@ -1,3 +1,5 @@
+from decimal import ROUND_HALF_UP, Decimal
+
 from django.contrib.auth.models import User
 from django.db import models
 from django.urls import reverse
@@ -16,15 +18,28 @@ class Product(models.Model):
     """
     class Meta:
         ordering = ["name", "price"]
+        indexes = [
+            # сортировка по умолчанию и keyset-пагинация API; покрывает и поиск по name
+            models.Index(fields=["name", "price", "id"], name="product_ordering_idx"),
+            # лента и карта сайта: только неархивные товары по дате
+            models.Index(fields=["created_at"], condition=models.Q(archived=False), name="product_live_created_idx"),
+        ]
 
-    name = models.CharField(max_length=100, db_index=True)
-    description = models.TextField(null=False, blank=True, db_index=True)
+    name = models.CharField(max_length=100)
+    # артикул поставщика: естественный ключ для повторных импортов каталога
+    sku = models.CharField(max_length=64, null=True, blank=True, unique=True)
+    # поиск по описанию идёт через FTS5 (shopapp.search), обычный индекс по TextField ему не помогает
+    description = models.TextField(null=False, blank=True)
     price = models.DecimalField(default=0, max_digits=8, decimal_places=2)
     discount = models.SmallIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    # для условных GET-запросов (ETag / Last-Modified)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     created_by = models.ForeignKey(User, on_delete=models.PROTECT)
     archived = models.BooleanField(default=False)
     preview = models.ImageField(null=True, blank=True, upload_to=product_preview_directory_path)
+    # уменьшенные копии превью для srcset, их строит shopapp.images
+    preview_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return f"Product(pk={self.pk}, name={self.name!r})"
@@ -41,15 +56,217 @@ class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to=product_images_directory_path)
     description = models.CharField(max_length=200, null=False, blank=True)
+    variants = models.JSONField(default=dict, blank=True, editable=False)
 
 
 class Order(models.Model):
+    class Meta:
+        indexes = [
+            # заказы пользователя по порядку; заменяет обычный индекс внешнего ключа
+            models.Index(fields=["user", "id"], name="order_user_idx"),
+        ]
+
     delivery_address = models.TextField(null=True, blank=True)
     promocode = models.CharField(max_length=20, null=False, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    user = models.ForeignKey(User, on_delete=models.PROTECT)
-    products = models.ManyToManyField(Product, related_name="orders")
-    receipt = models.FileField(null=True, upload_to='orders/receipts/')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    user = models.ForeignKey(User, on_delete=models.PROTECT, db_index=False)
+    products = models.ManyToManyField(Product, related_name="orders", through="OrderItem")
+    # сумма строк заказа, пересчитывается при каждой их записи (shopapp.orders.update_totals)
+    total = models.DecimalField(default=0, max_digits=12, decimal_places=2, editable=False)
+    # индекс нужен отдаче медиафайлов: по имени файла ищется заказ, чтобы проверить права
+    receipt = models.FileField(null=True, upload_to='orders/receipts/', db_index=True)
 
     def get_absolute_url(self):
         return reverse('shopapp:order_details', kwargs={'pk': self.pk})
+
+
+def line_total(quantity: int, unit_price: Decimal, discount: int) -> Decimal:
+    """
+    Стоимость строки заказа: discount - скидка в процентах.
+    """
+    # в каталоге встречаются скидки больше 100%: строка заказа дешевле нуля не бывает
+    discount = min(max(discount, 0), 100)
+    total = Decimal(quantity) * Decimal(unit_price) * (100 - discount) / 100
+    return total.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+class OrderItem(models.Model):
+    """
+    Строка заказа: цена и скидка товара фиксируются на момент заказа.
+
+    Таблица та же, что была у связи Order.products без through-модели.
+    """
+    class Meta:
+        db_table = "shopapp_order_products"
+        unique_together = [("order", "product")]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="items")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="order_items")
+    quantity = models.PositiveIntegerField(default=1)
+    # add()/set() через Order.products не знают цену: её проставляет сигнал m2m_changed
+    unit_price = models.DecimalField(default=0, max_digits=8, decimal_places=2)
+    discount = models.SmallIntegerField(default=0)
+
+    def __str__(self):
+        return f"OrderItem(order={self.order_id}, product={self.product_id}, quantity={self.quantity})"
+
+    @property
+    def total(self) -> Decimal:
+        return line_total(self.quantity, self.unit_price, self.discount)
+
+
+class DailySales(models.Model):
+    """
+    Итоги продаж за день (по дате заказа в TIME_ZONE).
+
+    Сводная таблица для отчётов, строится из заказов в `shopapp.rollups`.
+    """
+    date = models.DateField(primary_key=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(default=0, max_digits=14, decimal_places=2)
+
+
+class ProductDailySales(models.Model):
+    """
+    Продажи товара за день: заказы с товаром, штуки и выручка по строкам заказов.
+    """
+    class Meta:
+        unique_together = [("date", "product")]
+        indexes = [
+            # отчёт по одному товару за период; заменяет обычный индекс внешнего ключа
+            models.Index(fields=["product", "date"], name="product_sales_idx"),
+        ]
+
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="daily_sales", db_index=False)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(default=0, max_digits=14, decimal_places=2)
+
+
+class SalesRollupDirtyDay(models.Model):
+    """
+    День, заказы которого менялись после последнего пересчёта сводок.
+    """
+    date = models.DateField(primary_key=True)
+    # пересчёт снимает пометку, только если её не обновили, пока он шёл
+    marked_at = models.DateTimeField()
+
+
+class CustomerSegment(models.Model):
+    """
+    RFM-сегмент покупателя: давность последнего заказа, число заказов и их сумма,
+    баллы 1-5 по квинтилям среди всех покупателей и метка сегмента.
+
+    Считается сразу для всех покупателей в `shopapp.segments`.
+    """
+    SEGMENT_CHOICES = [
+        ("champions", "Champions"),
+        ("loyal", "Loyal"),
+        ("new", "New"),
+        ("promising", "Promising"),
+        ("at_risk", "At risk"),
+        ("hibernating", "Hibernating"),
+        ("need_attention", "Need attention"),
+    ]
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="segment")
+    last_order_at = models.DateTimeField()
+    frequency = models.PositiveIntegerField()
+    monetary = models.DecimalField(max_digits=14, decimal_places=2)
+    r_score = models.PositiveSmallIntegerField()
+    f_score = models.PositiveSmallIntegerField()
+    m_score = models.PositiveSmallIntegerField()
+    segment = models.CharField(max_length=20, choices=SEGMENT_CHOICES, db_index=True)
+    computed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"CustomerSegment(user={self.user_id}, segment={self.segment!r})"
+
+
+class SegmentationRun(models.Model):
+    """
+    Прогон сегментации. Полный прогон хранит границы квинтилей, по которым
+    инкрементальные прогоны оценивают покупателей с новыми заказами.
+    """
+    full = models.BooleanField(default=True)
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True)
+    users = models.PositiveIntegerField(default=0)
+    # {"recency": [...], "frequency": [...], "monetary": [...]}: по четыре границы на признак
+    edges = models.JSONField(default=dict)
+
+
+class ProductRecommendation(models.Model):
+    """
+    «С этим товаром покупают»: товар, который чаще других оказывался в одном заказе с product.
+
+    Для каждого товара хранятся первые K соседей по числу общих заказов,
+    rank 0 - самый частый. Строит и обновляет `shopapp.recommendations`.
+    """
+    class Meta:
+        constraints = [
+            # рекомендации товара - один проход по индексу (product, rank)
+            models.UniqueConstraint(fields=["product", "rank"], name="product_recommendation_rank_uniq"),
+        ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="recommendations", db_index=False)
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    rank = models.PositiveSmallIntegerField()
+    # заказы, в которых оба товара
+    orders = models.PositiveIntegerField()
+
+
+class RecommendationDirtyProduct(models.Model):
+    """
+    Товар, заказы с которым менялись после последнего пересчёта его рекомендаций.
+    """
+    # не внешний ключ: пометку ставят и при каскадном удалении строк самого товара
+    product_id = models.BigIntegerField(primary_key=True)
+    marked_at = models.DateTimeField()
+
+
+class ExportJob(models.Model):
+    """
+    Фоновая выгрузка заказов или товаров в сжатый файл под MEDIA_ROOT.
+
+    Выполняется воркером из `shopapp.jobs`, прогресс пишется в кэш.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    KIND_CHOICES = [
+        ('orders', 'Orders'),
+        ('products', 'Products'),
+    ]
+    FORMAT_CHOICES = [
+        ('csv', 'CSV'),
+        ('ndjson', 'NDJSON'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default='csv')
+    # query string с теми же фильтрами, что понимает соответствующий viewset
+    query = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    rows_total = models.PositiveIntegerField(null=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    file = models.FileField(null=True, upload_to='exports/', db_index=True)
+    error = models.TextField(blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # когда воркер забрал задачу; зависшую в running задачу (воркер умер) run_export_jobs ставит заново
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"ExportJob(pk={self.pk}, kind={self.kind!r}, status={self.status!r})"
@@ -0,0 +1,226 @@
+"""
+Массовое создание заказов, добавление товаров в заказы и суммы заказов.
+
+Партнёры присылают тысячи заказов за раз, поэтому всё делается пачкой:
+заказы создаются одним bulk_create в одной транзакции, их товары - одним
+bulk_create по through-таблице ``Order.products``. Товары и пользователи,
+на которые ссылаются заказы, проверяются одним запросом на всю пачку:
+несуществующий или архивный товар - ошибка заказа, и тогда не создаётся ни
+один заказ пачки.
+
+Строка заказа (``OrderItem``) хранит цену и скидку товара на момент заказа,
+а ``Order.total`` - сумму строк. Её пересчитывает ``update_totals`` при
+каждой записи строк; при массовом создании сумма считается сразу, по ценам
+из того же запроса, которым проверялись товары. Обе записи помечают дни
+заказов для пересчёта сводок продаж (``shopapp.rollups``), а их товары - для
+пересчёта рекомендаций (``shopapp.recommendations``).
+
+bulk_create сигналов (и m2m_changed) не шлёт, версии кэша сбрасываются здесь.
+"""
+from collections import Counter
+from decimal import Decimal
+from typing import Iterable
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .caching import bump, bump_rows, bump_user_orders, model_tag
+from .models import Order, OrderItem, Product, line_total
+from .recommendations import mark_products
+from .rollups import mark_instances, mark_orders
+
+BULK_ORDER_BATCH_SIZE = getattr(settings, "SHOPAPP_BULK_ORDER_BATCH_SIZE", 1000)
+
+
+def max_bulk_orders() -> int:
+    return getattr(settings, "SHOPAPP_MAX_BULK_ORDERS", 10000)
+
+
+class BulkOrderError(Exception):
+    """
+    Пачка не прошла проверку; ``errors`` - по словарю ошибок на заказ, как у DRF с many=True.
+    """
+
+    def __init__(self, errors: list):
+        super().__init__(f"{sum(1 for error in errors if error)} of {len(errors)} orders are invalid")
+        self.errors = errors
+
+
+def live_products(product_ids: Iterable[int]) -> dict:
+    """
+    Цены и скидки существующих неархивных товаров из переданных - одним запросом.
+
+    ``{pk: (price, discount)}``
+    """
+    product_ids = set(product_ids)
+    if not product_ids:
+        return {}
+    rows = Product.objects.filter(pk__in=product_ids, archived=False).values_list("pk", "price", "discount")
+    return {pk: (price, discount) for pk, price, discount in rows}
+
+
+def product_errors(product_ids: Iterable[int], live: dict) -> list:
+    unknown = sorted(set(product_ids) - live.keys())
+    if not unknown:
+        return []
+    return [f"Unknown or archived products: {', '.join(map(str, unknown))}."]
+
+
+def build_items(order: Order, quantities: dict, prices: dict) -> list:
+    """
+    Строки заказа по ``{product_id: quantity}`` с ценами из ``prices``; заодно считает order.total.
+    """
+    items = []
+    total = Decimal("0")
+    for product_id, quantity in quantities.items():
+        price, discount = prices[product_id]
+        items.append(OrderItem(
+            order=order, product_id=product_id, quantity=quantity, unit_price=price, discount=discount,
+        ))
+        total += line_total(quantity, price, discount)
+    order.total = total
+    return items
+
+
+def validate_orders(orders: list, live: dict) -> list:
+    """
+    Ошибки по каждому заказу пачки (пустой словарь - заказ в порядке); ``live`` - из live_products().
+    """
+    user_ids = {order["user_id"] for order in orders if order.get("user_id") is not None}
+    users = set(User.objects.filter(pk__in=user_ids).values_list("pk", flat=True)) if user_ids else set()
+    errors = []
+    for order in orders:
+        error = {}
+        if order.get("user_id") is None:
+            error["user"] = ["This field is required."]
+        elif order["user_id"] not in users:
+            error["user"] = [f"Unknown user {order['user_id']}."]
+        if not order["products"]:
+            error["products"] = ["This list may not be empty."]
+        else:
+            messages = product_errors(order["products"], live)
+            if messages:
+                error["products"] = messages
+        errors.append(error)
+    return errors
+
+
+def attach_items(items: list, batch_size: int = BULK_ORDER_BATCH_SIZE, ignore_conflicts: bool = False) -> int:
+    """
+    Вставляет строки заказов в through-таблицу одним bulk_create.
+    """
+    OrderItem.objects.bulk_create(items, batch_size=batch_size, ignore_conflicts=ignore_conflicts)
+    return len(items)
+
+
+def update_totals(order_ids: Iterable[int], batch_size: int = BULK_ORDER_BATCH_SIZE):
+    """
+    Пересчитывает Order.total (и сдвигает updated_at) по строкам заказов: запрос строк и bulk_update.
+    """
+    totals = dict.fromkeys(set(order_ids), Decimal("0"))
+    if not totals:
+        return
+    product_ids = set()
+    items = (
+        OrderItem.objects
+        .filter(order_id__in=totals.keys())
+        .values_list("order_id", "product_id", "quantity", "unit_price", "discount")
+        .iterator(chunk_size=batch_size)
+    )
+    for order_id, product_id, quantity, unit_price, discount in items:
+        totals[order_id] += line_total(quantity, unit_price, discount)
+        product_ids.add(product_id)
+    now = timezone.now()
+    Order.objects.bulk_update(
+        [Order(pk=pk, total=total, updated_at=now) for pk, total in totals.items()],
+        ["total", "updated_at"],
+        batch_size=batch_size,
+    )
+    # выручка этих заказов изменилась - их дни в сводках продаж устарели
+    mark_orders(totals.keys())
+    # как и рекомендации товаров этих заказов
+    mark_products(product_ids)
+
+
+def snapshot_prices(order_ids: Iterable[int], product_ids: Iterable[int]):
+    """
+    Строкам, добавленным через Order.products.add()/set(), - текущие цену и скидку товара.
+    """
+    product = Product.objects.filter(pk=OuterRef("product_id"))
+    (
+        OrderItem.objects
+        .filter(order_id__in=list(order_ids), product_id__in=list(product_ids))
+        .update(
+            unit_price=Subquery(product.values("price")[:1]),
+            discount=Subquery(product.values("discount")[:1]),
+        )
+    )
+
+
+def create_orders(orders: list, batch_size: int = BULK_ORDER_BATCH_SIZE) -> list:
+    """
+    Создаёт заказы пачкой; ``orders`` - словари с ключами user_id, products
+    (список pk товаров, повтор товара увеличивает количество) и
+    необязательными delivery_address, promocode.
+
+    Все заказы создаются в одной транзакции или ни один (``BulkOrderError``).
+    """
+    with transaction.atomic():
+        # проверка внутри транзакции: товар не заархивируют между ней и вставкой незаметно
+        prices = live_products(pk for order in orders for pk in order["products"])
+        errors = validate_orders(orders, prices)
+        if any(errors):
+            raise BulkOrderError(errors)
+        instances = [
+            Order(
+                user_id=order["user_id"],
+                delivery_address=order.get("delivery_address") or "",
+                promocode=order.get("promocode") or "",
+            )
+            for order in orders
+        ]
+        items = [
+            build_items(instance, Counter(order["products"]), prices)
+            for instance, order in zip(instances, orders)
+        ]
+        created = Order.objects.bulk_create(instances, batch_size=batch_size)
+        attach_items([item for order_items in items for item in order_items], batch_size=batch_size)
+        mark_instances(created)
+        mark_products(pk for order in orders for pk in order["products"])
+        bump(model_tag(Order))
+        bump_user_orders(order["user_id"] for order in orders)
+    return created
+
+
+def add_products(order_ids: list, product_ids: list, batch_size: int = BULK_ORDER_BATCH_SIZE) -> int:
+    """
+    Добавляет товары в заказы; уже добавленные пропускаются. Возвращает число заказов.
+    """
+    quantities = Counter(product_ids)
+    with transaction.atomic():
+        prices = live_products(quantities)
+        messages = product_errors(quantities, prices)
+        if messages:
+            raise BulkOrderError([{"products": messages}])
+        order_ids = list(Order.objects.filter(pk__in=order_ids).values_list("pk", flat=True))
+        # уникальный индекс (order_id, product_id) отсекает повторы без лишнего SELECT
+        attach_items(
+            [item for order_id in order_ids for item in build_items(Order(pk=order_id), quantities, prices)],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+        update_totals(order_ids, batch_size=batch_size)
+        bump_rows(Order, order_ids)
+        bump_user_orders(Order.objects.filter(pk__in=order_ids).values_list("user_id", flat=True))
+    return len(order_ids)
+
+
+def default_products() -> list:
+    """
+    pk всех неархивных товаров (товары заказа по умолчанию в командах).
+    """
+    return list(Product.objects.filter(archived=False).values_list("pk", flat=True))
+
@@ -0,0 +1,208 @@
+"""
+Keyset-пагинация для API магазина.
+
+Вместо OFFSET следующая страница выбирается условием "после последней
+записи предыдущей страницы" по полям сортировки с pk на конце, поэтому
+стоимость страницы не зависит от глубины прокрутки. Курсор непрозрачный
+и подписанный. Общее количество не считается, но по ``?with_count=1``
+отдаётся приблизительное значение из кэша.
+"""
+import hashlib
+
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .search import RANK_ANNOTATION
+
+CURSOR_SALT = "shopapp.pagination.cursor"
+
+
+class KeysetPagination(BasePagination):
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    count_query_param = "with_count"
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    count_cache_timeout = 60 * 5
+
+    # старые клиенты, которые ходят по ?page=N, продолжают получать постраничную выдачу
+    legacy_page_query_param = "page"
+    legacy_pagination_class = PageNumberPagination
+
+    def paginate_queryset(self, queryset: QuerySet, request, view=None):
+        self.request = request
+        self.legacy = None
+        if self.legacy_page_query_param in request.query_params:
+            self.legacy = self.legacy_pagination_class()
+            return self.legacy.paginate_queryset(queryset, request, view)
+
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.count = self.get_approximate_count(request, queryset, view)
+
+        values, reverse = self.decode_cursor(request)
+        queryset = queryset.order_by(*self.ordering_terms(reverse))
+        if values is not None:
+            queryset = queryset.filter(self.keyset_filter(values, reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        if reverse:
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+        self.next_item = results[-1] if results and has_next else None
+        self.previous_item = results[0] if results and has_previous else None
+        return results
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_ordering(self, request, queryset: QuerySet, view) -> list:
+        """
+        Список (attname, descending) из разрешённых ordering_fields, с pk в конце для однозначности.
+
+        Поля, по которым keyset невозможен (many-to-many, nullable), отбрасываются.
+        Результаты полнотекстового поиска без явного ?ordering= идут по релевантности.
+        """
+        terms = OrderingFilter().get_ordering(request, queryset, view)
+        if not terms and RANK_ANNOTATION in queryset.query.annotations:
+            return [(RANK_ANNOTATION, False), ("pk", False)]
+        terms = terms or queryset.model._meta.ordering
+        ordering = []
+        for term in terms:
+            name = term.lstrip("-")
+            if name == "pk":
+                break
+            try:
+                field = queryset.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if not field.concrete or field.many_to_many or field.null:
+                continue
+            ordering.append((field.attname, term.startswith("-")))
+        ordering.append(("pk", False))
+        return ordering
+
+    def ordering_terms(self, reverse: bool) -> list:
+        return [
+            f"-{name}" if descending != reverse else name
+            for name, descending in self.ordering
+        ]
+
+    def keyset_filter(self, values: list, reverse: bool) -> Q:
+        # (a, b, pk) > (x, y, z)  ==>  a > x OR (a = x AND b > y) OR (a = x AND b = y AND pk > z)
+        condition = Q()
+        equal = Q()
+        for (name, descending), value in zip(self.ordering, values):
+            lookup = "lt" if descending != reverse else "gt"
+            condition |= equal & Q(**{f"{name}__{lookup}": value})
+            equal &= Q(**{name: value})
+        # избыточное условие на первое поле даёт планировщику диапазон по индексу вместо
+        # перебора с начала: по одному OR индекс не используется
+        (name, descending), value = self.ordering[0], values[0]
+        return Q(**{f"{name}__{'lte' if descending != reverse else 'gte'}": value}) & condition
+
+    def encode_cursor(self, item, reverse: bool) -> str:
+        values = [getattr(item, name) for name, descending in self.ordering]
+        return signing.dumps(
+            {"v": [str(value) for value in values], "r": reverse},
+            salt=CURSOR_SALT,
+            compress=True,
+        )
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            payload = signing.loads(token, salt=CURSOR_SALT)
+            values = payload["v"]
+            if len(values) != len(self.ordering):
+                raise ValueError("cursor does not match ordering")
+        except (ValueError, KeyError, TypeError, signing.BadSignature):
+            raise NotFound("Invalid cursor")
+        return values, bool(payload["r"])
+
+    def get_approximate_count(self, request, queryset: QuerySet, view):
+        if request.query_params.get(self.count_query_param) not in ("1", "true"):
+            return None
+        params = sorted(
+            (key, value)
+            for key, value in request.query_params.lists()
+            if key not in (self.cursor_query_param, self.page_size_query_param)
+        )
+        digest = hashlib.md5(repr(params).encode()).hexdigest()
+        cache_key = f"approximate_count:{queryset.model._meta.label_lower}:{digest}"
+        return cache.get_or_set(cache_key, queryset.count, self.count_cache_timeout)
+
+    def get_link(self, item, reverse: bool):
+        if item is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.legacy_page_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(item, reverse))
+
+    def get_paginated_response(self, data):
+        if self.legacy is not None:
+            return self.legacy.get_paginated_response(data)
+        response = {
+            "next": self.get_link(self.next_item, reverse=False),
+            "previous": self.get_link(self.previous_item, reverse=True),
+            "results": data,
+        }
+        if self.count is not None:
+            response = {"count": self.count, **response}
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "count": {"type": "integer", "nullable": True},
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                "name": self.cursor_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Opaque cursor from the next/previous link",
+                "schema": {"type": "string"},
+            },
+            {
+                "name": self.page_size_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Number of results to return per page",
+                "schema": {"type": "integer"},
+            },
+            {
+                "name": self.count_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Include a cached approximate total",
+                "schema": {"type": "boolean"},
+            },
+        ]
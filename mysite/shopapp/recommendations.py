@@ -0,0 +1,292 @@
+"""
+«С этим товаром покупают»: по корзинам заказов (строки ``Order.products``)
+для каждого товара хранятся K товаров, чаще всего покупавшихся вместе с ним
+(``ProductRecommendation``).
+
+Построение читает through-таблицу потоком, кусками целых заказов. Кусок
+превращается в массивы NumPy и без циклов по заказам разворачивается в пары
+(товар, товар из того же заказа); пары кодируются одним int64, а их счётчики
+копятся как разреженная матрица совместных покупок: отсортированные ключи
+ненулевых ячеек и их значения. Первые K соседей каждой строки матрицы
+выбираются одной сортировкой.
+
+Строка матрицы товара меняется, только когда меняются заказы с этим
+товаром. Поэтому каждая запись строк заказов (сигналы, ``shopapp.orders``,
+импорт CSV) в своей транзакции помечает их товары
+(``RecommendationDirtyProduct``), а после коммита фоновый поток
+пересчитывает только строки помеченных товаров - по заказам, в которых
+они есть. Записываются лишь товары, у которых рекомендации на самом деле
+изменились, и их ``updated_at`` сдвигается: страница товара их показывает.
+"""
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .caching import bump, row_tag
+from .models import OrderItem, Product, ProductRecommendation, RecommendationDirtyProduct
+
+log = logging.getLogger(__name__)
+
+RECOMMENDATION_CHUNK_SIZE = getattr(settings, "SHOPAPP_RECOMMENDATION_CHUNK_SIZE", 50000)
+RECOMMENDATION_BATCH_SIZE = getattr(settings, "SHOPAPP_RECOMMENDATION_BATCH_SIZE", 1000)
+
+# ключ пары: pk товара в старших 32 битах, pk соседа - в младших
+PAIR_SHIFT = 32
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+
+# один поток: пересчёты одного товара не идут параллельно
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recommendations")
+_scheduled = False
+_scheduled_lock = threading.Lock()
+
+
+def top_k() -> int:
+    return getattr(settings, "SHOPAPP_RECOMMENDATIONS_TOP_K", 10)
+
+
+def recommendations_async() -> bool:
+    # False - пересчитывать сразу после коммита в том же потоке (для тестов и разработки)
+    return getattr(settings, "SHOPAPP_RECOMMENDATIONS_ASYNC", True)
+
+
+def baskets(items: Iterable[tuple], chunk_size: int = RECOMMENDATION_CHUNK_SIZE) -> Iterator[tuple]:
+    """
+    Строки (order_id, product_id), упорядоченные по заказу, - кусками по chunk_size строк, не разрывая заказ.
+    """
+    order_ids, product_ids = [], []
+    for order_id, product_id in items:
+        if len(order_ids) >= chunk_size and order_id != order_ids[-1]:
+            yield np.array(order_ids, dtype=np.int64), np.array(product_ids, dtype=np.int64)
+            order_ids, product_ids = [], []
+        order_ids.append(order_id)
+        product_ids.append(product_id)
+    if order_ids:
+        yield np.array(order_ids, dtype=np.int64), np.array(product_ids, dtype=np.int64)
+
+
+def basket_pairs(order_ids: np.ndarray, product_ids: np.ndarray, products: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Ключи всех пар (товар, другой товар того же заказа); order_ids упорядочены.
+
+    ``products`` оставляет только пары, где первый товар - из них.
+    """
+    _, starts, sizes = np.unique(order_ids, return_index=True, return_counts=True)
+    # для каждой строки - начало и размер её заказа
+    item_starts = np.repeat(starts, sizes)
+    item_sizes = np.repeat(sizes, sizes)
+    if products is None:
+        sources = np.arange(len(order_ids))
+    else:
+        sources = np.flatnonzero(np.isin(product_ids, products))
+    source_sizes = item_sizes[sources]
+    # строка-источник повторяется по разу на каждую строку своего заказа
+    left = np.repeat(sources, source_sizes)
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(source_sizes) - source_sizes, source_sizes)
+    right = np.repeat(item_starts[sources], source_sizes) + offsets
+    # пара (заказ, товар) уникальна: разные строки заказа - разные товары
+    distinct = left != right
+    return (product_ids[left[distinct]] << PAIR_SHIFT) | product_ids[right[distinct]]
+
+
+class PairCounts:
+    """
+    Разреженная матрица совместных покупок: упорядоченные ключи пар и число заказов с каждой парой.
+
+    Куски сводятся к своим уникальным парам и копятся отдельно; с матрицей они
+    сливаются, только когда их набирается не меньше, чем в ней ячеек, - каждая
+    пара переписывается O(log n) раз, а не при каждом куске.
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def add(self, keys: np.ndarray):
+        if not len(keys):
+            return
+        keys, counts = np.unique(keys, return_counts=True)
+        self.pending.append((keys, counts))
+        self.pending_size += len(keys)
+        if self.pending_size >= max(len(self.keys), RECOMMENDATION_CHUNK_SIZE):
+            self.merge()
+
+    def merge(self):
+        if not self.pending:
+            return
+        keys = np.concatenate([self.keys] + [keys for keys, counts in self.pending])
+        counts = np.concatenate([self.counts] + [counts for keys, counts in self.pending])
+        self.pending, self.pending_size = [], 0
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.keys)).astype(np.int64)
+
+    def top(self, k: int) -> dict:
+        """
+        ``{product_id: [(recommended_id, orders), ...]}`` - первые k соседей по числу заказов, при равенстве - по pk.
+        """
+        self.merge()
+        left = self.keys >> PAIR_SHIFT
+        right = self.keys & PAIR_MASK
+        order = np.lexsort((right, -self.counts, left))
+        left, right, counts = left[order], right[order], self.counts[order]
+        starts = np.flatnonzero(np.r_[True, left[1:] != left[:-1]]) if len(left) else np.empty(0, dtype=np.int64)
+        ranks = np.arange(len(left)) - np.repeat(starts, np.diff(np.r_[starts, len(left)]))
+        keep = ranks < k
+        neighbours = defaultdict(list)
+        for product_id, recommended_id, count in zip(
+            left[keep].tolist(), right[keep].tolist(), counts[keep].tolist(),
+        ):
+            neighbours[product_id].append((recommended_id, count))
+        return neighbours
+
+
+def count_pairs(product_ids: Optional[list] = None, chunk_size: int = RECOMMENDATION_CHUNK_SIZE) -> PairCounts:
+    """
+    Матрица по всем заказам или только строки product_ids - по заказам, в которых эти товары есть.
+    """
+    items = OrderItem.objects.all()
+    products = None
+    if product_ids is not None:
+        items = items.filter(
+            order_id__in=OrderItem.objects.filter(product_id__in=product_ids).values("order_id"),
+        )
+        products = np.array(product_ids, dtype=np.int64)
+    pairs = PairCounts()
+    rows = items.order_by("order_id").values_list("order_id", "product_id").iterator(chunk_size=chunk_size)
+    for order_ids, basket_products in baskets(rows, chunk_size):
+        pairs.add(basket_pairs(order_ids, basket_products, products))
+    return pairs
+
+
+def save_recommendations(neighbours: dict, product_ids: Optional[list] = None,
+                         batch_size: int = RECOMMENDATION_BATCH_SIZE) -> list:
+    """
+    Записывает рекомендации товаров product_ids (None - всех), которые изменились. Возвращает их pk.
+    """
+    stored = ProductRecommendation.objects.order_by("product_id", "rank")
+    if product_ids is not None:
+        stored = stored.filter(product_id__in=product_ids)
+    current = defaultdict(list)
+    for product_id, recommended_id, count in stored.values_list("product_id", "recommended_id", "orders").iterator():
+        current[product_id].append((recommended_id, count))
+
+    candidates = set(current) | set(neighbours) if product_ids is None else set(product_ids)
+    changed = [pk for pk in candidates if current.get(pk, []) != neighbours.get(pk, [])]
+    if not changed:
+        return []
+    referenced = set(changed).union(
+        recommended_id for product_id in changed for recommended_id, count in neighbours.get(product_id, [])
+    )
+    with transaction.atomic():
+        # товары, удалённые после чтения заказов, пропускаем: их строки ушли каскадом
+        existing = set(Product.objects.filter(pk__in=referenced).values_list("pk", flat=True))
+        changed = [product_id for product_id in changed if product_id in existing]
+        ProductRecommendation.objects.filter(product_id__in=changed).delete()
+        ProductRecommendation.objects.bulk_create(
+            [
+                ProductRecommendation(product_id=product_id, recommended_id=recommended_id, rank=rank, orders=count)
+                for product_id in changed
+                for rank, (recommended_id, count) in enumerate(
+                    pair for pair in neighbours.get(product_id, []) if pair[0] in existing
+                )
+            ],
+            batch_size=batch_size,
+        )
+        # рекомендации - часть страницы товара, её Last-Modified должен сдвинуться
+        Product.objects.filter(pk__in=changed).update(updated_at=timezone.now())
+        bump(*(row_tag(Product, pk) for pk in changed))
+    return changed
+
+
+def rebuild_recommendations(chunk_size: int = RECOMMENDATION_CHUNK_SIZE) -> list:
+    """
+    Полное построение по всем заказам. Возвращает pk товаров, рекомендации которых изменились.
+    """
+    return save_recommendations(count_pairs(chunk_size=chunk_size).top(top_k()))
+
+
+def refresh_products(product_ids: list, chunk_size: int = RECOMMENDATION_CHUNK_SIZE) -> list:
+    return save_recommendations(count_pairs(product_ids, chunk_size=chunk_size).top(top_k()), product_ids)
+
+
+def refresh_dirty_products(batch_size: int = RECOMMENDATION_BATCH_SIZE) -> int:
+    """
+    Пересчитывает помеченные товары, пока пометки не кончатся. Возвращает число пересчитанных товаров.
+    """
+    refreshed = 0
+    while True:
+        marks = list(
+            RecommendationDirtyProduct.objects.order_by("product_id").values_list("product_id", "marked_at")[:batch_size]
+        )
+        if not marks:
+            return refreshed
+        refresh_products([product_id for product_id, marked_at in marks])
+        # товар, помеченный во время пересчёта, остаётся до следующего прохода
+        by_time = defaultdict(list)
+        for product_id, marked_at in marks:
+            by_time[marked_at].append(product_id)
+        for marked_at, product_ids in by_time.items():
+            RecommendationDirtyProduct.objects.filter(product_id__in=product_ids, marked_at=marked_at).delete()
+        refreshed += len(marks)
+
+
+def run_refresh_in_thread():
+    global _scheduled
+    with _scheduled_lock:
+        # пометки, сделанные с этого момента, запланируют следующий проход
+        _scheduled = False
+    try:
+        refresh_dirty_products()
+    except Exception:
+        log.exception("Refreshing product recommendations failed")
+    finally:
+        connection.close()
+
+
+def schedule_refresh():
+    global _scheduled
+    if not recommendations_async():
+        refresh_dirty_products()
+        return
+    with _scheduled_lock:
+        if _scheduled:
+            return
+        _scheduled = True
+    executor.submit(run_refresh_in_thread)
+
+
+def mark_products(product_ids: Iterable[int]):
+    """
+    Помечает товары в текущей транзакции; пересчёт их рекомендаций - после коммита.
+    """
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+    now = timezone.now()
+    RecommendationDirtyProduct.objects.bulk_create(
+        [RecommendationDirtyProduct(product_id=product_id, marked_at=now) for product_id in product_ids],
+        update_conflicts=True,
+        unique_fields=["product_id"],
+        update_fields=["marked_at"],
+    )
+    transaction.on_commit(schedule_refresh)
+
+
+def recommendations_for(product_id, limit: Optional[int] = None) -> list:
+    """
+    Рекомендации товара без архивных - один запрос по индексу (product, rank).
+    """
+    return list(
+        ProductRecommendation.objects
+        .filter(product_id=product_id, recommended__archived=False)
+        .select_related("recommended")
+        .order_by("rank")[:limit or top_k()]
+    )
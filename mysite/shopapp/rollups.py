@@ -0,0 +1,266 @@
+"""
+Сводные таблицы продаж для отчётов: итоги по дням (``DailySales``) и по
+товарам за день (``ProductDailySales``).
+
+Сводка дня всегда пересчитывается целиком из заказов этого дня, поэтому
+правки и удаления заказов учитываются так же, как новые заказы. Каждая
+запись заказов (сигналы, ``shopapp.orders``, импорт CSV) в своей же
+транзакции помечает день заказа грязным (``SalesRollupDirtyDay``), а после
+коммита пересчёт грязных дней уходит в единственный фоновый поток. Пометки,
+накопившиеся за время пересчёта, он забирает следующим проходом, так что
+тысяча заказов подряд - это несколько пересчётов, а не тысяча. Пометки
+лежат в базе и переживают перезапуск: оставшиеся дни пересчитает
+``rebuild_sales_rollups --dirty``.
+
+Отчёты (``sales_report``) читают только сводки: строк в них - по одной на
+день и на товар за день, сколько бы ни было заказов.
+"""
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate, TruncMonth, TruncWeek
+from django.utils import timezone
+
+from .caching import bump, model_tag
+from .models import DailySales, Order, OrderItem, ProductDailySales, SalesRollupDirtyDay, line_total
+
+log = logging.getLogger(__name__)
+
+ROLLUP_BATCH_SIZE = getattr(settings, "SHOPAPP_ROLLUP_BATCH_SIZE", 1000)
+
+GROUP_BY_PERIODS = {
+    "day": None,
+    "week": TruncWeek,
+    "month": TruncMonth,
+}
+GROUP_BY_CHOICES = (*GROUP_BY_PERIODS, "product")
+
+# один поток: пересчёты одного дня не идут параллельно
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sales-rollups")
+_scheduled = False
+_scheduled_lock = threading.Lock()
+
+
+def rollup_async() -> bool:
+    # False - пересчитывать сразу после коммита в том же потоке (для тестов и разработки)
+    return getattr(settings, "SHOPAPP_SALES_ROLLUP_ASYNC", True)
+
+
+def day_bounds(first: date, last: date) -> tuple:
+    """
+    [начало first, начало дня после last) в текущем часовом поясе.
+    """
+    start = timezone.make_aware(datetime.combine(first, time.min))
+    end = timezone.make_aware(datetime.combine(last + timedelta(days=1), time.min))
+    return start, end
+
+
+def refresh_range(first: date, last: date, batch_size: int = ROLLUP_BATCH_SIZE):
+    """
+    Пересчитывает сводки за дни с first по last включительно: два чтения и одна транзакция записи.
+    """
+    start, end = day_bounds(first, last)
+    days = defaultdict(lambda: [0, 0, Decimal("0")])
+    products = defaultdict(lambda: [0, 0, Decimal("0")])
+
+    orders = (
+        Order.objects
+        .filter(created_at__gte=start, created_at__lt=end)
+        .annotate(day=TruncDate("created_at"))
+        .values_list("day", "total")
+        .iterator(chunk_size=batch_size)
+    )
+    for day, total in orders:
+        days[day][0] += 1
+        days[day][2] += total
+
+    items = (
+        OrderItem.objects
+        .filter(order__created_at__gte=start, order__created_at__lt=end)
+        .annotate(day=TruncDate("order__created_at"))
+        .values_list("day", "product_id", "quantity", "unit_price", "discount")
+        .iterator(chunk_size=batch_size)
+    )
+    for day, product_id, quantity, unit_price, discount in items:
+        days[day][1] += quantity
+        row = products[day, product_id]
+        # пара (заказ, товар) в заказе одна, так что строка - это заказ с товаром
+        row[0] += 1
+        row[1] += quantity
+        row[2] += line_total(quantity, unit_price, discount)
+
+    with transaction.atomic():
+        DailySales.objects.filter(date__range=(first, last)).delete()
+        ProductDailySales.objects.filter(date__range=(first, last)).delete()
+        DailySales.objects.bulk_create(
+            [
+                DailySales(date=day, orders=count, units=units, revenue=revenue)
+                for day, (count, units, revenue) in days.items()
+            ],
+            batch_size=batch_size,
+        )
+        ProductDailySales.objects.bulk_create(
+            [
+                ProductDailySales(date=day, product_id=product_id, orders=count, units=units, revenue=revenue)
+                for (day, product_id), (count, units, revenue) in products.items()
+            ],
+            batch_size=batch_size,
+        )
+        bump(model_tag(DailySales))
+
+
+def refresh_dirty_days(batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+    """
+    Пересчитывает помеченные дни, пока пометки не кончатся. Возвращает число пересчитанных дней.
+    """
+    refreshed = 0
+    while True:
+        marks = list(
+            SalesRollupDirtyDay.objects.order_by("date").values_list("date", "marked_at")[:batch_size]
+        )
+        if not marks:
+            return refreshed
+        for day, marked_at in marks:
+            refresh_range(day, day, batch_size=batch_size)
+            # заказ, записанный во время пересчёта, обновил пометку - её оставляем до следующего прохода
+            SalesRollupDirtyDay.objects.filter(date=day, marked_at=marked_at).delete()
+        refreshed += len(marks)
+
+
+def run_refresh_in_thread():
+    global _scheduled
+    with _scheduled_lock:
+        # пометки, сделанные с этого момента, запланируют следующий проход
+        _scheduled = False
+    try:
+        refresh_dirty_days()
+    except Exception:
+        log.exception("Refreshing sales rollups failed")
+    finally:
+        connection.close()
+
+
+def schedule_refresh():
+    global _scheduled
+    if not rollup_async():
+        refresh_dirty_days()
+        return
+    with _scheduled_lock:
+        if _scheduled:
+            return
+        _scheduled = True
+    executor.submit(run_refresh_in_thread)
+
+
+def mark_days(days: Iterable[date]):
+    """
+    Помечает дни грязными в текущей транзакции; пересчёт - после коммита.
+    """
+    days = set(days)
+    if not days:
+        return
+    now = timezone.now()
+    # upsert, а не вставка с пропуском: строка пометки блокируется до коммита заказа
+    SalesRollupDirtyDay.objects.bulk_create(
+        [SalesRollupDirtyDay(date=day, marked_at=now) for day in days],
+        update_conflicts=True,
+        unique_fields=["date"],
+        update_fields=["marked_at"],
+    )
+    transaction.on_commit(schedule_refresh)
+
+
+def mark_orders(order_ids: Iterable[int]):
+    order_ids = set(order_ids)
+    if order_ids:
+        mark_days(
+            Order.objects
+            .filter(pk__in=order_ids)
+            .annotate(day=TruncDate("created_at"))
+            .values_list("day", flat=True)
+            .distinct()
+        )
+
+
+def mark_instances(orders: Iterable[Order]):
+    mark_days(timezone.localdate(order.created_at) for order in orders if order.created_at)
+
+
+def order_date_range() -> Optional[tuple]:
+    """
+    Дни первого и последнего заказа или None, если заказов нет.
+    """
+    days = Order.objects.annotate(day=TruncDate("created_at")).values_list("day", flat=True)
+    first = days.order_by("created_at").first()
+    if first is None:
+        return None
+    return first, days.order_by("-created_at").first()
+
+
+def split_range(first: date, last: date, days: int) -> list:
+    chunks = []
+    while first <= last:
+        chunk_last = min(first + timedelta(days=days - 1), last)
+        chunks.append((first, chunk_last))
+        first = chunk_last + timedelta(days=1)
+    return chunks
+
+
+def sales_report(date_from: date, date_to: date, group_by: str = "day", product: Optional[int] = None,
+                 limit: int = 100) -> dict:
+    """
+    Отчёт по сводкам за период: строки по дням/неделям/месяцам или по товарам и итог.
+
+    ``product`` ограничивает отчёт одним товаром (кроме группировки по товарам).
+    """
+    if product is not None or group_by == "product":
+        source = ProductDailySales.objects.filter(date__range=(date_from, date_to))
+        if product is not None:
+            source = source.filter(product_id=product)
+    else:
+        source = DailySales.objects.filter(date__range=(date_from, date_to))
+    sums = {"orders": Sum("orders"), "units": Sum("units"), "revenue": Sum("revenue")}
+
+    if group_by == "product":
+        rows = (
+            source.values("product", "product__name")
+            .annotate(**sums)
+            .order_by("-revenue", "product")[:limit]
+        )
+        results = [
+            {"product": row["product"], "name": row["product__name"], **{name: row[name] for name in sums}}
+            for row in rows
+        ]
+    elif GROUP_BY_PERIODS[group_by] is None:
+        results = [
+            {"period": row["date"], **{name: row[name] for name in sums}}
+            for row in source.order_by("date").values("date", *sums)
+        ]
+    else:
+        rows = (
+            source.annotate(period=GROUP_BY_PERIODS[group_by]("date"))
+            .values("period")
+            .annotate(**sums)
+            .order_by("period")
+        )
+        results = [{"period": row["period"], **{name: row[name] for name in sums}} for row in rows]
+
+    if product is None and group_by == "product":
+        # итог по всем заказам периода, а не только по товарам из первых limit
+        source = DailySales.objects.filter(date__range=(date_from, date_to))
+    totals = source.aggregate(**{name: Sum(name, default=0) for name in sums})
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "group_by": group_by,
+        "totals": totals,
+        "results": results,
+    }
@@ -0,0 +1,152 @@
+"""
+Полнотекстовый поиск по товарам и заказам на SQLite FTS5.
+
+Для каждой модели из ``SEARCH_INDEXES`` заводится external-content таблица
+FTS5 (``<db_table>_fts``): сам текст хранится только в исходной таблице,
+а индекс поддерживают триггеры на INSERT/UPDATE/DELETE. Поэтому он не
+отстаёт ни при обычном save(), ни при bulk_create/bulk_update/update()
+из импорта CSV, которые сигналов не шлют.
+
+Django на SQLite пересоздаёт таблицу при многих ALTER, а вместе с ней
+пропадают и триггеры, поэтому после каждого migrate ``ensure_search_indexes``
+возвращает недостающие триггеры и перестраивает индекс.
+
+На других базах поиск откатывается к обычному ``icontains`` от SearchFilter.
+"""
+import re
+
+from django.db import connections
+from django.db.models import FloatField, QuerySet
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import SearchFilter
+
+from .models import Order, Product
+
+SEARCH_INDEXES = {
+    Product: ("name", "description"),
+    Order: ("delivery_address",),
+}
+
+RANK_ANNOTATION = "search_rank"
+
+TOKENIZER = "unicode61 remove_diacritics 2"
+
+
+def fts_table(model) -> str:
+    return f"{model._meta.db_table}_fts"
+
+
+def trigger_names(model) -> list:
+    table = fts_table(model)
+    return [f"{table}_ai", f"{table}_ad", f"{table}_au"]
+
+
+def index_statements(model) -> list:
+    source = model._meta.db_table
+    table = fts_table(model)
+    columns = ", ".join(SEARCH_INDEXES[model])
+    new_values = ", ".join(f"new.{column}" for column in SEARCH_INDEXES[model])
+    old_values = ", ".join(f"old.{column}" for column in SEARCH_INDEXES[model])
+    insert_new = f"INSERT INTO {table}(rowid, {columns}) VALUES (new.id, {new_values});"
+    delete_old = f"INSERT INTO {table}({table}, rowid, {columns}) VALUES ('delete', old.id, {old_values});"
+    inserted, deleted, updated = trigger_names(model)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+        f"{columns}, content='{source}', content_rowid='id', tokenize='{TOKENIZER}')",
+        f"CREATE TRIGGER IF NOT EXISTS {inserted} AFTER INSERT ON {source} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {deleted} AFTER DELETE ON {source} BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {updated} AFTER UPDATE OF {columns} ON {source} "
+        f"BEGIN {delete_old} {insert_new} END",
+    ]
+
+
+def existing_objects(cursor, names) -> set:
+    placeholders = ", ".join(["%s"] * len(names))
+    cursor.execute(f"SELECT name FROM sqlite_master WHERE name IN ({placeholders})", list(names))
+    return {name for name, in cursor.fetchall()}
+
+
+def ensure_search_indexes(using: str = "default", rebuild: bool = False) -> list:
+    """
+    Создаёт недостающие таблицы FTS5 и триггеры; если чего-то не хватало, перестраивает индекс.
+
+    Возвращает модели, индекс которых был перестроен.
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return []
+    rebuilt = []
+    with connection.cursor() as cursor:
+        for model in SEARCH_INDEXES:
+            names = [model._meta.db_table, fts_table(model), *trigger_names(model)]
+            existing = existing_objects(cursor, names)
+            if model._meta.db_table not in existing:
+                # миграции приложения ещё не применены
+                continue
+            if len(existing) == len(names) and not rebuild:
+                continue
+            for statement in index_statements(model):
+                cursor.execute(statement)
+            cursor.execute(f"INSERT INTO {fts_table(model)}({fts_table(model)}) VALUES ('rebuild')")
+            rebuilt.append(model)
+    return rebuilt
+
+
+def drop_search_indexes(using: str = "default"):
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for model in SEARCH_INDEXES:
+            for trigger in trigger_names(model):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            cursor.execute(f"DROP TABLE IF EXISTS {fts_table(model)}")
+
+
+def match_expression(term: str) -> str:
+    """
+    Превращает пользовательский ввод в запрос FTS5: все слова обязательны, каждое как префикс.
+
+    Слова берутся в кавычки, так что операторы FTS5 (AND, NEAR, "*", ":") из ввода не действуют.
+    """
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", term))
+
+
+def supports_full_text(queryset: QuerySet) -> bool:
+    return queryset.model in SEARCH_INDEXES and connections[queryset.db].vendor == "sqlite"
+
+
+def full_text_search(queryset: QuerySet, term: str, rank: bool = True) -> QuerySet:
+    """
+    Оставляет записи, подходящие под ``term``.
+
+    С ``rank=True`` добавляет аннотацию ``search_rank`` (bm25, чем меньше, тем лучше)
+    и сортирует по ней.
+    """
+    query = match_expression(term)
+    if not query:
+        return queryset
+    model = queryset.model
+    table = fts_table(model)
+    queryset = queryset.filter(pk__in=RawSQL(f"SELECT rowid FROM {table} WHERE {table} MATCH %s", (query,)))
+    if not rank:
+        return queryset
+    # rowid = ... позволяет FTS5 не перебирать весь список совпадений для каждой строки
+    rank_sql = f"SELECT rank FROM {table} WHERE {table} MATCH %s AND rowid = {model._meta.db_table}.id"
+    return (
+        queryset
+        .annotate(**{RANK_ANNOTATION: RawSQL(rank_sql, (query,), output_field=FloatField())})
+        .order_by(RANK_ANNOTATION, "pk")
+    )
+
+
+class FullTextSearchFilter(SearchFilter):
+    """
+    SearchFilter с тем же параметром ``?search=``, но через индекс FTS5 и с сортировкой по релевантности.
+
+    Явный ``?ordering=`` сортировку по релевантности отменяет.
+    """
+    def filter_queryset(self, request, queryset, view):
+        if not supports_full_text(queryset):
+            return super().filter_queryset(request, queryset, view)
+        return full_text_search(queryset, " ".join(self.get_search_terms(request)))
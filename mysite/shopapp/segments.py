@@ -0,0 +1,251 @@
+"""
+RFM-сегментация покупателей: recency (дней с последнего заказа), frequency
+(число заказов) и monetary (сумма ``Order.total``).
+
+Заказы не перебираются в Python: база одним GROUP BY по ``user_id`` сводит
+их к строке на покупателя, эти строки грузятся в столбцы NumPy, а баллы и
+сегменты считаются векторно, сразу по всем покупателям:
+
+* границы квинтилей - ``np.quantile`` по каждому признаку;
+* балл 1-5 - ``np.searchsorted`` по этим границам (у давности наоборот:
+  чем свежее заказ, тем выше балл);
+* метка сегмента - ``np.select`` по сочетанию баллов.
+
+Полный прогон запоминает границы в ``SegmentationRun``. Инкрементальный
+берёт покупателей, чьи заказы менялись после начала прошлого прогона
+(индекс по ``Order.updated_at``), и оценивает их по тем же границам, так
+что их баллы сопоставимы с остальными. Давность остальных растёт и без
+новых заказов, поэтому тот же прогон заново оценивает её у всех сохранённых
+сегментов - векторно, по ``CustomerSegment.last_order_at``, - и пишет только
+строки, у которых сменились балл или метка. Удалённые заказы инкрементальный
+прогон не видит - их учтёт следующий полный.
+"""
+from itertools import islice
+from typing import Iterable, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from .models import CustomerSegment, Order, SegmentationRun
+
+SEGMENT_BATCH_SIZE = getattr(settings, "SHOPAPP_SEGMENT_BATCH_SIZE", 5000)
+
+# границы квинтилей: баллы 1-5
+QUANTILES = (0.2, 0.4, 0.6, 0.8)
+FEATURES = ("recency", "frequency", "monetary")
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class CustomerColumns:
+    """
+    Признаки покупателей столбцами NumPy; строка i - покупатель user_ids[i].
+    """
+
+    def __init__(self, rows: Iterable[tuple], now):
+        user_ids, last_orders, frequency, monetary = [], [], [], []
+        for user_id, last_order_at, count, total in rows:
+            user_ids.append(user_id)
+            last_orders.append(last_order_at)
+            frequency.append(count)
+            monetary.append(total)
+        self.user_ids = np.array(user_ids, dtype=np.int64)
+        self.last_orders = last_orders
+        # суммы храним как есть (Decimal), для оценки хватает float
+        self.monetary_values = monetary
+        stamps = np.fromiter((moment.timestamp() for moment in last_orders), dtype=np.float64, count=len(last_orders))
+        self.recency = (now.timestamp() - stamps) / SECONDS_PER_DAY
+        self.frequency = np.array(frequency, dtype=np.int64)
+        self.monetary = np.array(monetary, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def feature(self, name: str) -> np.ndarray:
+        return getattr(self, name)
+
+
+def customer_rows(user_ids: Optional[list] = None):
+    """
+    (user_id, последний заказ, число заказов, сумма) - один GROUP BY по всем заказам или по заказам user_ids.
+    """
+    orders = Order.objects.all()
+    if user_ids is not None:
+        orders = orders.filter(user_id__in=user_ids)
+    return (
+        orders
+        .values("user_id")
+        .annotate(last_order_at=Max("created_at"), frequency=Count("id"), monetary=Sum("total", default=0))
+        .order_by()
+        .values_list("user_id", "last_order_at", "frequency", "monetary")
+        .iterator(chunk_size=SEGMENT_BATCH_SIZE)
+    )
+
+
+def quintile_edges(values: np.ndarray) -> list:
+    if not len(values):
+        return [0.0] * len(QUANTILES)
+    return np.quantile(values, QUANTILES).tolist()
+
+
+def scores(values: np.ndarray, edges: list, higher_is_better: bool = True) -> np.ndarray:
+    """
+    Баллы 1-5: 1 + число границ строго ниже значения (для давности - наоборот).
+
+    Значения, равные границе, попадают в нижний квинтиль, поэтому большая
+    доля одинаковых минимальных значений (один заказ) получает балл 1, а не 5.
+    """
+    below = np.searchsorted(np.asarray(edges, dtype=np.float64), values, side="left")
+    if higher_is_better:
+        return (below + 1).astype(np.int16)
+    return (len(edges) + 1 - below).astype(np.int16)
+
+
+def label_segments(r: np.ndarray, f: np.ndarray, m: np.ndarray) -> np.ndarray:
+    """
+    Метки сегментов по баллам; условия проверяются по порядку, первое совпавшее побеждает.
+    """
+    conditions = [
+        (r >= 4) & (f >= 4) & (m >= 4),
+        (r >= 3) & (f >= 4),
+        (r >= 4) & (f <= 1),
+        r >= 4,
+        (r <= 2) & (f >= 3),
+        (r <= 2) & (f <= 2),
+    ]
+    labels = ["champions", "loyal", "new", "promising", "at_risk", "hibernating"]
+    return np.select(conditions, labels, default="need_attention")
+
+
+def score_columns(columns: CustomerColumns, edges: dict) -> tuple:
+    r = scores(columns.recency, edges["recency"], higher_is_better=False)
+    f = scores(columns.frequency, edges["frequency"])
+    m = scores(columns.monetary, edges["monetary"])
+    return r, f, m, label_segments(r, f, m)
+
+
+def save_segments(columns: CustomerColumns, edges: dict, computed_at, batch_size: int = SEGMENT_BATCH_SIZE):
+    r, f, m, labels = score_columns(columns, edges)
+    # в Python-объекты разом, а не поэлементным доступом к массивам
+    rows = zip(
+        columns.user_ids.tolist(), columns.last_orders, columns.frequency.tolist(), columns.monetary_values,
+        r.tolist(), f.tolist(), m.tolist(), labels.tolist(),
+    )
+    while batch := list(islice(rows, batch_size)):
+        CustomerSegment.objects.bulk_create(
+            [
+                CustomerSegment(
+                    user_id=user_id, last_order_at=last_order_at, frequency=frequency, monetary=monetary,
+                    r_score=r_score, f_score=f_score, m_score=m_score, segment=segment, computed_at=computed_at,
+                )
+                for user_id, last_order_at, frequency, monetary, r_score, f_score, m_score, segment in batch
+            ],
+            update_conflicts=True,
+            unique_fields=["user"],
+            update_fields=[
+                "last_order_at", "frequency", "monetary", "r_score", "f_score", "m_score", "segment", "computed_at",
+            ],
+        )
+
+
+def rescore_recency(edges: dict, now, skip: Iterable[int] = (), batch_size: int = SEGMENT_BATCH_SIZE) -> int:
+    """
+    Пересчитывает давность, её балл и метку сохранённых сегментов (кроме skip). Возвращает число изменённых.
+    """
+    skip = np.fromiter(skip, dtype=np.int64)
+    rows = (
+        CustomerSegment.objects
+        .values_list("user_id", "last_order_at", "r_score", "f_score", "m_score", "segment")
+        .iterator(chunk_size=batch_size)
+    )
+    user_ids, last_orders, r_scores, f_scores, m_scores, labels = [], [], [], [], [], []
+    for user_id, last_order_at, r_score, f_score, m_score, segment in rows:
+        user_ids.append(user_id)
+        last_orders.append(last_order_at.timestamp())
+        r_scores.append(r_score)
+        f_scores.append(f_score)
+        m_scores.append(m_score)
+        labels.append(segment)
+    user_ids = np.array(user_ids, dtype=np.int64)
+    recency = (now.timestamp() - np.array(last_orders, dtype=np.float64)) / SECONDS_PER_DAY
+    r = scores(recency, edges["recency"], higher_is_better=False)
+    new_labels = label_segments(r, np.array(f_scores, dtype=np.int16), np.array(m_scores, dtype=np.int16))
+    changed = (r != np.array(r_scores, dtype=np.int16)) | (new_labels != np.array(labels, dtype=new_labels.dtype))
+    changed &= ~np.isin(user_ids, skip)
+    updates = (
+        CustomerSegment(user_id=user_id, r_score=r_score, segment=segment)
+        for user_id, r_score, segment in zip(
+            user_ids[changed].tolist(), r[changed].tolist(), new_labels[changed].tolist(),
+        )
+    )
+    while batch := list(islice(updates, batch_size)):
+        CustomerSegment.objects.bulk_update(batch, ["r_score", "segment"])
+    return int(changed.sum())
+
+
+def last_full_run() -> Optional[SegmentationRun]:
+    return SegmentationRun.objects.filter(full=True, finished_at__isnull=False).order_by("-started_at").first()
+
+
+def segment_customers(batch_size: int = SEGMENT_BATCH_SIZE) -> SegmentationRun:
+    """
+    Полный прогон: все покупатели, новые границы квинтилей.
+    """
+    run = SegmentationRun.objects.create(full=True, started_at=timezone.now())
+    columns = CustomerColumns(customer_rows(), now=run.started_at)
+    run.edges = {name: quintile_edges(columns.feature(name)) for name in FEATURES}
+    with transaction.atomic():
+        save_segments(columns, run.edges, computed_at=run.started_at, batch_size=batch_size)
+        # покупатели, у которых заказов больше нет
+        CustomerSegment.objects.filter(computed_at__lt=run.started_at).delete()
+        run.users = len(columns)
+        run.finished_at = timezone.now()
+        run.save(update_fields=["edges", "users", "finished_at"])
+    return run
+
+
+def refresh_segments(batch_size: int = SEGMENT_BATCH_SIZE) -> SegmentationRun:
+    """
+    Инкрементальный прогон: покупатели с заказами, изменёнными после начала прошлого прогона,
+    и давность всех остальных.
+
+    Без полного прогона границ ещё нет - тогда выполняется полный.
+    """
+    full = last_full_run()
+    previous = SegmentationRun.objects.filter(finished_at__isnull=False).order_by("-started_at").first()
+    if full is None:
+        return segment_customers(batch_size=batch_size)
+
+    run = SegmentationRun.objects.create(full=False, started_at=timezone.now(), edges=full.edges)
+    user_ids = list(
+        Order.objects
+        .filter(updated_at__gte=previous.started_at)
+        .values_list("user_id", flat=True)
+        .distinct()
+    )
+    columns = CustomerColumns(customer_rows(user_ids), now=run.started_at) if user_ids else None
+    with transaction.atomic():
+        if columns is not None:
+            save_segments(columns, full.edges, computed_at=run.started_at, batch_size=batch_size)
+        rescore_recency(full.edges, now=run.started_at, skip=user_ids, batch_size=batch_size)
+        run.users = len(columns) if columns is not None else 0
+        run.finished_at = timezone.now()
+        run.save(update_fields=["users", "finished_at"])
+    return run
+
+
+def segment_summary() -> dict:
+    """
+    Число покупателей по сегментам и последний прогон.
+    """
+    counts = dict(
+        CustomerSegment.objects.values("segment").annotate(count=Count("pk")).order_by().values_list("segment", "count")
+    )
+    run = SegmentationRun.objects.filter(finished_at__isnull=False).order_by("-started_at").first()
+    return {
+        "segments": {segment: counts.get(segment, 0) for segment, label in CustomerSegment.SEGMENT_CHOICES},
+        "last_run": run,
+    }
@@ -1,15 +1,58 @@
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from django.urls import reverse
+from django.utils import timezone
 from rest_framework import serializers
 
 
-from .models import Product, Order
+from .images import SIZES, srcset, variant_url
+from .jobs import get_progress
+from .rollups import GROUP_BY_CHOICES
+from .models import (
+    Product,
+    ProductImage,
+    ProductRecommendation,
+    Order,
+    OrderItem,
+    ExportJob,
+    CustomerSegment,
+    SegmentationRun,
+)
+
+
+class VariantURLsMixin:
+    """
+    Абсолютные ссылки на варианты картинки и строки srcset для сериализаторов товара и галереи.
+    """
+
+    def absolute(self, url):
+        request = self.context.get("request")
+        return request.build_absolute_uri(url) if request is not None and url else url
+
+    def variant_urls(self, field_file, variants: dict) -> dict:
+        return {
+            variant: self.absolute(variant_url(field_file, variants, variant))
+            for size in SIZES.values()
+            for variant in size
+            if variant in variants
+        }
 
+    def srcsets(self, field_file, variants: dict) -> dict:
+        # по строке srcset на размер: {"thumb": "<url> 1x, <url> 2x", ...}
+        return {
+            size: srcset(field_file, variants, size, build_url=self.absolute)
+            for size in SIZES
+        }
 
-class ProductSerializer(serializers.ModelSerializer):
+
+class ProductSerializer(VariantURLsMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = (
             "pk",
             "name",
+            "sku",
             "description",
             "price",
             "discount",
@@ -17,6 +60,64 @@ class ProductSerializer(serializers.ModelSerializer):
             "created_by",
             "archived",
             "preview",
+            "preview_variants",
+            "preview_srcset",
+        )
+
+    preview_variants = serializers.SerializerMethodField()
+    preview_srcset = serializers.SerializerMethodField()
+
+    def get_preview_variants(self, product: Product) -> dict:
+        return self.variant_urls(product.preview, product.preview_variants)
+
+    def get_preview_srcset(self, product: Product) -> dict:
+        return self.srcsets(product.preview, product.preview_variants)
+
+
+class ProductImageSerializer(VariantURLsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ProductImage
+        fields = (
+            "pk",
+            "product",
+            "image",
+            "description",
+            "variants",
+            "srcset",
+        )
+
+    variants = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+
+    def get_variants(self, image: ProductImage) -> dict:
+        return self.variant_urls(image.image, image.variants)
+
+    def get_srcset(self, image: ProductImage) -> dict:
+        return self.srcsets(image.image, image.variants)
+
+
+class ProductRecommendationSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(source="recommended.name")
+    price = serializers.DecimalField(source="recommended.price", max_digits=8, decimal_places=2)
+    discount = serializers.IntegerField(source="recommended.discount")
+
+    class Meta:
+        model = ProductRecommendation
+        fields = ("recommended", "name", "price", "discount", "orders")
+
+
+class RecommendationQuerySerializer(serializers.Serializer):
+    limit = serializers.IntegerField(min_value=1, max_value=100, required=False)
+
+
+class OrderItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = OrderItem
+        fields = (
+            "product",
+            "quantity",
+            "unit_price",
+            "discount",
         )
 
 
@@ -30,5 +131,140 @@ class OrderSerializer(serializers.ModelSerializer):
             "created_at",
             "user",
             "products",
+            "items",
+            "total",
             "receipt",
         )
+
+    # связь с through-моделью DRF делает только для чтения; set() проставит цены сигналом
+    products = serializers.PrimaryKeyRelatedField(many=True, queryset=Product.objects.all())
+    items = OrderItemSerializer(many=True, read_only=True)
+
+    def save(self, **kwargs):
+        instance = super().save(**kwargs)
+        # сумму пересчитал сигнал строк заказа уже после сохранения самого заказа
+        instance.refresh_from_db(fields=["total", "updated_at"])
+        return instance
+
+
+class BulkOrderSerializer(serializers.Serializer):
+    """
+    Заказ в массовом создании. Ссылки на товары и пользователя - просто pk:
+    PrimaryKeyRelatedField делал бы запрос на каждую, а shopapp.orders
+    проверяет их одним запросом на всю пачку.
+    """
+    delivery_address = serializers.CharField(required=False, allow_blank=True, default="")
+    promocode = serializers.CharField(max_length=20, required=False, allow_blank=True, default="")
+    user = serializers.IntegerField(required=False)
+    products = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+
+class SalesReportQuerySerializer(serializers.Serializer):
+    """
+    Параметры отчёта о продажах; по умолчанию - последние 30 дней по дням.
+    """
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    group_by = serializers.ChoiceField(choices=GROUP_BY_CHOICES, default="day")
+    product = serializers.IntegerField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+    def validate(self, attrs):
+        attrs.setdefault("date_to", timezone.localdate())
+        attrs.setdefault("date_from", attrs["date_to"] - timedelta(days=29))
+        if attrs["date_from"] > attrs["date_to"]:
+            raise serializers.ValidationError({"date_from": "Must not be later than date_to."})
+        return attrs
+
+
+class SalesFiguresSerializer(serializers.Serializer):
+    orders = serializers.IntegerField()
+    units = serializers.IntegerField()
+    # SQLite суммирует decimal как float: приводим к двум знакам
+    revenue = serializers.DecimalField(max_digits=16, decimal_places=2)
+
+
+class SalesRowSerializer(SalesFiguresSerializer):
+    period = serializers.DateField(required=False)
+    product = serializers.IntegerField(required=False)
+    name = serializers.CharField(required=False)
+
+
+class SalesReportSerializer(serializers.Serializer):
+    date_from = serializers.DateField()
+    date_to = serializers.DateField()
+    group_by = serializers.CharField()
+    totals = SalesFiguresSerializer()
+    results = SalesRowSerializer(many=True)
+
+
+class CustomerSegmentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomerSegment
+        fields = (
+            "user",
+            "segment",
+            "last_order_at",
+            "frequency",
+            "monetary",
+            "r_score",
+            "f_score",
+            "m_score",
+            "computed_at",
+        )
+
+
+class SegmentationRunSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SegmentationRun
+        fields = ("pk", "full", "started_at", "finished_at", "users", "edges")
+
+
+class SegmentSummarySerializer(serializers.Serializer):
+    # {сегмент: число покупателей}, все сегменты, в том числе пустые
+    segments = serializers.DictField(child=serializers.IntegerField())
+    last_run = SegmentationRunSerializer(allow_null=True)
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    # те же параметры, что принимают list/download_csv соответствующего viewset
+    filters = serializers.DictField(child=serializers.CharField(), write_only=True, required=False)
+    progress = serializers.SerializerMethodField()
+    download_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ExportJob
+        fields = (
+            "pk",
+            "kind",
+            "format",
+            "filters",
+            "query",
+            "status",
+            "progress",
+            "error",
+            "created_at",
+            "started_at",
+            "finished_at",
+            "download_url",
+        )
+        read_only_fields = (
+            "query",
+            "status",
+            "error",
+            "created_at",
+            "started_at",
+            "finished_at",
+        )
+
+    def get_progress(self, obj: ExportJob) -> dict:
+        return get_progress(obj)
+
+    def get_download_url(self, obj: ExportJob):
+        if obj.status != ExportJob.STATUS_DONE:
+            return None
+        return reverse("shopapp:export-job-download", kwargs={"pk": obj.pk})
+
+    def create(self, validated_data):
+        validated_data["query"] = urlencode(validated_data.pop("filters", {}))
+        return super().create(validated_data)
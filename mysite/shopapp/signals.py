@@ -0,0 +1,171 @@
+"""
+Сброс версий кэша при изменении товаров, картинок и заказов, пересчёт
+сумм заказов при изменении их строк и пометка их дней для сводок продаж
+и их товаров для рекомендаций, а также постановка в очередь построения вариантов новых картинок.
+
+Подключается в ShopappConfig.ready(). Массовые операции (queryset.update,
+bulk_create) сигналов не шлют и сбрасывают кэш сами через shopapp.caching.
+"""
+from django.db.models import QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .caching import bump, bump_user_orders, instance_tag, model_tag, row_tag
+from .images import enqueue_variants, needs_variants, update_image_variants, update_preview_variants
+from .models import Order, OrderItem, Product, ProductImage
+from .orders import snapshot_prices, update_totals
+from .recommendations import mark_products
+from .rollups import mark_instances
+
+
+def bump_product_customers(product_ids):
+    """
+    Выгрузки заказов содержат данные товаров, поэтому их сбрасываем у всех, кто эти товары заказывал.
+    """
+    bump_user_orders(
+        Order.objects
+        .filter(products__in=product_ids)
+        .values_list("user_id", flat=True)
+        .distinct()
+    )
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance: Product, created: bool, **kwargs):
+    bump(model_tag(Product), instance_tag(instance))
+    if not created:
+        bump_product_customers([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def product_preview_saved(sender, instance: Product, raw: bool, **kwargs):
+    if not raw and needs_variants(instance.preview, instance.preview_variants):
+        enqueue_variants(update_preview_variants, instance.pk)
+
+
+def deleted_with(origin, model) -> bool:
+    """
+    Удаление начато с объекта или queryset модели model (``origin`` сигналов удаления).
+    """
+    return isinstance(origin, model) or (isinstance(origin, QuerySet) and issubclass(origin.model, model))
+
+
+@receiver(pre_delete, sender=Product)
+def product_deleting(sender, instance: Product, **kwargs):
+    # после удаления строки through-таблицы уже стёрты, покупателей и заказы ищем заранее
+    bump_product_customers([instance.pk])
+    instance._order_ids = list(OrderItem.objects.filter(product=instance).values_list("order_id", flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance: Product, **kwargs):
+    bump(model_tag(Product), instance_tag(instance))
+    # строки заказов ушли каскадом без своих сигналов (order_item_changed) - суммы пересчитываем разом
+    order_ids = getattr(instance, "_order_ids", ())
+    if order_ids:
+        update_totals(order_ids)
+        mark_products([instance.pk])
+        bump(model_tag(Order), *(row_tag(Order, pk) for pk in order_ids))
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def product_image_changed(sender, instance: ProductImage, **kwargs):
+    # страница товара показывает картинки, её Last-Modified должен сдвинуться
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+    bump(model_tag(ProductImage), row_tag(Product, instance.product_id))
+
+
+@receiver(post_save, sender=ProductImage)
+def product_image_saved(sender, instance: ProductImage, raw: bool, **kwargs):
+    if not raw and needs_variants(instance.image, instance.variants):
+        enqueue_variants(update_image_variants, instance.pk)
+
+
+@receiver(pre_save, sender=Order)
+def order_saving(sender, instance: Order, **kwargs):
+    # заказ могли передать другому пользователю: сбросить нужно и прежнего владельца
+    if instance.pk and not instance._state.adding:
+        previous_user_id = Order.objects.filter(pk=instance.pk).values_list("user_id", flat=True).first()
+        if previous_user_id not in (None, instance.user_id):
+            bump_user_orders([previous_user_id])
+
+
+@receiver([post_save, post_delete], sender=Order)
+def order_changed(sender, instance: Order, **kwargs):
+    bump(model_tag(Order), instance_tag(instance))
+    bump_user_orders([instance.user_id])
+    mark_instances([instance])
+
+
+@receiver(post_delete, sender=Order)
+def order_deleted(sender, instance: Order, origin=None, **kwargs):
+    # товары строк, удалённых каскадом (order_item_deleted), - одной пометкой на всё удаление
+    product_ids = getattr(origin, "_deleted_product_ids", None)
+    if product_ids:
+        mark_products(product_ids)
+        product_ids.clear()
+
+
+@receiver(m2m_changed, sender=OrderItem)
+def order_products_changed(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        # после product.orders.clear() затронутые заказы уже не найти, запоминаем их заранее
+        instance._cleared_order_ids = list(instance.order_items.values_list("order_id", flat=True))
+        return
+    if action == "pre_clear":
+        # а после order.products.clear() - убранные товары, их рекомендации устарели
+        instance._cleared_product_ids = list(instance.items.values_list("product_id", flat=True))
+        return
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        if action == "post_add" and pk_set:
+            # add()/set() через менеджер связи: цена и скидка - текущие у товара
+            snapshot_prices([instance.pk], pk_set)
+        elif action == "post_remove" and pk_set:
+            mark_products(pk_set)
+        elif action == "post_clear":
+            mark_products(getattr(instance, "_cleared_product_ids", ()))
+        update_totals([instance.pk])
+        bump(model_tag(Order), instance_tag(instance))
+        bump_user_orders([instance.user_id])
+        return
+    if action == "post_clear":
+        pk_set = set(getattr(instance, "_cleared_order_ids", ()))
+    elif action == "post_add" and pk_set:
+        snapshot_prices(pk_set, [instance.pk])
+    if action in ("post_remove", "post_clear") and pk_set:
+        # update_totals пометит товары, оставшиеся в заказах, но не сам убранный товар
+        mark_products([instance.pk])
+    if pk_set:
+        update_totals(pk_set)
+        bump(model_tag(Order), *(row_tag(Order, pk) for pk in pk_set))
+        bump_user_orders(Order.objects.filter(pk__in=pk_set).values_list("user_id", flat=True))
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def order_item_changed(sender, instance: OrderItem, origin=None, **kwargs):
+    # строки, записанные напрямую (инлайн админки); каскад от заказа или товара
+    # разбирают их собственные сигналы - одним проходом, а не по строке
+    if deleted_with(origin, Order) or deleted_with(origin, Product):
+        return
+    update_totals([instance.order_id])
+    bump(model_tag(Order), row_tag(Order, instance.order_id))
+    user_id = Order.objects.filter(pk=instance.order_id).values_list("user_id", flat=True).first()
+    if user_id is not None:
+        bump_user_orders([user_id])
+
+
+@receiver(post_delete, sender=OrderItem)
+def order_item_deleted(sender, instance: OrderItem, origin=None, **kwargs):
+    if deleted_with(origin, Product):
+        return
+    if deleted_with(origin, Order):
+        # пометку ставит order_deleted: post_delete строк приходят раньше, чем заказа
+        if not hasattr(origin, "_deleted_product_ids"):
+            origin._deleted_product_ids = set()
+        origin._deleted_product_ids.add(instance.product_id)
+        return
+    # update_totals помечает товары, оставшиеся в заказе; удалённый помечаем сами
+    mark_products([instance.product_id])
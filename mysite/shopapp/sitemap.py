@@ -12,4 +12,4 @@ class ShopSitemap(Sitemap):
         return Product.objects.filter(archived=False).order_by('created_at')
 
     def lastmod(self, obj: Product):
-        return obj.created_at
+        return obj.updated_at
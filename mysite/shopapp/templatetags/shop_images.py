@@ -0,0 +1,30 @@
+from django import template
+from django.utils.html import format_html
+
+from shopapp.images import SIZES, srcset, variant_url
+from shopapp.imaging import VARIANTS
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_image(field_file, variants: dict, size: str = "thumb", alt: str = "", title: str = ""):
+    """
+    <img> с уменьшенной копией и srcset для 2x; пока вариантов нет - исходник, сжатый до той же ширины.
+
+    {% responsive_image product.preview product.preview_variants "thumb" alt=product.name %}
+    """
+    if not field_file:
+        return ""
+    variant = SIZES[size][0]
+    src = variant_url(field_file, variants, variant)
+    if src is None:
+        return format_html(
+            '<img src="{}" alt="{}" title="{}" width="{}" loading="lazy">',
+            field_file.url, alt, title, VARIANTS[variant],
+        )
+    return format_html(
+        '<img src="{}" srcset="{}" alt="{}" title="{}" width="{}" height="{}" loading="lazy">',
+        src, srcset(field_file, variants, size), alt, title,
+        variants[variant]["width"], variants[variant]["height"],
+    )
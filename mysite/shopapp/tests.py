@@ -1,12 +1,50 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from io import StringIO
 from string import ascii_letters
+from unittest import mock
 from random import choices
 
 from django.conf import settings
 from django.contrib.auth.models import User, Group, Permission
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from .models import Product, Order
+import numpy as np
+from mediastore.uploadhandlers import HashedUploadedFile
+
+from .caching import bump, model_tag, update_and_bump, versions_fingerprint
+from .common import CSVImporter, save_csv_orders, save_csv_products
+from .images import update_image_variants, update_preview_variants
+from .jobs import run_export_job
+from .models import (
+    CustomerSegment,
+    DailySales,
+    ExportJob,
+    Product,
+    ProductDailySales,
+    Order,
+    OrderItem,
+    ProductImage,
+    ProductRecommendation,
+    RecommendationDirtyProduct,
+    SalesRollupDirtyDay,
+    SegmentationRun,
+)
+from .orders import create_orders
+from .recommendations import PairCounts, basket_pairs, recommendations_for
+from .search import ensure_search_indexes, full_text_search
+from .segments import label_segments, refresh_segments, scores, segment_customers
+from .serializers import ProductImageSerializer
 
 
 class ProductCreateViewTestCase(TestCase):
@@ -163,11 +201,11 @@ class OrdersExportTestCase(TestCase):
                 'promocode': order.promocode,
                 'user': order.user.pk,
                 'products': [str(product) for product in order.products.filter().values()],
-
+                'total': str(order.total),
             }
             for order in orders
         ]
-        orders_data = response.json()
+        orders_data = json.loads(response.getvalue())
         self.assertEqual(orders_data['orders'], expected_data)
 
 
@@ -189,7 +227,7 @@ class ProductsExportViewTestCase(TestCase):
             }
             for product in products
         ]
-        products_data = response.json()
+        products_data = json.loads(response.getvalue())
         self.assertEqual(products_data['products'], expected_data)
 
 
@@ -230,3 +268,1140 @@ class OrderDetailsViewTestCase(TestCase):
         order_from_db = Order.objects.filter(pk=10000).all()
         order_from_context = response.context['orders']
         self.assertEqual(order_from_db[0].pk, order_from_context.pk)
+
+
+class OrdersCSVExportTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='csv_tester', password='pedro999')
+        cls.products = [
+            Product.objects.create(name=f'Product {i}', price=i, created_by=cls.user)
+            for i in range(3)
+        ]
+        for i in range(5):
+            order = Order.objects.create(delivery_address=f'Street {i}', promocode='promo', user=cls.user)
+            order.products.add(*cls.products[:i % 3 + 1])
+
+    def test_download_csv_streams_orders(self):
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('shopapp:order-download-csv'))
+            self.assertTrue(response.streaming)
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'delivery_address,promocode,created_at,user,products,total')
+        self.assertEqual(len(lines), 6)
+        product_ids = ','.join(str(product.pk) for product in self.products[:2])
+        self.assertIn('Street 1,promo,', lines[2])
+        self.assertTrue(lines[2].endswith(f',csv_tester,"{product_ids}",1.00'))
+
+    def test_download_csv_honors_filters(self):
+        response = self.client.get(
+            reverse('shopapp:product-download-csv'),
+            {'search': 'Product 1'},
+        )
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[1:], ['Product 1,,1.00,0'])
+
+
+class CSVImportTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(username='import_tester', password='pedro999')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def upload(self, url_name, content):
+        csv_file = SimpleUploadedFile('import.csv', content.encode(), content_type='text/csv')
+        return self.client.post(reverse(url_name), {'file': csv_file})
+
+    def test_products_import_coerces_and_reports_bad_rows(self):
+        response = self.upload(
+            'shopapp:product-upload-csv',
+            'name,description,price,discount,archived\n'
+            'Table,Oak,"1 234,50",5,yes\n'
+            'Chair,,abc,0,no\n'
+            ',,1,0,no\n'
+            'Lamp,,10,0,\n',
+        )
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(report['failed'], 2)
+        self.assertEqual([error['line'] for error in report['errors']], [3, 4])
+        table = Product.objects.get(name='Table')
+        self.assertEqual(str(table.price), '1234.50')
+        self.assertTrue(table.archived)
+        self.assertEqual(table.created_by, self.user)
+
+    def test_orders_import_sets_products(self):
+        products = [Product.objects.create(name=f'P{i}', created_by=self.user) for i in range(2)]
+        response = self.upload(
+            'shopapp:order-upload-csv',
+            'delivery_address,promocode,user,products\n'
+            f'Street 1,,import_tester,"{products[0].pk},{products[1].pk}"\n'
+            f'Street 2,,{self.user.pk},{products[1].pk}\n'
+            'Street 3,,nobody,\n'
+            'Street 4,,,999999\n',
+        )
+        report = response.json()
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(report['failed'], 2)
+        order = Order.objects.get(delivery_address='Street 1')
+        self.assertQuerysetEqual(order.products.order_by('pk'), products)
+        self.assertEqual(order.user, self.user)
+
+    def test_import_in_batches(self):
+        content = 'name,price\n' + ''.join(f'Item {i},{i}\n' for i in range(25))
+        report = save_csv_products(
+            SimpleUploadedFile('import.csv', content.encode()).file,
+            encoding='utf-8',
+            created_by=self.user,
+            batch_size=10,
+        )
+        self.assertEqual(report.created, 25)
+        self.assertEqual(Product.objects.filter(name__startswith='Item').count(), 25)
+
+    def test_products_upsert_reports_duplicate_keys(self):
+        content = (
+            'sku,name,price\n'
+            'D-1,First,1\n'
+            'D-2,Other,2\n'
+            'D-1,Second,3\n'
+        )
+        report = save_csv_products(
+            SimpleUploadedFile('import.csv', content.encode()).file,
+            encoding='utf-8',
+            created_by=self.user,
+            upsert_key='sku',
+        )
+        self.assertEqual((report.created, report.failed), (2, 1))
+        self.assertEqual(report.errors[0]['line'], 2)
+        self.assertIn('superseded by line 4', report.errors[0]['error'])
+        self.assertEqual(Product.objects.get(sku='D-1').name, 'Second')
+
+    def test_incomplete_importer_fails_on_creation(self):
+        class BuildOnlyImporter(CSVImporter):
+            def build(self, row, context):
+                return row
+
+        with self.assertRaises(TypeError):
+            BuildOnlyImporter()
+
+    def test_products_upsert_by_sku(self):
+        Product.objects.create(name='Old table', sku='T-1', price=10, created_by=self.user)
+        Product.objects.create(name='Chair', sku='C-1', price=5, created_by=self.user)
+        content = (
+            'sku,name,price\n'
+            'T-1,New table,10\n'
+            'C-1,Chair,5.00\n'
+            'L-1,Lamp,3\n'
+            ',Nameless,1\n'
+        )
+        csv_file = SimpleUploadedFile('import.csv', content.encode(), content_type='text/csv')
+        response = self.client.post(reverse('shopapp:product-upload-csv') + '?upsert_key=sku', {'file': csv_file})
+        report = response.json()
+        self.assertEqual(
+            (report['created'], report['updated'], report['unchanged'], report['failed']),
+            (1, 1, 1, 1),
+        )
+        self.assertEqual(Product.objects.get(sku='T-1').name, 'New table')
+        self.assertEqual(Product.objects.filter(sku__in=['T-1', 'C-1', 'L-1']).count(), 3)
+
+        csv_file = SimpleUploadedFile('import.csv', content.encode(), content_type='text/csv')
+        response = self.client.post(reverse('shopapp:product-upload-csv') + '?upsert_key=sku', {'file': csv_file})
+        self.assertEqual(response.json()['unchanged'], 3)
+        self.assertEqual(Product.objects.count(), 3)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ExportJobTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='job_tester', password='pedro999')
+        for i in range(3):
+            Order.objects.create(delivery_address=f'Street {i}', promocode=f'promo{i % 2}', user=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_export_job_lifecycle(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.client.post(
+                reverse('shopapp:export-job-list'),
+                {'kind': 'orders', 'format': 'ndjson', 'filters': {'promocode': 'promo0'}},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(callbacks), 1)
+        job_id = response.json()['pk']
+        self.assertEqual(response.json()['status'], 'pending')
+
+        run_export_job(job_id)
+
+        status = self.client.get(reverse('shopapp:export-job-detail', kwargs={'pk': job_id})).json()
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['progress'], {'rows_done': 2, 'rows_total': 2})
+
+        response = self.client.get(status['download_url'])
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        content = b''.join(response.streaming_content)
+        rows = [json.loads(line) for line in gzip.decompress(content).splitlines()]
+        self.assertEqual([row['delivery_address'] for row in rows], ['Street 0', 'Street 2'])
+
+        response = self.client.get(status['download_url'], HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), content[10:])
+        self.assertEqual(response['Content-Range'], f'bytes 10-{len(content) - 1}/{len(content)}')
+
+        response = self.client.get(status['download_url'], HTTP_RANGE=f'bytes={len(content)}-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_stuck_running_jobs_are_requeued(self):
+        now = timezone.now()
+        # воркер забрал задачу и умер; вторая ещё честно выполняется
+        stuck = ExportJob.objects.create(kind='orders', created_by=self.user, status=ExportJob.STATUS_RUNNING,
+                                         started_at=now - timezone.timedelta(hours=7))
+        running = ExportJob.objects.create(kind='orders', created_by=self.user, status=ExportJob.STATUS_RUNNING,
+                                           started_at=now)
+        out = StringIO()
+        call_command('run_export_jobs', stdout=out)
+        self.assertIn(f'Export job #{stuck.pk} was stuck in running, requeued', out.getvalue())
+        stuck.refresh_from_db()
+        self.assertEqual(stuck.status, ExportJob.STATUS_DONE)
+        self.assertEqual(stuck.rows_done, 3)
+        self.assertIsNotNone(stuck.started_at)
+        running.refresh_from_db()
+        self.assertEqual(running.status, ExportJob.STATUS_RUNNING)
+
+
+class KeysetPaginationTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='cursor_tester', password='pedro999')
+        for i in range(7):
+            Product.objects.create(name=f'Item {i}', price=i // 2, created_by=cls.user)
+
+    def collect(self, url, params=None):
+        pages = []
+        response = self.client.get(url, params)
+        while True:
+            data = response.json()
+            pages.append([item['pk'] for item in data['results']])
+            if not data['next']:
+                return pages, data
+            response = self.client.get(data['next'])
+
+    def test_walks_all_pages_with_stable_tie_breaking(self):
+        expected = list(Product.objects.order_by('-price', 'pk').values_list('pk', flat=True))
+        pages, last_page = self.collect(reverse('shopapp:product-list'), {'ordering': '-price', 'page_size': 2})
+        self.assertEqual([pk for page in pages for pk in page], expected)
+        self.assertEqual(len(pages), 4)
+        self.assertNotIn('count', last_page)
+
+        previous = self.client.get(last_page['previous']).json()
+        self.assertEqual([item['pk'] for item in previous['results']], pages[-2])
+
+    def test_approximate_count_and_legacy_pages(self):
+        data = self.client.get(reverse('shopapp:product-list'), {'with_count': '1', 'page_size': 3}).json()
+        self.assertEqual(data['count'], 7)
+        data = self.client.get(reverse('shopapp:product-list'), {'page': 1}).json()
+        self.assertEqual(data['count'], 7)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('shopapp:product-list'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'shopapp-tests',
+    },
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheInvalidationTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='cache_tester', password='pedro999')
+        cls.product = Product.objects.create(name='Cached table', price=10, created_by=cls.user)
+
+    def product_names(self):
+        response = self.client.get(reverse('shopapp:product-list'))
+        return [item['name'] for item in response.json()['results']]
+
+    def test_product_list_cache_is_invalidated_on_save(self):
+        self.assertEqual(self.product_names(), ['Cached table'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.product_names(), ['Cached table'])
+
+        self.product.name = 'Renamed table'
+        self.product.save()
+        self.assertEqual(self.product_names(), ['Renamed table'])
+
+    def test_bulk_update_invalidates_export(self):
+        response = self.client.get(reverse('shopapp:products-export'))
+        self.assertFalse(json.loads(response.getvalue())['products'][0]['archived'])
+
+        update_and_bump(Product.objects.filter(pk=self.product.pk), archived=True)
+        response = self.client.get(reverse('shopapp:products-export'))
+        self.assertTrue(json.loads(response.getvalue())['products'][0]['archived'])
+
+    def test_versions_change_after_commit(self):
+        before = versions_fingerprint([model_tag(Product)])
+        with self.captureOnCommitCallbacks(execute=True):
+            bump(model_tag(Product))
+            during = versions_fingerprint([model_tag(Product)])
+        self.assertNotEqual(before, during)
+        self.assertNotEqual(during, versions_fingerprint([model_tag(Product)]))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UserOrdersExportCacheTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='pedro999')
+        cls.bob = User.objects.create_user(username='bob', password='pedro999')
+        cls.product = Product.objects.create(name='Lamp', price=3, created_by=cls.alice)
+        cls.alice_order = Order.objects.create(delivery_address='Alice street', user=cls.alice)
+        cls.bob_order = Order.objects.create(delivery_address='Bob street', user=cls.bob)
+
+    def setUp(self):
+        cache.clear()
+
+    def export(self, user):
+        response = self.client.get(reverse('shopapp:user_orders_export', kwargs={'user_id': user.pk}))
+        return json.loads(response.getvalue())['orders']
+
+    def test_export_is_cached_per_user(self):
+        with self.assertNumQueries(3):
+            alice_orders = self.export(self.alice)
+        self.assertEqual([order['delivery_address'] for order in alice_orders], ['Alice street'])
+        bob_orders = self.export(self.bob)
+        self.assertEqual([order['delivery_address'] for order in bob_orders], ['Bob street'])
+        with self.assertNumQueries(1):
+            self.export(self.alice)
+
+    def test_export_is_invalidated_by_owner_changes_only(self):
+        self.export(self.alice)
+        self.export(self.bob)
+
+        self.alice_order.products.add(self.product)
+        with self.assertNumQueries(1):
+            self.export(self.bob)
+        self.assertIn("'name': 'Lamp'", self.export(self.alice)[0]['products'][0])
+
+        self.product.name = 'Desk lamp'
+        self.product.save()
+        self.assertIn("'name': 'Desk lamp'", self.export(self.alice)[0]['products'][0])
+
+    def test_csv_import_invalidates_export(self):
+        self.assertEqual(len(self.export(self.bob)), 1)
+        content = f'delivery_address,user,products\nImported street,bob,{self.product.pk}\n'
+        save_csv_orders(SimpleUploadedFile('import.csv', content.encode()).file, encoding='utf-8')
+        self.assertEqual([order['delivery_address'] for order in self.export(self.bob)],
+                         ['Bob street', 'Imported street'])
+
+    def test_orders_fragment_skips_orders_query_when_cached(self):
+        self.client.force_login(self.bob)
+        url = reverse('shopapp:user_orders', kwargs={'pk': self.alice.pk})
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(url)
+        self.assertContains(response, f'#{self.alice_order.pk}')
+        self.assertEqual(len(second), len(first) - 1)
+
+    def test_orders_fragment_is_keyed_on_owner(self):
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse('shopapp:user_orders', kwargs={'pk': self.alice.pk}))
+        self.assertContains(response, f'#{self.alice_order.pk}')
+        response = self.client.get(reverse('shopapp:user_orders', kwargs={'pk': self.bob.pk}))
+        self.assertContains(response, f'#{self.bob_order.pk}')
+        self.assertNotContains(response, f'#{self.alice_order.pk}<')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ConditionalGetTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='etag_tester', password='pedro999')
+        cls.product = Product.objects.create(name='Etag table', price=10, created_by=cls.user)
+
+    def assertNotModified(self, url, **headers):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(headers.pop('queries', 0)):
+            again = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        return response
+
+    def test_product_list_and_feed_answer_304_without_queries(self):
+        response = self.assertNotModified(reverse('shopapp:product-list'))
+        self.assertNotModified(reverse('shopapp:products-feed'))
+
+        self.product.save()
+        changed = self.client.get(reverse('shopapp:product-list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+
+    def test_product_details_use_updated_at(self):
+        url = reverse('shopapp:product-detail', kwargs={'pk': self.product.pk})
+        response = self.assertNotModified(url, queries=1)
+        self.assertIn('Last-Modified', response)
+        not_modified = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+
+        self.assertNotModified(reverse('shopapp:product_details', kwargs={'pk': self.product.pk}), queries=1)
+
+    def test_sitemap_etag(self):
+        self.assertNotModified(reverse('django.contrib.sitemaps.views.sitemap'), queries=1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FullTextSearchTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(username='search_tester', password='pedro999')
+        cls.oak = Product.objects.create(name='Oak table', description='Solid oak, seats six', created_by=cls.user)
+        cls.pine = Product.objects.create(name='Pine chair', description='Goes with the oak table', created_by=cls.user)
+        Product.objects.create(name='Lamp', description='Desk lamp', created_by=cls.user)
+        cls.order = Order.objects.create(delivery_address='Lenina street 5', user=cls.user)
+        Order.objects.create(delivery_address='Mira avenue 12', user=cls.user)
+
+    def search(self, term):
+        response = self.client.get(reverse('shopapp:product-list'), {'search': term})
+        return [item['name'] for item in response.json()['results']]
+
+    def test_ranked_prefix_search(self):
+        self.assertEqual(self.search('oak tab'), ['Oak table', 'Pine chair'])
+        self.assertEqual(self.search('"oak" OR lamp*'), [])
+        ordered = self.client.get(reverse('shopapp:product-list'), {'search': 'oak', 'ordering': '-name'})
+        self.assertEqual([item['name'] for item in ordered.json()['results']], ['Pine chair', 'Oak table'])
+
+    def test_index_follows_writes(self):
+        Product.objects.filter(pk=self.pine.pk).update(name='Birch chair')
+        self.assertEqual(self.search('birch'), ['Birch chair'])
+        self.oak.delete()
+        self.assertEqual(self.search('oak'), ['Birch chair'])
+        save_csv_products(
+            SimpleUploadedFile('p.csv', b'name,price,description\nWalnut shelf,10,oak trim\n'),
+            encoding=None,
+            created_by=self.user,
+        )
+        self.assertEqual(sorted(self.search('oak')), ['Birch chair', 'Walnut shelf'])
+
+    def test_orders_and_admin_search(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('shopapp:order-list'), {'search': 'lenin'})
+        self.assertEqual([item['pk'] for item in response.json()['results']], [self.order.pk])
+        response = self.client.get(reverse('admin:shopapp_order_changelist'), {'q': 'lenina 5'})
+        self.assertContains(response, 'Lenina street 5')
+        self.assertNotContains(response, 'Mira avenue')
+
+    def test_rebuild_restores_lost_triggers(self):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER shopapp_product_fts_ai')
+        Product.objects.create(name='Teak bench', created_by=self.user)
+        self.assertEqual(ensure_search_indexes(), [Product])
+        self.assertEqual(list(full_text_search(Product.objects.all(), 'teak')), list(Product.objects.filter(name='Teak bench')))
+
+
+class QueryPlanTestCase(TestCase):
+
+    def test_view_queries_use_indexes(self):
+        out = StringIO()
+        call_command('explain_queries', '--fail-on-issue', stdout=out)
+        self.assertIn('All query plans use indexes', out.getvalue())
+
+    def test_keyset_page_uses_ordering_index(self):
+        from .management.commands.explain_queries import keyset_page
+        from .views import ProductViewSet
+        plan = keyset_page(Product.objects.all(), ProductViewSet, after=True).explain()
+        self.assertIn('product_ordering_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StreamingJSONExportTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='stream_tester', password='pedro999', is_staff=True)
+        cls.products = [
+            Product.objects.create(name=f'Stream product {i}', price=i, created_by=cls.user)
+            for i in range(3)
+        ]
+        for i in range(20):
+            order = Order.objects.create(delivery_address=f'Street {i}', user=cls.user)
+            order.products.set(cls.products[:i % 3 + 1])
+
+    def setUp(self):
+        # откат транзакции теста версии тегов не возвращает
+        cache.clear()
+
+    def test_empty_catalog(self):
+        Product.objects.all().delete()
+        response = self.client.get(reverse('shopapp:products-export'))
+        self.assertEqual(json.loads(response.getvalue()), {'products': []})
+
+    def test_orders_export_streams_with_fixed_queries(self):
+        self.client.force_login(self.user)
+        # сессия, пользователь, затем заказы, строки through-таблицы и товары одной порцией
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('shopapp:orders-export'))
+            data = json.loads(response.getvalue())
+        self.assertTrue(response.streaming)
+        self.assertEqual(len(data['orders']), 20)
+        self.assertEqual(len(data['orders'][5]['products']), 3)
+
+        response = self.client.get(reverse('shopapp:orders-export'), {'format': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = response.getvalue().decode().splitlines()
+        self.assertEqual([json.loads(line)['pk'] for line in lines], [order['pk'] for order in data['orders']])
+
+        response = self.client.get(reverse('shopapp:orders-export'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_small_products_export_is_cached(self):
+        first = self.client.get(reverse('shopapp:products-export'))
+        self.assertTrue(first.streaming)
+        body = first.getvalue()
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse('shopapp:products-export'))
+        self.assertEqual(cached.content, body)
+
+
+def png_file(name='photo.png', size=(800, 600)):
+    from io import BytesIO
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), SHOPAPP_IMAGE_WORKERS=0, CACHES=LOCMEM_CACHES)
+class ImageVariantsTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='image_tester', password='pedro999')
+
+    def test_preview_variants_are_built_after_commit(self):
+        with mock.patch('shopapp.signals.enqueue_variants') as enqueue_variants:
+            product = Product.objects.create(name='Chair', created_by=self.user, preview=png_file())
+        enqueue_variants.assert_called_once_with(update_preview_variants, product.pk)
+
+        update_preview_variants(product.pk)
+        product.refresh_from_db()
+        variants = product.preview_variants
+        self.assertEqual(variants['source'], product.preview.name)
+        self.assertEqual((variants['thumb']['width'], variants['thumb']['height']), (200, 150))
+        # исходник меньше 1200 пикселей не увеличивается
+        self.assertEqual(variants['detail_2x']['width'], 800)
+        self.assertTrue(product.preview.storage.exists(variants['thumb']['name']))
+        self.assertTrue(variants['thumb']['name'].endswith('/thumb.webp'))
+
+        data = self.client.get(reverse('shopapp:product-detail', kwargs={'pk': product.pk})).json()
+        self.assertIn('thumb_2x.webp 2x', data['preview_srcset']['thumb'])
+        self.assertTrue(data['preview_variants']['detail'].startswith('http://testserver/'))
+
+        response = self.client.get(reverse('shopapp:product_details', kwargs={'pk': product.pk}))
+        self.assertContains(response, 'detail_2x.webp 2x')
+
+    def test_gallery_image_variants(self):
+        product = Product.objects.create(name='Table', created_by=self.user)
+        image = ProductImage.objects.create(product=product, image=png_file('table.png', (300, 300)))
+        update_image_variants(image.pk)
+        image.refresh_from_db()
+        self.assertEqual(image.variants['thumb']['width'], 200)
+        self.assertEqual(image.variants['detail']['width'], 300)
+
+        data = ProductImageSerializer(image).data
+        self.assertTrue(data['variants']['thumb'].endswith('/thumb.webp'))
+        self.assertIn('thumb_2x.webp 2x', data['srcset']['thumb'])
+
+    def test_backfill_keeps_going_after_a_failure(self):
+        product = Product.objects.create(name='Shelf', created_by=self.user)
+        with mock.patch('shopapp.signals.enqueue_variants'):
+            images = [ProductImage.objects.create(product=product, image=png_file(f'shelf{i}.png')) for i in range(3)]
+        built = []
+
+        def update_image_variants(image_id):
+            if image_id == images[0].pk:
+                raise OSError('unreadable file')
+            built.append(image_id)
+
+        out = StringIO()
+        with mock.patch('shopapp.management.commands.generate_image_variants.update_image_variants',
+                        update_image_variants), self.assertLogs('shopapp.images', 'ERROR'):
+            call_command('generate_image_variants', stdout=out)
+        self.assertCountEqual(built, [images[1].pk, images[2].pk])
+        self.assertIn('Failed to build variants for 1 of 3 images', out.getvalue())
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), SHOPAPP_IMAGE_WORKERS=0, CACHES=LOCMEM_CACHES)
+class BulkImageUploadTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='gallery_tester', password='pedro999')
+        cls.user.user_permissions.add(Permission.objects.get(codename='change_product'))
+        cls.product = Product.objects.create(name='Sofa', price=100, created_by=cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_update_view_uploads_gallery_in_one_insert(self):
+        files = [png_file(f'sofa-{index}.png', (50, 40)) for index in range(5)]
+        with mock.patch('shopapp.images.enqueue_variants') as enqueue_variants:
+            response = self.client.post(
+                reverse('shopapp:product_update', kwargs={'pk': self.product.pk}),
+                {'name': 'Sofa', 'price': 100, 'discount': 0, 'description': '', 'images': files},
+            )
+        self.assertRedirects(response, reverse('shopapp:product_details', kwargs={'pk': self.product.pk}))
+        images = list(self.product.images.order_by('pk'))
+        self.assertEqual(len(images), 5)
+        self.assertEqual(enqueue_variants.call_count, 5)
+        for image in images:
+            self.assertTrue(image.image.storage.exists(image.image.name))
+
+    def test_update_view_rejects_batch_with_broken_file(self):
+        files = [png_file('good.png'), SimpleUploadedFile('broken.png', b'not an image')]
+        response = self.client.post(
+            reverse('shopapp:product_update', kwargs={'pk': self.product.pk}),
+            {'name': 'Renamed', 'price': 100, 'discount': 0, 'description': '', 'images': files},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('broken.png: not a valid image', response.context['form'].errors['images'])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.name, 'Sofa')
+        self.assertFalse(self.product.images.exists())
+
+    def test_api_upload_images(self):
+        url = reverse('shopapp:product-upload-images', kwargs={'pk': self.product.pk})
+        with mock.patch('shopapp.images.enqueue_variants'):
+            response = self.client.post(url, {
+                'images': [png_file('a.png'), png_file('b.png')],
+                'descriptions': ['front', 'back'],
+            })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([item['description'] for item in response.json()], ['front', 'back'])
+        self.assertEqual(self.product.images.count(), 2)
+
+        response = self.client.post(url, {'images': [SimpleUploadedFile('notes.txt', b'hello')]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.product.images.count(), 2)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class StreamingUploadTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(username='stream_tester', password='pedro999')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_csv_is_imported_while_body_arrives(self):
+        content = 'name,description,price\n"Sofa","Two\nlines, ""quoted""",10\n\nBed,,5\n'
+        csv_file = SimpleUploadedFile('import.csv', content.encode(), content_type='text/csv')
+        with mock.patch('shopapp.views.save_csv_products') as save_csv:
+            response = self.client.post(reverse('shopapp:product-upload-csv'), {'file': csv_file})
+        # файловый путь не понадобился: строки ушли в импортёр из обработчика загрузки
+        save_csv.assert_not_called()
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual(Product.objects.get(name='Sofa').description, 'Two\nlines, "quoted"')
+
+    def test_csv_is_not_imported_before_csrf_check(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        client.cookies[settings.CSRF_COOKIE_NAME] = 'a' * 32
+        url = reverse('shopapp:product-upload-csv')
+
+        def upload(url, token):
+            csv_file = SimpleUploadedFile('import.csv', b'name,price\nSofa,10\n', content_type='text/csv')
+            return client.post(url, {'file': csv_file}, HTTP_X_CSRFTOKEN=token)
+
+        # проверка CSRF читает тело до проверки прав: строки не должны попасть в базу
+        response = upload(url, 'b' * 32)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Product.objects.exists())
+
+        response = upload(url + '?upsert_key=bogus', 'a' * 32)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('upsert_key', response.json())
+        self.assertFalse(Product.objects.exists())
+
+        # верный токен: тело уже во временном файле, импорт идёт из него
+        response = upload(url, 'a' * 32)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['created'], 1)
+
+    def test_bad_upsert_key_before_streaming(self):
+        csv_file = SimpleUploadedFile('import.csv', b'name,price\nSofa,10\n', content_type='text/csv')
+        response = self.client.post(reverse('shopapp:product-upload-csv') + '?upsert_key=bogus', {'file': csv_file})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Product.objects.exists())
+
+    @override_settings(SHOPAPP_CSV_UPLOAD_MAX_SIZE=64)
+    def test_csv_size_limit(self):
+        content = 'name,price\n' + ''.join(f'Item {i},{i}\n' for i in range(20))
+        csv_file = SimpleUploadedFile('import.csv', content.encode(), content_type='text/csv')
+        response = self.client.post(reverse('shopapp:product-upload-csv'), {'file': csv_file})
+        self.assertEqual(response.status_code, 413)
+
+    def test_receipt_is_hashed_while_streaming(self):
+        product = Product.objects.create(name='Desk', created_by=self.user)
+        receipt = SimpleUploadedFile('receipt.pdf', b'%PDF-1.4 receipt', content_type='application/pdf')
+        # хэш посчитан обработчиком загрузки, хранилище файл не перечитывает
+        with mock.patch.object(HashedUploadedFile, 'chunks', side_effect=AssertionError('upload read twice')):
+            response = self.client.post(reverse('shopapp:order-list'), {
+                'delivery_address': 'Street 1',
+                'user': self.user.pk,
+                'products': [product.pk],
+                'receipt': receipt,
+            })
+        self.assertEqual(response.status_code, 201, response.content)
+        order = Order.objects.get(pk=response.json()['pk'])
+        self.assertEqual(os.path.basename(order.receipt.name), hashlib.sha256(b'%PDF-1.4 receipt').hexdigest() + '.pdf')
+        self.assertEqual(order.receipt.read(), b'%PDF-1.4 receipt')
+
+    @override_settings(SHOPAPP_RECEIPT_MAX_SIZE=10)
+    def test_receipt_size_limit(self):
+        product = Product.objects.create(name='Desk', created_by=self.user)
+        receipt = SimpleUploadedFile('receipt.pdf', b'x' * 100, content_type='application/pdf')
+        response = self.client.post(reverse('shopapp:order-list'), {
+            'delivery_address': 'Street 1',
+            'user': self.user.pk,
+            'products': [product.pk],
+            'receipt': receipt,
+        })
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Order.objects.exists())
+
+
+class BulkOrderTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(username='bulk_tester', password='pedro999')
+        cls.chair = Product.objects.create(name='Chair', created_by=cls.user)
+        cls.table = Product.objects.create(name='Table', created_by=cls.user)
+        cls.old = Product.objects.create(name='Old lamp', created_by=cls.user, archived=True)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_bulk_create_orders(self):
+        payload = [
+            {'delivery_address': f'Street {i}', 'products': [self.chair.pk, self.table.pk]}
+            for i in range(3)
+        ]
+        response = self.client.post(reverse('shopapp:order-bulk'), payload, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        created = response.json()['created']
+        self.assertEqual(len(created), 3)
+        for order in Order.objects.filter(pk__in=created):
+            self.assertEqual(order.user, self.user)
+            self.assertEqual(set(order.products.all()), {self.chair, self.table})
+
+    def test_bulk_create_queries(self):
+        orders = [
+            {'user_id': self.user.pk, 'products': [self.chair.pk, self.table.pk]}
+            for _ in range(50)
+        ]
+        # savepoint, товары, пользователи, заказы, through-таблица, пометки дня для сводок и товаров
+        # для рекомендаций, release
+        with self.assertNumQueries(8):
+            create_orders(orders)
+        self.assertEqual(Order.products.through.objects.count(), 100)
+
+    def test_archived_product_rejects_whole_batch(self):
+        payload = [
+            {'products': [self.chair.pk]},
+            {'products': [self.old.pk, 10 ** 6]},
+        ]
+        response = self.client.post(reverse('shopapp:order-bulk'), payload, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual(errors[0], {})
+        self.assertIn(str(self.old.pk), errors[1]['products'][0])
+        self.assertFalse(Order.objects.exists())
+
+    def test_bulk_requires_authentication(self):
+        self.client.logout()
+        payload = [{'products': [self.chair.pk]}]
+        response = self.client.post(reverse('shopapp:order-bulk'), payload, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Order.objects.exists())
+
+    def test_bulk_orders_for_other_users(self):
+        customer = User.objects.create_user(username='bulk_customer', password='pedro999')
+        self.client.force_login(customer)
+        url = reverse('shopapp:order-bulk')
+        response = self.client.post(url, [{'products': [self.chair.pk], 'user': customer.pk}],
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+
+        payload = [{'products': [self.chair.pk]}, {'products': [self.table.pk], 'user': self.user.pk}]
+        response = self.client.post(url, payload, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Order.objects.filter(user=self.user).exists())
+
+        customer.user_permissions.add(Permission.objects.get(codename='change_order'))
+        customer = User.objects.get(pk=customer.pk)
+        self.client.force_login(customer)
+        response = self.client.post(url, payload, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertTrue(Order.objects.filter(user=self.user, products=self.table).exists())
+
+    def test_create_order_command(self):
+        call_command('create_order', '--user', 'bulk_tester', '--count', '5',
+                     '--products', str(self.chair.pk), stdout=StringIO())
+        self.assertEqual(Order.objects.filter(products=self.chair).count(), 5)
+        order = Order.objects.first()
+        call_command('update_order', '--orders', str(order.pk), stdout=StringIO())
+        self.assertEqual(set(order.products.all()), {self.chair, self.table})
+
+
+class OrderItemTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(username='items_tester', password='pedro999')
+        cls.chair = Product.objects.create(name='Chair', price='19.99', created_by=cls.user)
+        cls.table = Product.objects.create(name='Table', price='100.00', discount=15, created_by=cls.user)
+
+    def test_add_snapshots_price_and_keeps_total(self):
+        order = Order.objects.create(delivery_address='Street 1', user=self.user)
+        order.products.add(self.chair, self.table)
+        order.refresh_from_db()
+        self.assertEqual(str(order.total), '104.99')
+        item = order.items.get(product=self.table)
+        self.assertEqual((str(item.unit_price), item.discount), ('100.00', 15))
+
+        # цена товара поменялась - прошлые заказы это не задевает
+        Product.objects.filter(pk=self.chair.pk).update(price='25.00')
+        order.refresh_from_db()
+        self.assertEqual(str(order.total), '104.99')
+
+        order.products.remove(self.table)
+        order.refresh_from_db()
+        self.assertEqual(str(order.total), '19.99')
+
+    def test_repeated_product_is_quantity(self):
+        payload = [{'products': [self.chair.pk, self.chair.pk, self.table.pk]}]
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('shopapp:order-bulk'), payload, content_type='application/json')
+        order = Order.objects.get(pk=response.json()['created'][0])
+        self.assertEqual(order.items.get(product=self.chair).quantity, 2)
+        self.assertEqual(str(order.total), '124.98')
+
+        response = self.client.get(reverse('shopapp:order-detail', kwargs={'pk': order.pk}))
+        self.assertEqual(response.json()['total'], '124.98')
+
+    def test_item_edited_directly_updates_total(self):
+        order = Order.objects.create(delivery_address='Street 2', user=self.user)
+        item = OrderItem.objects.create(order=order, product=self.chair, quantity=3, unit_price='10.00')
+        order.refresh_from_db()
+        self.assertEqual(str(order.total), '30.00')
+        item.delete()
+        order.refresh_from_db()
+        self.assertEqual(str(order.total), '0.00')
+
+    def test_order_delete_does_not_cascade_per_item(self):
+        products = [Product.objects.create(name=f'Part {i}', created_by=self.user) for i in range(50)]
+        order, = create_orders([{'user_id': self.user.pk, 'products': [product.pk for product in products]}])
+        RecommendationDirtyProduct.objects.all().delete()
+        # строки заказа, удаление строк и заказа, пометки дня и товаров - без запросов на каждую строку
+        with self.assertNumQueries(5):
+            order.delete()
+        self.assertEqual(RecommendationDirtyProduct.objects.count(), 50)
+
+    def test_product_delete_updates_totals_once(self):
+        orders = create_orders([{'user_id': self.user.pk, 'products': [self.chair.pk, self.table.pk]}] * 19)
+        RecommendationDirtyProduct.objects.all().delete()
+        table_pk = self.table.pk
+        # картинки и строки товара, покупатели и заказы товара, каскадные удаления,
+        # пересчёт сумм одним bulk_update с пометками дней и товаров
+        with self.assertNumQueries(14):
+            self.table.delete()
+        self.assertEqual({str(total) for total in Order.objects.values_list('total', flat=True)}, {'19.99'})
+        self.assertEqual(Order.objects.get(pk=orders[0].pk).items.count(), 1)
+        self.assertEqual(
+            set(RecommendationDirtyProduct.objects.values_list('product_id', flat=True)), {self.chair.pk, table_pk},
+        )
+
+
+@override_settings(SHOPAPP_SALES_ROLLUP_ASYNC=False, CACHES=LOCMEM_CACHES)
+class SalesRollupTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(username='rollup_tester', password='pedro999')
+        cls.chair = Product.objects.create(name='Chair', price='10.00', created_by=cls.user)
+        cls.table = Product.objects.create(name='Table', price='50.00', discount=10, created_by=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def create(self, *product_lists):
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_orders([{'user_id': self.user.pk, 'products': products} for products in product_lists])
+
+    def test_rollups_follow_order_writes(self):
+        today = timezone.localdate()
+        orders = self.create([self.chair.pk, self.chair.pk], [self.chair.pk, self.table.pk])
+        day = DailySales.objects.get(date=today)
+        self.assertEqual((day.orders, day.units, str(day.revenue)), (2, 4, '75.00'))
+        chair = ProductDailySales.objects.get(date=today, product=self.chair)
+        self.assertEqual((chair.orders, chair.units, str(chair.revenue)), (2, 3, '30.00'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            orders[1].products.remove(self.table)
+        self.assertEqual(str(DailySales.objects.get(date=today).revenue), '30.00')
+        self.assertFalse(ProductDailySales.objects.filter(product=self.table).exists())
+        self.assertFalse(SalesRollupDirtyDay.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.filter(pk__in=[order.pk for order in orders]).delete()
+        self.assertFalse(DailySales.objects.exists())
+
+    def test_report_api(self):
+        self.create([self.chair.pk], [self.table.pk])
+        url = reverse('shopapp:sales-report-list')
+        with self.assertNumQueries(4):
+            # сессия, пользователь, строки и итог - только из сводок
+            response = self.client.get(url, {'group_by': 'day'})
+        data = response.json()
+        self.assertEqual(data['totals'], {'orders': 2, 'units': 2, 'revenue': '55.00'})
+        self.assertEqual(data['results'][0]['period'], timezone.localdate().isoformat())
+
+        data = self.client.get(url, {'group_by': 'product'}).json()
+        self.assertEqual([row['name'] for row in data['results']], ['Table', 'Chair'])
+        self.assertEqual(data['results'][0]['revenue'], '45.00')
+
+        data = self.client.get(url, {'group_by': 'month', 'product': self.chair.pk}).json()
+        self.assertEqual(data['totals']['revenue'], '10.00')
+
+        response = self.client.get(url, {'date_from': '2024-02-01', 'date_to': '2024-01-01'})
+        self.assertEqual(response.status_code, 400)
+
+        self.client.force_login(User.objects.create_user(username='rollup_guest'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_rebuild_command(self):
+        order, = self.create([self.table.pk])
+        past = timezone.now() - timezone.timedelta(days=40)
+        # update() сигналов не шлёт: сводки о переносе заказа не знают
+        Order.objects.filter(pk=order.pk).update(created_at=past)
+        call_command('rebuild_sales_rollups', '--workers', '0', '--chunk-days', '10',
+                     '--from', (timezone.localdate() - timezone.timedelta(days=45)).isoformat(),
+                     '--to', timezone.localdate().isoformat(), stdout=StringIO())
+        self.assertEqual(list(DailySales.objects.values_list('date', 'orders')), [(timezone.localdate(past), 1)])
+
+
+class CustomerSegmentTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(username='segment_admin', password='pedro999')
+        cls.product = Product.objects.create(name='Lamp', price='10.00', created_by=cls.admin)
+        cls.users = [User.objects.create_user(username=f'segment_buyer_{n}') for n in range(5)]
+        now = timezone.now()
+        # покупатель n: n + 1 заказов, последний - n * 30 дней назад
+        for n, user in enumerate(cls.users):
+            for _ in range(n + 1):
+                order = Order.objects.create(user=user)
+                order.products.add(cls.product)
+            Order.objects.filter(user=user).update(created_at=now - timezone.timedelta(days=n * 30))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def test_scores(self):
+        edges = [1, 2, 3, 4]
+        values = np.array([0, 1, 2, 3.5, 4, 9])
+        self.assertEqual(scores(values, edges).tolist(), [1, 1, 2, 4, 4, 5])
+        self.assertEqual(scores(values, edges, higher_is_better=False).tolist(), [5, 5, 4, 2, 2, 1])
+        labels = label_segments(np.array([5, 4, 5, 4, 1, 2, 3]), np.array([5, 4, 1, 2, 3, 1, 2]),
+                                np.array([5, 1, 1, 1, 1, 1, 1]))
+        self.assertEqual(labels.tolist(),
+                         ['champions', 'loyal', 'new', 'promising', 'at_risk', 'hibernating', 'need_attention'])
+
+    def test_full_run(self):
+        run = segment_customers()
+        self.assertEqual(run.users, 5)
+        self.assertEqual(set(run.edges), {'recency', 'frequency', 'monetary'})
+        # самый давний и редкий - в низших квинтилях, самый свежий - в высшем по давности
+        oldest = CustomerSegment.objects.get(user=self.users[4])
+        self.assertEqual((oldest.r_score, oldest.frequency, str(oldest.monetary)), (1, 5, '50.00'))
+        newest = CustomerSegment.objects.get(user=self.users[0])
+        self.assertEqual((newest.r_score, newest.f_score, newest.segment), (5, 1, 'new'))
+        self.assertEqual(CustomerSegment.objects.get(user=self.users[1]).segment, 'promising')
+
+        # покупатель без заказов из сегментов уходит
+        Order.objects.filter(user=self.users[3]).delete()
+        segment_customers()
+        self.assertFalse(CustomerSegment.objects.filter(user=self.users[3]).exists())
+
+    def test_incremental_run(self):
+        segment_customers()
+        with self.assertNumQueries(8):
+            # два последних прогона, новый прогон, покупатели с изменёнными заказами (никого),
+            # давность сохранённых сегментов (ничего не изменилось) и итог прогона в savepoint
+            run = refresh_segments()
+        self.assertEqual((run.full, run.users), (False, 0))
+
+        newcomer = User.objects.create_user(username='segment_newcomer')
+        order = Order.objects.create(user=newcomer)
+        order.products.add(self.product)
+        run = refresh_segments()
+        self.assertEqual((run.full, run.users), (False, 1))
+        segment = CustomerSegment.objects.get(user=newcomer)
+        # оценён по границам полного прогона
+        self.assertEqual((segment.r_score, segment.f_score, segment.segment), (5, 1, 'new'))
+
+    def test_incremental_run_ages_other_customers(self):
+        segment_customers()
+        # со времени полного прогона прошло полгода, новых заказов у покупателя нет
+        CustomerSegment.objects.filter(user=self.users[0]).update(
+            last_order_at=timezone.now() - timezone.timedelta(days=200),
+        )
+        run = refresh_segments()
+        self.assertEqual(run.users, 0)
+        segment = CustomerSegment.objects.get(user=self.users[0])
+        self.assertEqual((segment.r_score, segment.f_score, segment.segment), (1, 1, 'hibernating'))
+        # баллы остальных не изменились
+        self.assertEqual(CustomerSegment.objects.get(user=self.users[1]).segment, 'promising')
+
+    def test_command(self):
+        out = StringIO()
+        call_command('segment_customers', stdout=out)
+        self.assertIn('Segmented 5 customers (full run)', out.getvalue())
+        call_command('segment_customers', '--incremental', stdout=out)
+        self.assertIn('(incremental run)', out.getvalue())
+
+    def test_api(self):
+        segment_customers()
+        url = reverse('shopapp:customersegment-list')
+        data = self.client.get(url, {'segment': 'new'}).json()
+        self.assertEqual([row['user'] for row in data['results']], [self.users[0].pk])
+
+        data = self.client.get(reverse('shopapp:customersegment-summary')).json()
+        self.assertEqual(sum(data['segments'].values()), 5)
+        self.assertTrue(data['last_run']['full'])
+
+        response = self.client.post(reverse('shopapp:customersegment-refresh'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['full'])
+        self.assertEqual(SegmentationRun.objects.count(), 2)
+
+        self.client.force_login(self.users[0])
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+
+@override_settings(SHOPAPP_RECOMMENDATIONS_ASYNC=False, SHOPAPP_SALES_ROLLUP_ASYNC=False, CACHES=LOCMEM_CACHES)
+class RecommendationTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='recommendation_buyer')
+        cls.lamp, cls.bulb, cls.shade, cls.desk = (
+            Product.objects.create(name=name, price='10.00', created_by=cls.user)
+            for name in ('Lamp', 'Bulb', 'Shade', 'Desk')
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def create(self, *product_lists):
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_orders([{'user_id': self.user.pk, 'products': products} for products in product_lists])
+
+    def neighbours(self, product):
+        return list(
+            ProductRecommendation.objects.filter(product=product).order_by('rank').values_list('recommended', 'orders')
+        )
+
+    def test_pair_counts(self):
+        orders = np.array([1, 1, 1, 2, 2])
+        products = np.array([10, 11, 12, 10, 11])
+        pairs = PairCounts()
+        pairs.add(basket_pairs(orders, products))
+        self.assertEqual(dict(pairs.top(2)), {
+            10: [(11, 2), (12, 1)],
+            11: [(10, 2), (12, 1)],
+            12: [(10, 1), (11, 1)],
+        })
+        # строка одного товара: только пары, где он первый
+        pairs = PairCounts()
+        pairs.add(basket_pairs(orders, products, np.array([12])))
+        self.assertEqual(dict(pairs.top(1)), {12: [(10, 1)]})
+
+    def test_pair_counts_merge_chunks(self):
+        pairs = PairCounts()
+        # по заказу на кусок: счётчики копятся без слияния и сводятся при выборке
+        for order_id in range(3):
+            pairs.add(basket_pairs(np.array([order_id, order_id]), np.array([10, 11])))
+        pairs.add(np.empty(0, dtype=np.int64))
+        self.assertEqual(len(pairs.pending), 3)
+        self.assertEqual(dict(pairs.top(1)), {10: [(11, 3)], 11: [(10, 3)]})
+        self.assertEqual((len(pairs.pending), pairs.counts.tolist()), (0, [3, 3]))
+
+    def test_incremental_updates(self):
+        orders = self.create([self.lamp.pk, self.bulb.pk], [self.lamp.pk, self.bulb.pk, self.shade.pk])
+        self.assertEqual(self.neighbours(self.lamp), [(self.bulb.pk, 2), (self.shade.pk, 1)])
+        self.assertEqual(self.neighbours(self.shade), [(self.lamp.pk, 1), (self.bulb.pk, 1)])
+        self.assertFalse(RecommendationDirtyProduct.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            orders[1].products.remove(self.shade)
+        self.assertEqual(self.neighbours(self.lamp), [(self.bulb.pk, 2)])
+        self.assertEqual(self.neighbours(self.shade), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            orders[0].products.add(self.desk)
+        self.assertEqual(self.neighbours(self.desk), [(self.lamp.pk, 1), (self.bulb.pk, 1)])
+
+        incremental = list(ProductRecommendation.objects.values_list('product', 'recommended', 'rank', 'orders'))
+        out = StringIO()
+        call_command('build_recommendations', '--chunk-size', '1', stdout=out)
+        self.assertIn('0 products changed', out.getvalue())
+        self.assertCountEqual(
+            ProductRecommendation.objects.values_list('product', 'recommended', 'rank', 'orders'), incremental,
+        )
+
+        Product.objects.filter(pk=self.bulb.pk).update(archived=True)
+        self.assertEqual([item.recommended for item in recommendations_for(self.lamp.pk)], [self.desk])
+
+    def test_api_and_page(self):
+        self.create([self.lamp.pk, self.bulb.pk])
+        url = reverse('shopapp:product-recommendations', kwargs={'pk': self.lamp.pk})
+        with self.assertNumQueries(2):
+            # updated_at для условного GET и одна выборка по индексу (product, rank)
+            response = self.client.get(url)
+        self.assertEqual(response.json(), [
+            {'recommended': self.bulb.pk, 'name': 'Bulb', 'price': '10.00', 'discount': 0, 'orders': 1},
+        ])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(url, {'limit': 0}).status_code, 400)
+        missing = reverse('shopapp:product-recommendations', kwargs={'pk': self.desk.pk + 100})
+        self.assertEqual(self.client.get(missing).status_code, 404)
+
+        response = self.client.get(reverse('shopapp:product_details', kwargs={'pk': self.lamp.pk}))
+        self.assertContains(response, 'Bulb')
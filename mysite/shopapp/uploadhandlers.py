@@ -0,0 +1,63 @@
+"""
+Обработчик загрузки, который импортирует CSV, пока тело запроса ещё приходит.
+
+Куски файла сразу уходят в ``CSVPushReader`` и дальше в импортёр: файл не
+складывается ни в память, ни во временный файл, и к концу загрузки импорт
+тоже почти закончен. В ``request.FILES`` такой файл не попадает, результат -
+отчёт в ``handler.report``.
+
+Такой обработчик ставится только после проверки прав
+(``UploadHandlersMixin.get_deferred_upload_handlers``). Если тело прочитала
+ещё проверка CSRF, файл лежит во временном файле и импортируется из него.
+"""
+from csv import Error as CSVError
+
+from django.conf import settings
+from django.http.multipartparser import MultiPartParserError
+
+from mediastore.uploadhandlers import LimitedUploadHandler
+
+from .common import CSVPushReader
+
+
+def csv_upload_max_size() -> int:
+    return getattr(settings, "SHOPAPP_CSV_UPLOAD_MAX_SIZE", 200 * 1024 * 1024)
+
+
+def receipt_max_size() -> int:
+    return getattr(settings, "SHOPAPP_RECEIPT_MAX_SIZE", 10 * 1024 * 1024)
+
+
+class CSVImportUploadHandler(LimitedUploadHandler):
+
+    def __init__(self, request=None, importer_factory=None, field_name: str = "file", encoding: str = None,
+                 max_size: int = None):
+        super().__init__(request, csv_upload_max_size() if max_size is None else max_size)
+        self.importer_factory = importer_factory
+        self.import_field = field_name
+        self.encoding = encoding
+        self.reader = None
+        self.report = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name == self.import_field and self.reader is None:
+            self.reader = CSVPushReader(self.importer_factory(), encoding=self.encoding)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.field_name != self.import_field:
+            return raw_data
+        self.check_size(start + len(raw_data))
+        try:
+            self.reader.feed(raw_data)
+        except (UnicodeDecodeError, CSVError) as exc:
+            # парсеры превращают MultiPartParserError в ответ 400
+            raise MultiPartParserError(f"{self.file_name}: {exc}") from exc
+
+    def file_complete(self, file_size):
+        if self.field_name == self.import_field and self.report is None:
+            try:
+                self.report = self.reader.close()
+            except (UnicodeDecodeError, CSVError) as exc:
+                raise MultiPartParserError(f"{self.file_name}: {exc}") from exc
+
@@ -5,6 +5,9 @@ from django.views.decorators.cache import cache_page
 from rest_framework.routers import DefaultRouter
 
 
+from .caching import model_tag
+from .conditional import tags_condition
+from .models import Product
 from .views import (
     ShopIndexView,
     ProductsListView,
@@ -22,6 +25,9 @@ from .views import (
     OrderDeleteView,
     OrdersDataExportView,
     OrderViewSet,
+    ExportJobViewSet,
+    SalesReportViewSet,
+    CustomerSegmentViewSet,
     LatestProductsFeed,
     UserOrdersListView,
     UserOrdersDataExportView,
@@ -32,6 +38,9 @@ app_name = "shopapp"
 routers = DefaultRouter()
 routers.register('products', ProductViewSet)
 routers.register('orders', OrderViewSet)
+routers.register('export-jobs', ExportJobViewSet, basename='export-job')
+routers.register('reports/sales', SalesReportViewSet, basename='sales-report')
+routers.register('customer-segments', CustomerSegmentViewSet)
 
 urlpatterns = [
     # здесь пример применения декоратора cache_page к view-классу:
@@ -49,7 +58,7 @@ urlpatterns = [
     path("products/<int:pk>/archive/", ProductArchiveView.as_view(), name="product_archive"),
     path("products/export/", ProductsDataExportView.as_view(), name="products-export"),
 
-    path('products/feed/', LatestProductsFeed(), name='products-feed'),
+    path('products/feed/', tags_condition(model_tag(Product))(LatestProductsFeed()), name='products-feed'),
 
     path("orders/", OrdersListView.as_view(), name="orders_list"),
     path("orders/<int:pk>/", OrderDetailsView.as_view(), name="order_details"),
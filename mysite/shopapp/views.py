@@ -4,17 +4,17 @@
 Разные view для интернет-магазина: по товарам, заказам и так далее.
 """
 import logging
+import os
 
-from csv import DictWriter
 from timeit import default_timer
 
 from django.contrib.auth.models import Group, User
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin, UserPassesTestMixin
 from django.contrib.syndication.views import Feed
-from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
 # LoginRequiredMixin make views available only for authorized users
 
-from django.http import HttpResponse, HttpRequest, HttpResponseRedirect, JsonResponse, Http404
+from django.http import HttpResponse, HttpRequest, HttpResponseRedirect, Http404
 from django.shortcuts import render, redirect, get_object_or_404, reverse
 from django.urls import reverse_lazy
 
@@ -25,28 +25,93 @@ from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.cache import cache_page
 from django.views.generic import TemplateView, ListView, DetailView, CreateView, UpdateView, DeleteView
-from rest_framework.viewsets import ModelViewSet
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.viewsets import ModelViewSet, GenericViewSet, ReadOnlyModelViewSet
+from rest_framework.mixins import CreateModelMixin, ListModelMixin, RetrieveModelMixin
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.filters import OrderingFilter
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser
 from django_filters.rest_framework import DjangoFilterBackend
 from drf_spectacular.utils import extend_schema, OpenApiResponse
-
-
-from .common import save_csv_products, save_csv_orders
+from mediastore.uploadhandlers import HashingUploadHandler, LimitedTemporaryFileUploadHandler, UploadHandlersMixin
+
+
+from .caching import cache_page_tagged, model_tag, tagged_key, user_orders_tag, versions_fingerprint
+from .conditional import row_condition, row_updated_at, tags_condition
+from .common import UPSERT_KEYS, OrderCSVImporter, product_importer, save_csv_products, save_csv_orders
+from .downloads import ranged_file_response
+from .exports import (
+    ORDER_EXPORT_FIELDS,
+    PRODUCT_EXPORT_FIELDS,
+    iter_order_dicts,
+    iter_order_rows,
+    iter_product_dicts,
+    iter_product_rows,
+    json_export_response,
+    streaming_csv_response,
+)
 from .forms import ProductForm
-from .models import Product, Order, ProductImage
-from .serializers import ProductSerializer,  OrderSerializer
+from .images import ingest_images
+from .jobs import enqueue_export
+from .models import CustomerSegment, DailySales, Product, Order, ProductImage, ExportJob
+from .pagination import KeysetPagination
+from .recommendations import recommendations_for
+from .rollups import sales_report
+from .search import FullTextSearchFilter
+from .segments import refresh_segments, segment_summary
+from .orders import BulkOrderError, create_orders, max_bulk_orders
+from .serializers import (
+    BulkOrderSerializer,
+    CustomerSegmentSerializer,
+    ExportJobSerializer,
+    OrderSerializer,
+    ProductImageSerializer,
+    ProductRecommendationSerializer,
+    ProductSerializer,
+    RecommendationQuerySerializer,
+    SalesReportQuerySerializer,
+    SalesReportSerializer,
+    SegmentationRunSerializer,
+    SegmentSummarySerializer,
+)
+from .uploadhandlers import CSVImportUploadHandler, csv_upload_max_size, receipt_max_size
 
 # прописываем здесь инструмент, а потом используем во въю-функциях, указывая соответствующий уровень дебаггинга.
 log = logging.getLogger(__name__)
 
 
-class OrderViewSet(ModelViewSet):
+def authenticated_user(request):
+    return request.user if request.user.is_authenticated else None
+
+
+def upsert_key_param(request: Request):
+    upsert_key = request.query_params.get("upsert_key")
+    if upsert_key and upsert_key not in UPSERT_KEYS:
+        raise ValidationError({"upsert_key": f"Expected one of {', '.join(UPSERT_KEYS)}"})
+    return upsert_key
+
+
+def streamed_csv_report(request: Request):
+    """
+    Отчёт импорта, если CSV разобран по мере загрузки (CSVImportUploadHandler), иначе None.
+    """
+    handlers = [handler for handler in request.upload_handlers if isinstance(handler, CSVImportUploadHandler)]
+    if not handlers:
+        return None
+    # чтение тела и есть импорт
+    request.FILES
+    if handlers[0].report is None:
+        raise ValidationError({"file": "No file was submitted"})
+    return handlers[0].report
+
+
+class OrderViewSet(UploadHandlersMixin, ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
+    pagination_class = KeysetPagination
 
 #    filter_backends = [
 #        SearchFilter,
@@ -55,10 +120,11 @@ class OrderViewSet(ModelViewSet):
 #    ]
 
     filter_backends = [
+        FullTextSearchFilter,
         OrderingFilter,
         DjangoFilterBackend,
     ]
-    search_fields = ["delivery_address", "products"]
+    search_fields = ["delivery_address"]
     filterset_fields = [
         "delivery_address",
         "promocode",
@@ -80,33 +146,77 @@ class OrderViewSet(ModelViewSet):
             404: OpenApiResponse(description="Empty response, order by id not found"),
         }
     )
+    @method_decorator(row_condition(Order))
     def retrieve(self, *args, **kwargs):
         return super().retrieve(*args, **kwargs)
 
+    @method_decorator(tags_condition(model_tag(Order)))
+    def list(self, *args, **kwargs):
+        return super().list(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ("list", "retrieve"):
+            # товары и строки заказов страницы - двумя запросами, а не по два на заказ
+            queryset = queryset.prefetch_related("products", "items")
+        return queryset
+
+    def get_upload_handlers(self, request):
+        if self.action in ("create", "update", "partial_update"):
+            # чек пишется сразу в каталог хранилища с хэшем, при сохранении его только переименуют
+            return [HashingUploadHandler(request, max_size=receipt_max_size())]
+        if self.action == "upload_csv":
+            return [LimitedTemporaryFileUploadHandler(request, max_size=csv_upload_max_size())]
+        return None
+
+    def get_deferred_upload_handlers(self, request):
+        if self.action == "upload_csv":
+            return [CSVImportUploadHandler(
+                request,
+                importer_factory=lambda: OrderCSVImporter(created_by=authenticated_user(request)),
+                encoding=request.encoding,
+            )]
+        return None
+
+    @extend_schema(
+        summary="Create many orders at once",
+        description="Creates all orders of the list in one transaction, or none if any of them is invalid",
+        request=BulkOrderSerializer(many=True),
+        responses={201: OpenApiResponse(description="Primary keys of the created orders")},
+    )
+    @action(methods=["post"], detail=False, permission_classes=[IsAuthenticated])
+    def bulk(self, request: Request):
+        serializer = BulkOrderSerializer(data=request.data, many=True, max_length=max_bulk_orders())
+        serializer.is_valid(raise_exception=True)
+        user = request.user
+        # заказы на чужое имя - только сотрудникам и тем, кому можно менять любые заказы
+        if any(data.get("user", user.pk) != user.pk for data in serializer.validated_data) and not (
+            user.is_staff or user.has_perm("shopapp.change_order")
+        ):
+            raise PermissionDenied("You may only create orders for yourself.")
+        orders = [
+            {
+                "user_id": data.get("user", user.pk),
+                "products": data["products"],
+                "delivery_address": data["delivery_address"],
+                "promocode": data["promocode"],
+            }
+            for data in serializer.validated_data
+        ]
+        try:
+            created = create_orders(orders)
+        except BulkOrderError as exc:
+            raise ValidationError(exc.errors)
+        return Response({"created": [order.pk for order in created]}, status=201)
+
     @action(methods=["get"], detail=False)
     def download_csv(self, request: Request):
-        response = HttpResponse(content_type="text/csv")
-        filename = "orders-export.csv"
-        response["Content-Disposition"] = f"attachment; filename={filename}"
         queryset = self.filter_queryset(self.get_queryset())
-        fields = [
-            "delivery_address",
-            "promocode",
-            "created_at",
-            "user",
-            "products",
-        ]
-        queryset = queryset.only(*fields)
-        writer = DictWriter(response, fieldnames=fields)
-        writer.writeheader()
-
-        for order in queryset:
-            writer.writerow({
-                field: getattr(order, field)
-                for field in fields
-            })
-
-        return response
+        return streaming_csv_response(
+            iter_order_rows(queryset),
+            fieldnames=ORDER_EXPORT_FIELDS,
+            filename="orders-export.csv",
+        )
 
     @action(
         detail=False,
@@ -116,32 +226,125 @@ class OrderViewSet(ModelViewSet):
         parser_classes=[MultiPartParser],
     )
     def upload_csv(self, request: Request):
-        orders = save_csv_orders(
-            request.FILES["file"].file,
-            encoding=request.encoding,
+        report = streamed_csv_report(request)
+        if report is None:
+            report = save_csv_orders(
+                request.FILES["file"].file,
+                encoding=request.encoding,
+                created_by=authenticated_user(request),
+            )
+        return Response(report.as_dict())
+
+
+@extend_schema(description="Sales reports answered from the daily rollup tables")
+class SalesReportViewSet(GenericViewSet):
+    """
+    Отчёт о продажах за период по дням, неделям, месяцам или товарам.
+
+    Читает только сводные таблицы (shopapp.rollups), заказы не трогает.
+    """
+    permission_classes = [IsAdminUser]
+    serializer_class = SalesReportSerializer
+    pagination_class = None
+
+    @extend_schema(parameters=[SalesReportQuerySerializer], responses=SalesReportSerializer)
+    @method_decorator(tags_condition(model_tag(DailySales)))
+    def list(self, request: Request):
+        query = SalesReportQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        return Response(SalesReportSerializer(sales_report(**query.validated_data)).data)
+
+
+@extend_schema(description="RFM segments of customers")
+class CustomerSegmentViewSet(ReadOnlyModelViewSet):
+    """
+    RFM-сегменты покупателей (shopapp.segments): список с фильтром по сегменту,
+    сводка по сегментам и инкрементальный пересчёт.
+    """
+    queryset = CustomerSegment.objects.order_by("user")
+    serializer_class = CustomerSegmentSerializer
+    permission_classes = [IsAdminUser]
+    filter_backends = [
+        OrderingFilter,
+        DjangoFilterBackend,
+    ]
+    filterset_fields = [
+        "segment",
+        "r_score",
+        "f_score",
+        "m_score",
+    ]
+    ordering_fields = [
+        "user",
+        "last_order_at",
+        "frequency",
+        "monetary",
+    ]
+
+    @extend_schema(responses=SegmentSummarySerializer)
+    @action(methods=["get"], detail=False)
+    def summary(self, request: Request):
+        return Response(SegmentSummarySerializer(segment_summary()).data)
+
+    @extend_schema(request=None, responses=SegmentationRunSerializer)
+    @action(methods=["post"], detail=False)
+    def refresh(self, request: Request):
+        # только покупатели с новыми заказами; полный пересчёт - командой segment_customers
+        return Response(SegmentationRunSerializer(refresh_segments()).data)
+
+
+@extend_schema(description="Background exports of orders and products")
+class ExportJobViewSet(CreateModelMixin, RetrieveModelMixin, ListModelMixin, GenericViewSet):
+    """
+    Фоновые выгрузки: POST ставит выгрузку в очередь, GET показывает её статус,
+    а готовый файл скачивается через download с поддержкой Range.
+    """
+    serializer_class = ExportJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        queryset = ExportJob.objects.order_by("-pk")
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(created_by=self.request.user)
+        return queryset
+
+    def perform_create(self, serializer):
+        job = serializer.save(created_by=self.request.user)
+        enqueue_export(job)
+
+    @action(methods=["get"], detail=True)
+    def download(self, request: Request, pk=None):
+        job = self.get_object()
+        if job.status != ExportJob.STATUS_DONE:
+            return Response({"detail": f"Export is {job.status}"}, status=409)
+        return ranged_file_response(
+            request,
+            job.file.path,
+            content_type="application/gzip",
+            filename=os.path.basename(job.file.name),
         )
-        serializer = self.get_serializer(orders, many=True)
-        return Response(serializer.data)
 
 
 # здесь будет показано как применить кэширование к странице django rest_ramework, т.к. декоратор cache_page
 # в этом случае не применить ни через views ни через urls.
 @extend_schema(description="Product views CRUD")
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(UploadHandlersMixin, ModelViewSet):
     """
     Набор представлений для действий над Product.
     Полный CRUD для сущностей товара.
     """
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    pagination_class = KeysetPagination
     filter_backends = [
-        SearchFilter,
+        FullTextSearchFilter,
         DjangoFilterBackend,
         OrderingFilter,
     ]
     search_fields = ["name", "description"]
     filterset_fields = [
         "name",
+        "sku",
         "description",
         "price",
         "discount",
@@ -161,32 +364,36 @@ class ProductViewSet(ModelViewSet):
             404: OpenApiResponse(description="Empty response, product by id not found"),
         }
     )
+    @method_decorator(row_condition(Product))
     def retrieve(self, *args, **kwargs):
         return super().retrieve(*args, **kwargs)
 
+    def get_upload_handlers(self, request):
+        if self.action == "upload_csv":
+            return [LimitedTemporaryFileUploadHandler(request, max_size=csv_upload_max_size())]
+        return None
+
+    def get_deferred_upload_handlers(self, request):
+        if self.action == "upload_csv":
+            upsert_key = upsert_key_param(request)
+            return [CSVImportUploadHandler(
+                request,
+                importer_factory=lambda: product_importer(
+                    created_by=authenticated_user(request),
+                    upsert_key=upsert_key,
+                ),
+                encoding=request.encoding,
+            )]
+        return None
+
     @action(methods=["get"], detail=False)
     def download_csv(self, request: Request):
-        response = HttpResponse(content_type="text/csv")
-        filename = "products-export.csv"
-        response["Content-Disposition"] = f"attachment; filename={filename}"
         queryset = self.filter_queryset(self.get_queryset())
-        fields = [
-            "name",
-            "description",
-            "price",
-            "discount",
-        ]
-        queryset = queryset.only(*fields)
-        writer = DictWriter(response, fieldnames=fields)
-        writer.writeheader()
-
-        for product in queryset:
-            writer.writerow({
-                field: getattr(product, field)
-                for field in fields
-            })
-
-        return response
+        return streaming_csv_response(
+            iter_product_rows(queryset),
+            fieldnames=PRODUCT_EXPORT_FIELDS,
+            filename="products-export.csv",
+        )
 
     @action(
         detail=False,
@@ -196,16 +403,60 @@ class ProductViewSet(ModelViewSet):
         parser_classes=[MultiPartParser],
     )
     def upload_csv(self, request: Request):
-        products = save_csv_products(
-            request.FILES["file"].file,
-            encoding=request.encoding,
-        )
-        serializer = self.get_serializer(products, many=True)
-        return Response(serializer.data)
+        upsert_key = upsert_key_param(request)
+        report = streamed_csv_report(request)
+        if report is None:
+            report = save_csv_products(
+                request.FILES["file"].file,
+                encoding=request.encoding,
+                created_by=authenticated_user(request),
+                upsert_key=upsert_key,
+            )
+        return Response(report.as_dict())
+
+    @extend_schema(
+        summary="Upload many gallery images at once",
+        description="Multipart form with one or more **images** files and optional **descriptions** "
+                    "in the same order. Returns the created images; 400 if any file is not a valid image",
+        responses={201: ProductImageSerializer(many=True)},
+    )
+    @action(detail=True, methods=["post"], parser_classes=[MultiPartParser])
+    def upload_images(self, request: Request, pk=None):
+        product = self.get_object()
+        files = request.FILES.getlist("images")
+        if not files:
+            raise ValidationError({"images": "No files were submitted"})
+        try:
+            images = ingest_images(product, files, request.data.getlist("descriptions"))
+        except DjangoValidationError as exc:
+            raise ValidationError({"images": exc.messages})
+        serializer = ProductImageSerializer(images, many=True, context=self.get_serializer_context())
+        return Response(serializer.data, status=201)
+
+    @extend_schema(
+        summary="Frequently bought together",
+        description="Products most often ordered together with this one, from the precomputed table; "
+                    "returns 404 if the product is not found",
+        parameters=[RecommendationQuerySerializer],
+        responses={200: ProductRecommendationSerializer(many=True)},
+    )
+    @action(detail=True, methods=["get"])
+    @method_decorator(row_condition(Product))
+    def recommendations(self, request: Request, pk=None):
+        # существование товара уже проверил row_condition, его запрос запомнен
+        if row_updated_at(Product, request, pk) is None:
+            raise Http404
+        query = RecommendationQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        recommendations = recommendations_for(pk, query.validated_data.get("limit"))
+        return Response(ProductRecommendationSerializer(recommendations, many=True).data)
 
     # чисто для кэширования страницы, которую представляет этот view-класс, переопределяем его родительский метод:
     # данный декоратор позволяет кэшировать отдельные методы во view-классах.
-    @method_decorator(cache_page(60 * 2))
+    # ключ включает версию тега товаров, поэтому кэш сбрасывается при любом изменении каталога.
+    # условный GET проверяется до кэша: на совпадающий ETag отвечаем 304, не читая страницу из кэша
+    @method_decorator(tags_condition(model_tag(Product)))
+    @method_decorator(cache_page_tagged(60 * 60 * 6, tags=[model_tag(Product)]))
     def list(self, *args, **kwargs):
         # print('hello products list')
         return super().list(*args, *kwargs)
@@ -240,12 +491,18 @@ class ShopIndexView(View):
         return render(request, 'shopapp/shop-index.html', context=context)
 
 
+@method_decorator(row_condition(Product), name='get')
 class ProductDetailsView(DetailView):
     template_name = 'shopapp/product-details.html'
     # model = Product
     queryset = Product.objects.prefetch_related('images')
     context_object_name = 'product'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["recommendations"] = recommendations_for(self.object.pk)
+        return context
+
 
 class ProductsListView(ListView):
     template_name = 'shopapp/products-list.html'
@@ -260,7 +517,7 @@ class OrderDetailsView(LoginRequiredMixin, DetailView):
     queryset = (
         Order.objects
         .select_related("user")
-        .prefetch_related("products")
+        .prefetch_related("items__product")
     )
     context_object_name = 'orders'
 
@@ -270,7 +527,7 @@ class OrdersListView(LoginRequiredMixin, ListView):
     queryset = (
         Order.objects
         .select_related("user")
-        .prefetch_related("products")
+        .prefetch_related("items__product")
     )
     context_object_name = 'orders'
 
@@ -312,11 +569,8 @@ class ProductUpdateView(UserPassesTestMixin, PermissionRequiredMixin, UpdateView
 
     def form_valid(self, form):
         response = super().form_valid(form)
-        for image in form.files.getlist('images'):
-            ProductImage.objects.create(
-                product=self.object,
-                image=image
-            )
+        # картинки уже проверены в ProductForm.clean_images
+        ingest_images(self.object, form.cleaned_data['images'], validated=True)
         return response
 
     def test_func(self):
@@ -384,44 +638,25 @@ class OrdersDataExportView(UserPassesTestMixin, View):
         if self.request.user.is_staff:
             return True
 
-    def get(self, request: HttpRequest) -> JsonResponse:
-        orders = Order.objects.order_by('pk').all()
-        orders_data = [
-            {
-                'pk': order.pk,
-                'delivery_address': order.delivery_address,
-                'promocode': order.promocode,
-                'user': order.user.pk,
-                'products': [str(product) for product in order.products.filter().values()],
-            }
-            for order in orders
-        ]
-        return JsonResponse({'orders': orders_data})
+    def get(self, request: HttpRequest) -> HttpResponse:
+        orders = Order.objects.order_by('pk')
+        return json_export_response(request, 'orders', iter_order_dicts(orders))
 
 
 # ----------------------------------пример низкоуровневого кэширования через Cache API:--------------------------------
 # так же без прописывания каких-либо middlewares
-#
+# выгрузка отдаётся потоком, а в кэш попадает, только если целиком уложилась в EXPORT_CACHE_MAX_SIZE
 
 class ProductsDataExportView(View):
-    def get(self, request: HttpRequest) -> JsonResponse:
-        cache_key = "products_data_export"
-        products_data = cache.get(cache_key)
-        if products_data is None:
-            products = Product.objects.order_by('pk').all()
-            products_data = [
-                {
-                    'pk': product.pk,
-                    'name': product.name,
-                    'price': product.price,
-                    'archived': product.archived
-                }
-                for product in products
-            ]
-            elem = products_data[0]
-            name = elem['name']
-            cache.set(cache_key, products_data, 300)
-        return JsonResponse({'products': products_data})
+    def get(self, request: HttpRequest) -> HttpResponse:
+        products = Product.objects.order_by('pk')
+        return json_export_response(
+            request,
+            'products',
+            iter_product_dicts(products),
+            cache_key=tagged_key("products_data_export", [model_tag(Product)]),
+            timeout=60 * 60 * 6,
+        )
 
 
 class LatestProductsFeed(Feed):
@@ -459,33 +694,27 @@ class UserOrdersListView(LoginRequiredMixin, DetailView):
         context = super().get_context_data(**kwargs)
 
         res = Order.objects.filter(user_id=self.owner.pk)
-        context['orders'] = [order.pk for order in res]
+        # ленивый queryset: список выбирается только при промахе {% cache %}, а проверка наличия - exists()
+        context['orders'] = res.values_list('pk', flat=True)
         context['owner'] = self.owner
         context['user'] = self.request.user
+        context['orders_version'] = versions_fingerprint([user_orders_tag(self.owner.pk)])
 
         return context
 
 
 class UserOrdersDataExportView(View):
 
-    def get(self, request: HttpRequest, user_id) -> JsonResponse:
+    def get(self, request: HttpRequest, user_id) -> HttpResponse:
         try:
             user = User.objects.get(pk=user_id)
         except Exception as exc:
             raise Http404('Такого пользователя не существует')
-        cache_key = 'user_orders_data_export'
-        orders_data = cache.get(cache_key)
-        if orders_data is None:
-            orders = Order.objects.filter(user_id=user_id).order_by('pk')
-            orders_data = [
-                {
-                    'pk': order.pk,
-                    'delivery_address': order.delivery_address,
-                    'promocode': order.promocode,
-                    'user': order.user.pk,
-                    'products': [str(product) for product in order.products.filter().values()],
-                }
-                for order in orders
-            ]
-            cache.set(cache_key, orders_data, 300)
-        return JsonResponse({'orders': orders_data})
+        orders = Order.objects.filter(user_id=user.pk).order_by('pk')
+        return json_export_response(
+            request,
+            'orders',
+            iter_order_dicts(orders),
+            cache_key=tagged_key(f'user_orders_data_export:{user.pk}', [user_orders_tag(user.pk)]),
+            timeout=60 * 60 * 6,
+        )